@@ -0,0 +1,80 @@
+"""Recall against latency of approximate nearest neighbor searches, on the
+EcoBici stations and on uniform and clustered sets. Sweeps the relative error
+eps with no budget, then the visit budget max_visits with eps = 0, for both
+trees. Recall is the fraction of queries whose answer is as close as the
+true nearest neighbor, and the error is the mean and worst ratio of the
+answer's distance to the true one, minus 1.
+
+    python -m benchmarks.approximate --sizes 100000 1000000"""
+import argparse
+import time
+import numpy as np
+
+import tree as kd
+import vptree as vpt
+from benchmarks.common import (BruteForce, clustered_points, ecobici_points,
+                               uniform_points)
+
+# build from an (n, 2) array, and distance of an approximate search
+INDEXES = {
+    '2d': (lambda p: kd.Tree(p[:, 0], p[:, 1]),
+           lambda index, q, eps, budget: index.nearest_neighbor(
+               q, eps=eps, max_visits=budget)[0]),
+    'vp': (lambda p: vpt.VpTree(p),
+           lambda index, q, eps, budget: index.nearest_neighbor(
+               q, eps=eps, max_visits=budget)[1]),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10**5])
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--eps', type=float, nargs='+',
+                        default=[0.0, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0])
+    parser.add_argument('--budgets', type=int, nargs='+',
+                        default=[16, 32, 64, 128, 256])
+    args = parser.parse_args()
+
+    datasets = [('ecobici', ecobici_points())]
+    for n in args.sizes:
+        datasets += [(f'uniform-{n}', uniform_points(n)),
+                     (f'clustered-{n}', clustered_points(n))]
+    settings = [(eps, None) for eps in args.eps]
+    settings += [(0.0, budget) for budget in args.budgets]
+
+    print(f"{'dataset':>16} {'index':>5} {'eps':>5} {'budget':>6} "
+          f"{'recall':>7} {'mean err':>9} {'max err':>8} {'visits':>7} "
+          f"{'p50 (us)':>8} {'p99 (us)':>8}")
+    for name, points in datasets:
+        rng = np.random.default_rng(1)
+        queries = rng.uniform(points.min(axis=0), points.max(axis=0),
+                              size=(args.queries, 2))
+        d_true, _ = BruteForce(points).query(queries)
+        queries = queries.tolist()
+        for index_name, (build, search) in INDEXES.items():
+            index = build(points)
+            for eps, budget in settings:
+                d = np.empty(len(queries))
+                latency = np.empty(len(queries))
+                visits = 0
+                for j, q in enumerate(queries):
+                    start = time.perf_counter()
+                    d[j] = search(index, q, eps, budget)
+                    latency[j] = time.perf_counter() - start
+                    visits += index.visits
+                ratio = np.ones(d.shape[0])
+                positive = d_true > 0
+                ratio[positive] = d[positive] / d_true[positive]
+                ratio[~positive & (d > 0)] = np.inf
+                p50, p99 = 1e6 * np.percentile(latency, [50, 99])
+                print(f"{name:>16} {index_name:>5} {eps:>5.2f} "
+                      f"{budget or '-':>6} {np.mean(d <= d_true):>7.3f} "
+                      f"{ratio.mean() - 1:>9.4f} {ratio.max() - 1:>8.3f} "
+                      f"{visits / len(queries):>7.1f} {p50:>8.1f} "
+                      f"{p99:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""2d-tree and vp-tree construction benchmark across input sizes."""
+import argparse
+
+import tree as kd
+import vptree as vpt
+from benchmarks.common import best_of, uniform_points
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10**3, 10**4, 10**5, 10**6])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'n':>10} {'2d (s)':>10} {'us/point':>10} {'vp (s)':>10} "
+          f"{'us/point':>10}")
+    for n in args.sizes:
+        points = uniform_points(n)
+        repeat = args.repeat if n < 10**6 else 1
+        t_kd, _ = best_of(lambda: kd.Tree(points[:, 0], points[:, 1]), repeat)
+        t_vp, _ = best_of(lambda: vpt.VpTree(points), repeat)
+        print(f"{n:>10} {t_kd:>10.3f} {1e6 * t_kd / n:>10.2f} "
+              f"{t_vp:>10.3f} {1e6 * t_vp / n:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Query cache benchmark: replays a query log against the EcoBici stations
+without a cache, with an exact-query cache and with grid caches of several
+cell sizes, for both trees. The default log is synthetic and repetitive, with
+queries around a few hundred hubs of Zipf-distributed popularity snapped to a
+10 m grid; --log replays a JSON/NDJSON/CSV file of lon/lat queries instead."""
+import argparse
+import time
+import numpy as np
+
+import tree as kd
+import vptree as vpt
+from benchmarks.common import ecobici_points
+from cache import QueryCache
+from ingest import load_points
+
+
+def synthetic_log(points: np.ndarray, m: int, hubs: int = 300,
+                  seed: int = 0) -> np.ndarray:
+    """Samples m queries around hubs with Zipf-distributed popularity.
+    ----------------------------------------------------------------------------
+    Args:
+        points: (n, 2)-shape array of stations, hubs are drawn near them
+        m: number of queries
+        hubs: number of distinct hubs
+        seed: random generator seed
+    Returns:
+        queries: (m, 2)-shape array of query coords"""
+    rng = np.random.default_rng(seed)
+    centers = points[rng.choice(points.shape[0], hubs)] + \
+        rng.normal(scale=0.3, size=(hubs, 2))
+    weights = 1.0 / np.arange(1, hubs + 1)
+    hub = rng.choice(hubs, size=m, p=weights / weights.sum())
+    queries = centers[hub] + rng.normal(scale=0.05, size=(m, 2))
+
+    return np.round(queries, 2) # 10 m resolution, as in rounded GPS fixes
+
+
+def replay(nearest, queries: np.ndarray) -> tuple:
+    """Answers queries one at a time, returns latencies and distances."""
+    latency, dists = np.empty(queries.shape[0]), np.empty(queries.shape[0])
+    for j, q in enumerate(queries.tolist()):
+        start = time.perf_counter()
+        dists[j] = nearest(q)
+        latency[j] = time.perf_counter() - start
+
+    return latency, dists
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--queries', type=int, default=10**5)
+    parser.add_argument('--log', help='file of lon/lat queries to replay')
+    parser.add_argument('--cells', type=float, nargs='+',
+                        default=[0.05, 0.1, 0.25], help='cell sizes in km')
+    parser.add_argument('--max-entries', type=int, default=4096)
+    args = parser.parse_args()
+
+    points = ecobici_points()
+    if args.log:
+        # queries use the stations' projection, centered at their mean
+        _, _, projection = load_points('data/station_information.json')
+        queries = np.column_stack(load_points(
+            args.log, projection=projection)[:2])[:args.queries]
+    else:
+        queries = synthetic_log(points, args.queries)
+
+    print(f"{'index':>8} {'cache':>10} {'hit rate':>9} {'mean (us)':>10} "
+          f"{'p50 (us)':>9} {'p99 (us)':>9} {'speedup':>8}")
+    for name, index in (('2d-tree', kd.Tree(points[:, 0], points[:, 1])),
+                        ('vp-tree', vpt.VpTree(points))):
+        latency, expected = replay(lambda q: index.knn(q, 1)[0][0], queries)
+        base = latency.mean()
+        p50, p99 = np.percentile(1e6 * latency, [50, 99])
+        print(f"{name:>8} {'none':>10} {'-':>9} {1e6 * base:>10.1f} "
+              f"{p50:>9.1f} {p99:>9.1f} {1.0:>8.2f}")
+
+        for cell in [None] + args.cells:
+            cache = QueryCache(index, cell, args.max_entries)
+            latency, dists = replay(
+                lambda q: cache.nearest_neighbor(q)[0], queries)
+            # cached answers must match the uncached ones
+            assert np.allclose(dists, expected, rtol=1e-12, atol=0.0)
+            p50, p99 = np.percentile(1e6 * latency, [50, 99])
+            label = 'exact' if cell is None else f'{cell:g} km'
+            print(f"{name:>8} {label:>10} {cache.stats['hit_rate']:>9.3f} "
+                  f"{1e6 * latency.mean():>10.1f} {p50:>9.1f} {p99:>9.1f} "
+                  f"{base / latency.mean():>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
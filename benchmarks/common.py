@@ -0,0 +1,151 @@
+"""Shared helpers for the benchmark scripts. Run them from the repository root
+as modules, e.g. `python -m benchmarks.build`."""
+import math
+import time
+import numpy as np
+from typing import Callable, List, Tuple
+
+from ingest import load_points
+from metrics import Euclidean
+
+
+def uniform_points(n: int, seed: int = 0) -> np.ndarray:
+    """Samples n 2d-points uniformly over a city-sized box (in km).
+    ----------------------------------------------------------------------------
+    Args:
+        n: number of points
+        seed: random generator seed
+    Returns:
+        points: (n, 2)-shape array of xy coords"""
+    rng = np.random.default_rng(seed)
+    return rng.uniform(low=(-10.0, -10.0), high=(10.0, 10.0), size=(n, 2))
+
+
+def clustered_points(n: int, seed: int = 0, clusters: int = 20) -> np.ndarray:
+    """Samples n 2d-points from gaussian blobs of a few hundred meters spread
+    over the same box as uniform_points, like stations around city hubs.
+    ----------------------------------------------------------------------------
+    Args:
+        n: number of points
+        seed: random generator seed
+        clusters: number of blobs
+    Returns:
+        points: (n, 2)-shape array of xy coords"""
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(low=-9.0, high=9.0, size=(clusters, 2))
+    spread = rng.uniform(low=0.1, high=0.5, size=clusters)
+    blob = rng.integers(clusters, size=n)
+
+    return centers[blob] + rng.normal(size=(n, 2)) * spread[blob, None]
+
+
+def duplicate_points(n: int, seed: int = 0) -> np.ndarray:
+    """Samples n 2d-points snapped to a coarse 100 m grid, so most coords are
+    repeated many times, as with stations sharing an address.
+    ----------------------------------------------------------------------------
+    Args:
+        n: number of points
+        seed: random generator seed
+    Returns:
+        points: (n, 2)-shape array of xy coords"""
+    return np.round(uniform_points(n, seed), 1)
+
+
+def line_points(n: int, seed: int = 0) -> np.ndarray:
+    """Samples n 2d-points along a diagonal of the box of uniform_points,
+    moved off it by a few millimeters, like stops along a straight avenue.
+    ----------------------------------------------------------------------------
+    Args:
+        n: number of points
+        seed: random generator seed
+    Returns:
+        points: (n, 2)-shape array of xy coords"""
+    rng = np.random.default_rng(seed)
+    t = rng.uniform(low=-10.0, high=10.0, size=n)
+    noise = rng.normal(scale=1e-6, size=n)
+
+    return np.column_stack((t + noise, 0.5 * t - noise))
+
+
+def ecobici_points(path: str = 'data/station_information.json') -> np.ndarray:
+    """Loads the EcoBici stations projected to local xy coords (in km), with
+    the same projection around the mean used by ecobici.py.
+    ----------------------------------------------------------------------------
+    Args:
+        path: station information json file
+    Returns:
+        points: (n, 2)-shape array of xy coords"""
+    xs, ys, _ = load_points(path)
+    return np.column_stack((xs, ys))
+
+
+def best_of(fn: Callable, repeat: int = 3) -> Tuple[float, object]:
+    """Runs fn repeat times and keeps the fastest wall-clock time.
+    ----------------------------------------------------------------------------
+    Args:
+        fn: zero-argument callable to time
+        repeat: number of runs
+    Returns:
+        (best time in seconds, result of the last run)"""
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+class BruteForce:
+    def __init__(self, points: np.ndarray):
+        """Exhaustive search baseline with the same search methods as the
+        trees. Results are exact, ties are broken by lowest index.
+        ------------------------------------------------------------------------
+        Args:
+            points: (n, 2)-shape array of xy coords"""
+        self._points = np.array(points, dtype=float).reshape(-1, 2)
+        self.visits = self._points.shape[0] # every point, for every query
+
+    def __len__(self) -> int:
+        return self._points.shape[0]
+
+    def distances(self, points: np.ndarray) -> np.ndarray:
+        """(m, n)-shape array of distances from queries to all points."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return Euclidean.dists(points[:, None, 0], points[:, None, 1],
+                               self._points[None, :, 0],
+                               self._points[None, :, 1])
+
+    def query(self, points: np.ndarray, chunk: int = 2**24) -> Tuple:
+        """Batch nearest neighbor search, in chunks of about chunk distances.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            chunk: number of distances computed at once
+        Returns:
+            dists: (m,)-shape array of distances to the nearest neighbors
+            indices: (m,)-shape array of the nearest neighbors' indices"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        m = points.shape[0]
+        dists = np.full(m, math.inf)
+        indices = np.full(m, -1, dtype=np.int64)
+        if len(self) == 0:
+            return dists, indices
+        step = max(1, chunk // len(self))
+        for lo in range(0, m, step):
+            d = self.distances(points[lo:lo + step])
+            indices[lo:lo + step] = d.argmin(axis=1) # first, lowest index
+            dists[lo:lo + step] = d.min(axis=1)
+
+        return dists, indices
+
+    def knn(self, query: List[float], k: int) -> Tuple[np.ndarray]:
+        d = self.distances(query)[0]
+        order = np.lexsort((np.arange(d.shape[0]), d))[:k]
+        return d[order], order
+
+    def query_radius(self, query: List[float], r: float) -> Tuple[np.ndarray]:
+        d = self.distances(query)[0]
+        hits = np.flatnonzero(d <= r)
+        order = np.lexsort((hits, d[hits]))
+        return d[hits[order]], hits[order]
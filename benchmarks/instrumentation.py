@@ -0,0 +1,105 @@
+"""Search and build statistics of both trees, see stats.py. Runs nearest
+neighbor, k nearest neighbors and radius queries on the EcoBici stations and
+on uniform and clustered sets with a Stats object attached, and prints per
+operation means of the counters and latency percentiles, plus the build time
+per phase. The nearest neighbor latency is also measured without stats, to
+show the cost of recording. --json and --prom write the aggregated
+statistics of the last dataset for dashboards.
+
+    python -m benchmarks.instrumentation --sizes 100000 --prom out/stats.prom"""
+import argparse
+import time
+import numpy as np
+
+import tree as kd
+import vptree as vpt
+from benchmarks.common import clustered_points, ecobici_points, uniform_points
+from stats import Stats
+
+INDEXES = {
+    'kdtree': lambda p, stats: kd.Tree(p[:, 0], p[:, 1], stats=stats),
+    'vptree': lambda p, stats: vpt.VpTree(p, stats=stats),
+}
+
+
+def nn_latency(index, queries: list, repeat: int = 3) -> float:
+    """Best mean nearest neighbor latency over queries, in microseconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for q in queries:
+            index.nearest_neighbor(q)
+        best = min(best, time.perf_counter() - start)
+
+    return 1e6 * best / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10**5])
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--json', help='output file for the JSON export')
+    parser.add_argument('--prom', help='output file for the Prometheus export')
+    args = parser.parse_args()
+
+    datasets = [('ecobici', ecobici_points())]
+    for n in args.sizes:
+        datasets += [(f'uniform-{n}', uniform_points(n)),
+                     (f'clustered-{n}', clustered_points(n))]
+
+    for name, points in datasets:
+        rng = np.random.default_rng(1)
+        queries = rng.uniform(points.min(axis=0), points.max(axis=0),
+                              size=(args.queries, 2)).tolist()
+        stats = Stats()
+        indexes = {kind: build(points, stats)
+                   for kind, build in INDEXES.items()}
+        overhead = {}
+        for kind, index in indexes.items():
+            index.stats = None
+            # radius of twice the median nearest neighbor distance
+            r = 2.0 * float(np.median([index.knn(q, 1)[0][0]
+                                       for q in queries[:100]]))
+            t_off = nn_latency(index, queries)
+            index.stats = Stats()
+            t_on = nn_latency(index, queries)
+            overhead[kind] = (t_off, t_on)
+            index.stats = stats
+            for q in queries:
+                index.nearest_neighbor(q)
+                index.knn(q, args.k)
+                index.query_radius(q, r)
+
+        summary = stats.to_dict()
+        print(f"\n{name}")
+        print(f"{'index':>7} {'op':>7} {'visits':>7} {'checks':>7} "
+              f"{'pruned':>7} {'depth':>6} {'p50 (us)':>9} {'p99 (us)':>9}")
+        for kind, ops in summary['queries'].items():
+            for op, s in ops.items():
+                print(f"{kind:>7} {op:>7} {s['visits']['mean']:>7.1f} "
+                      f"{s['checks']['mean']:>7.1f} "
+                      f"{s['pruned']['mean']:>7.1f} "
+                      f"{s['depth']['mean']:>6.1f} "
+                      f"{1e6 * s['seconds']['p50']:>9.0f} "
+                      f"{1e6 * s['seconds']['p99']:>9.0f}")
+        print(f"{'index':>7} {'sort (s)':>9} {'partition (s)':>14} "
+              f"{'layout (s)':>11} {'nn (us)':>8} {'nn stats (us)':>14}")
+        for kind, b in summary['builds'].items():
+            phases = b['seconds']
+            t_off, t_on = overhead[kind]
+            print(f"{kind:>7} {phases['sort']:>9.3f} "
+                  f"{phases['partition']:>14.3f} {phases['layout']:>11.3f} "
+                  f"{t_off:>8.1f} {t_on:>14.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(stats.to_json(indent=2))
+    if args.prom:
+        with open(args.prom, 'w') as f:
+            f.write(stats.to_prometheus())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Nearest neighbor joins: matches a large set of trip origins to their
+nearest station with one nearest_neighbor call per point (timed on a sample
+and scaled), with the batch query, and with the dual-tree nearest_join (query
+tree build included, then with a prebuilt query tree). Stations are the
+EcoBici ones or uniform and clustered synthetic sets, and trip origins are
+uniform over the stations' bounding box. Also times the all nearest neighbors
+and closest pair of the stations against k = 2 nearest neighbors searches.
+Answers are checked against the batch query and brute force.
+
+    python -m benchmarks.join --sizes 100000 --queries 1000000"""
+import argparse
+import time
+import numpy as np
+
+import tree as kd
+from join import QUERY_LEAF_SIZE
+from benchmarks.common import (BruteForce, best_of, clustered_points,
+                               ecobici_points, uniform_points)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10**5])
+    parser.add_argument('--queries', type=int, default=2 * 10**5)
+    parser.add_argument('--sample', type=int, default=2000,
+                        help='queries timed one by one')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    datasets = [('ecobici', ecobici_points())]
+    for n in args.sizes:
+        datasets += [(f'uniform-{n}', uniform_points(n)),
+                     (f'clustered-{n}', clustered_points(n))]
+
+    print(f"{'stations':>16} {'per point (s)':>14} {'batch (s)':>10} "
+          f"{'join (s)':>9} {'prebuilt (s)':>13} {'all nn (s)':>11} "
+          f"{'k=2 (s)':>8} {'errors':>7}")
+    for name, points in datasets:
+        rng = np.random.default_rng(1)
+        queries = rng.uniform(points.min(axis=0), points.max(axis=0),
+                              size=(args.queries, 2))
+        index = kd.Tree(points[:, 0], points[:, 1])
+
+        # one call per point, scaled from a sample
+        sample = queries[:args.sample].tolist()
+        start = time.perf_counter()
+        for q in sample:
+            index.nearest_neighbor(q)
+        t_point = (time.perf_counter() - start) * args.queries / len(sample)
+
+        t_batch, (d_batch, i_batch) = best_of(lambda: index.query(queries),
+                                              args.repeat)
+        t_join, (d_join, i_join) = best_of(
+            lambda: index.nearest_join(queries), args.repeat)
+        query_tree = kd.Tree(queries[:, 0], queries[:, 1],
+                             leaf_size=QUERY_LEAF_SIZE)
+        t_pre, _ = best_of(lambda: index.nearest_join(query_tree),
+                           args.repeat)
+
+        # all nearest neighbors, against the second of two nearest neighbors
+        t_all, (d_all, i_all) = best_of(index.all_nearest_neighbors,
+                                        args.repeat)
+        start = time.perf_counter()
+        d_two, _ = index.knn_batch(points, 2)
+        t_two = time.perf_counter() - start
+
+        d_true, _ = BruteForce(points).query(queries[:args.sample])
+        errors = int((d_join[:args.sample] != d_true).sum())
+        errors += int((i_join != i_batch).sum())
+        errors += int((d_all != d_two[:, 1]).sum())
+        print(f"{name:>16} {t_point:>14.2f} {t_batch:>10.2f} {t_join:>9.2f} "
+              f"{t_pre:>13.2f} {t_all:>11.2f} {t_two:>8.2f} {errors:>7}")
+        d, i, j = index.closest_pair()
+        print(f"{'':>16} closest pair: stations {i} and {j}, {1e3 * d:.1f} m")
+
+
+if __name__ == '__main__':
+    main()
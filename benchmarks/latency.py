@@ -0,0 +1,65 @@
+"""Per-query latency of the single-point searches of both trees. Builds and
+searches run under a low recursion limit, to check that no code path depends
+on Python recursion depth (use --sizes 10000000 for the 10^7 run)."""
+import argparse
+import sys
+import time
+import numpy as np
+
+import tree as kd
+import vptree as vpt
+from benchmarks.common import duplicate_points, uniform_points
+
+
+def latency(fn, queries: np.ndarray) -> float:
+    """Mean latency of fn over queries, in microseconds."""
+    start = time.perf_counter()
+    for q in queries:
+        fn(q)
+
+    return 1e6 * (time.perf_counter() - start) / queries.shape[0]
+
+
+def report(name: str, kind: str, build, queries: np.ndarray):
+    """Builds an index and prints its build time and search latencies. The
+    index is dropped on return, before the next one is built.
+    ----------------------------------------------------------------------------
+    Args:
+        name: dataset name
+        kind: index name
+        build: function returning the index
+        queries: (m, 2)-shape array of query points"""
+    start = time.perf_counter()
+    index = build()
+    t_build = time.perf_counter() - start
+    nn = latency(index.nearest_neighbor, queries)
+    knn = latency(lambda q: index.knn(q, 5), queries)
+    radius = latency(lambda q: index.query_radius(q, 0.1), queries)
+    print(f"{name:>20} {kind:>7} {t_build:>10.2f} {nn:>9.1f} {knn:>10.1f} "
+          f"{radius:>12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10**4, 10**5, 10**6])
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--recursion-limit', type=int, default=100)
+    parser.add_argument('--no-vptree', action='store_true',
+                        help='skip the vp-tree, whose build is slow at 10^7')
+    args = parser.parse_args()
+    sys.setrecursionlimit(args.recursion_limit)
+
+    print(f"{'dataset':>20} {'index':>7} {'build (s)':>10} {'nn (us)':>9} "
+          f"{'knn5 (us)':>10} {'radius (us)':>12}")
+    for n in args.sizes:
+        for name, points in ((f'uniform-{n}', uniform_points(n)),
+                             (f'duplicates-{n}', duplicate_points(n))):
+            queries = uniform_points(args.queries, seed=1)
+            report(name, '2d', lambda: kd.Tree(points[:, 0], points[:, 1]),
+                   queries)
+            if not args.no_vptree:
+                report(name, 'vp', lambda: vpt.VpTree(list(points)), queries)
+
+if __name__ == '__main__':
+    main()
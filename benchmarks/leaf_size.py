@@ -0,0 +1,78 @@
+"""Leaf block size sweep for both trees: build time, nearest neighbor and k
+nearest neighbors latency, points examined per query and batch throughput for
+each leaf_size, on the EcoBici stations and on larger uniform and clustered
+sets. leaf_size 1 stores one point per node. Answers are checked against brute
+force on a subset of the queries. The defaults tree.LEAF_SIZE and
+vptree.LEAF_SIZE were chosen from this sweep.
+
+    python -m benchmarks.leaf_size --sizes 100000 1000000"""
+import argparse
+import time
+import numpy as np
+
+import tree as kd
+import vptree as vpt
+from benchmarks.common import (BruteForce, best_of, clustered_points,
+                               ecobici_points, uniform_points)
+
+INDEXES = {
+    '2d': lambda p, leaf_size: kd.Tree(p[:, 0], p[:, 1], leaf_size=leaf_size),
+    'vp': lambda p, leaf_size: vpt.VpTree(p, leaf_size=leaf_size),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10**5])
+    parser.add_argument('--leaf-sizes', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--indexes', nargs='+', default=list(INDEXES),
+                        choices=list(INDEXES))
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--check', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=10**4)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    datasets = [('ecobici', ecobici_points())]
+    for n in args.sizes:
+        datasets += [(f'uniform-{n}', uniform_points(n)),
+                     (f'clustered-{n}', clustered_points(n))]
+
+    print(f"{'dataset':>17} {'index':>5} {'leaf':>5} {'build (s)':>10} "
+          f"{'nn (us)':>8} {'visits':>7} {'knn (us)':>9} {'batch q/s':>10} "
+          f"{'errors':>7}")
+    for name, points in datasets:
+        rng = np.random.default_rng(1)
+        lo, hi = points.min(axis=0), points.max(axis=0)
+        queries = rng.uniform(lo, hi, size=(args.queries, 2)).tolist()
+        batch = rng.uniform(lo, hi, size=(args.batch, 2))
+        d_true, _ = BruteForce(points).query(batch[:args.check])
+        for index_name in args.indexes:
+            build = INDEXES[index_name]
+            for leaf_size in args.leaf_sizes:
+                t_build, index = best_of(lambda: build(points, leaf_size),
+                                         args.repeat)
+                visits = 0
+                start = time.perf_counter()
+                for q in queries:
+                    index.nearest_neighbor(q)
+                    visits += index.visits
+                t_nn = (time.perf_counter() - start) / len(queries)
+                start = time.perf_counter()
+                for q in queries:
+                    index.knn(q, args.k)
+                t_knn = (time.perf_counter() - start) / len(queries)
+                t_batch, (d, _) = best_of(lambda: index.query(batch),
+                                          args.repeat)
+                errors = int((d[:args.check] != d_true).sum())
+                print(f"{name:>17} {index_name:>5} {leaf_size:>5} "
+                      f"{t_build:>10.3f} {1e6 * t_nn:>8.1f} "
+                      f"{visits / len(queries):>7.1f} {1e6 * t_knn:>9.1f} "
+                      f"{args.batch / t_batch:>10.0f} {errors:>7}")
+
+
+if __name__ == '__main__':
+    main()
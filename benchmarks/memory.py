@@ -0,0 +1,75 @@
+"""2d-tree memory benchmark: flat node arrays against one TreeNode object per
+node, materialized from the tree's views. Trees are built with leaf_size=1,
+one point per node, as leaf blocks hold points that are not nodes. The
+script exits with status 1 if the copy does not hold every point."""
+import argparse
+import sys
+import tracemalloc
+from typing import Tuple
+
+import tree as kd
+from benchmarks.common import uniform_points
+
+
+def materialize(view: kd.TreeNode) -> Tuple[kd.TreeNode, int]:
+    """Copies a subtree of node views into plain linked TreeNode objects.
+    ----------------------------------------------------------------------------
+    Args:
+        view: root of the subtree to copy
+    Returns:
+        node: root of the copied subtree
+        count: number of copied nodes"""
+    root = kd.TreeNode(view.x, view.y, view.split_x)
+    stack = [(view, root)]
+    count = 0
+    while stack:
+        src, dst = stack.pop()
+        count += 1
+        dst.xmin, dst.xmax, dst.ymin, dst.ymax = src.bounds
+        for side in ('left', 'right'):
+            child = getattr(src, side)
+            if child is not None:
+                node = kd.TreeNode(child.x, child.y, child.split_x)
+                setattr(dst, side, node)
+                stack.append((child, node))
+
+    return root, count
+
+
+def traced(fn) -> int:
+    """Bytes still allocated by fn's result when it returns."""
+    tracemalloc.start()
+    result = fn()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10**3, 10**4, 10**5])
+    args = parser.parse_args()
+
+    print(f"{'n':>10} {'arrays (MB)':>12} {'objects (MB)':>13} {'ratio':>7}")
+    failed = False
+    for n in args.sizes:
+        points = uniform_points(n)
+        build = lambda: kd.Tree(points[:, 0], points[:, 1], leaf_size=1)
+        tree = build()
+        flat = traced(build)
+        linked = traced(lambda: materialize(tree.root))
+        print(f"{n:>10} {flat / 1e6:>12.2f} {linked / 1e6:>13.2f} "
+              f"{linked / flat:>7.1f}")
+        count = materialize(tree.root)[1]
+        if count != len(tree):
+            print(f"copied {count} nodes of {len(tree)} points")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
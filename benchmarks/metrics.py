@@ -0,0 +1,113 @@
+"""Cost of the euclidean and haversine metrics. Times the distance kernels per
+call (scalar, vectorized per element with and without an output buffer, and
+rectangle lower bounds), then builds both trees over the same stations with
+projected euclidean coords and with raw lon/lat under haversine, and compares
+their nearest neighbor latency and answers. --span scatters synthetic stations
+over a wider area, e.g. --span 4 for a metro area of a few hundred km, where
+the flat projection starts returning the wrong nearest station."""
+import argparse
+import time
+import numpy as np
+
+import tree as kd
+import vptree as vpt
+from ingest import LocalProjection, load_lonlat
+from metrics import METRICS
+
+
+def per_call(fn, args: list, repeat: int = 5) -> float:
+    """Best mean time of fn over a list of argument tuples, in nanoseconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for a in args:
+            fn(*a)
+        best = min(best, time.perf_counter() - start)
+
+    return 1e9 * best / len(args)
+
+
+def per_element(fn, repeat: int = 5) -> float:
+    """Best time of a vectorized call, returned as is, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=10**5)
+    parser.add_argument('--size', type=int, default=10**6,
+                        help='vectorized kernel length')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--span', type=float, default=0.0,
+                        help='degrees of synthetic stations, 0 for EcoBici')
+    parser.add_argument('--stations', type=int, default=10**4)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    # kernel costs over points around Mexico City
+    lon = rng.uniform(-99.3, -99.0, size=args.size)
+    lat = rng.uniform(19.2, 19.6, size=args.size)
+    out = np.empty(args.size)
+    pairs = list(zip(lon[:args.calls].tolist(), lat[:args.calls].tolist()))
+    rects = [(x - 0.2, x - 0.1, y - 0.05, y + 0.05) for x, y in pairs]
+    print(f"{'metric':>10} {'dist (ns)':>10} {'dists (ns/el)':>14} "
+          f"{'dists out (ns/el)':>18} {'rect (ns)':>10} "
+          f"{'rects (ns/el)':>14}")
+    for name, metric in METRICS.items():
+        t_dist = per_call(metric.dist, [(x, y, -99.1, 19.4) for x, y in pairs])
+        t_dists = per_element(lambda: metric.dists(lon, lat, -99.1, 19.4))
+        t_out = per_element(lambda: metric.dists(lon, lat, -99.1, 19.4, out))
+        t_rect = per_call(metric.rect_dist,
+                          [(x, y, r) for (x, y), r in zip(pairs, rects)])
+        t_rects = per_element(lambda: metric.rect_dists(
+            lon, lat, lon - 0.2, lon - 0.1, lat - 0.05, lat + 0.05))
+        print(f"{name:>10} {t_dist:>10.0f} {1e9 * t_dists / args.size:>14.2f} "
+              f"{1e9 * t_out / args.size:>18.2f} {t_rect:>10.0f} "
+              f"{1e9 * t_rects / args.size:>14.2f}")
+
+    if args.span > 0:
+        lon = rng.uniform(-99.1 - args.span / 2, -99.1 + args.span / 2,
+                          size=args.stations)
+        lat = rng.uniform(19.4 - args.span / 2, 19.4 + args.span / 2,
+                          size=args.stations)
+    else:
+        lon, lat = load_lonlat('data/station_information.json')
+    projection = LocalProjection.fit(lon, lat)
+    xs, ys = projection.forward(lon, lat)
+    q_lon = rng.uniform(lon.min(), lon.max(), size=args.queries)
+    q_lat = rng.uniform(lat.min(), lat.max(), size=args.queries)
+    q_xy = np.column_stack(projection.forward(q_lon, q_lat))
+    q_ll = np.column_stack((q_lon, q_lat))
+
+    print(f"\n{'index':>8} {'metric':>10} {'nn (us)':>8} {'batch q/s':>10} "
+          f"{'wrong nn':>9}")
+    for index_name, build in (
+            ('2d-tree', lambda x, y, m: kd.Tree(x, y, metric=m)),
+            ('vp-tree', lambda x, y, m: vpt.VpTree(np.column_stack((x, y)),
+                                                   metric=m))):
+        exact = build(lon, lat, 'haversine')
+        _, truth = exact.query(q_ll)
+        for metric, index, queries in (
+                ('euclidean', build(xs, ys, 'euclidean'), q_xy),
+                ('haversine', exact, q_ll)):
+            start = time.perf_counter()
+            for q in queries.tolist():
+                index.knn(q, 1)
+            t_nn = (time.perf_counter() - start) / args.queries
+            start = time.perf_counter()
+            _, nn = index.query(queries)
+            t_batch = time.perf_counter() - start
+            # nearest stations differing from the great circle ones
+            wrong = int((nn != truth).sum())
+            print(f"{index_name:>8} {metric:>10} {1e6 * t_nn:>8.1f} "
+                  f"{args.queries / t_batch:>10.0f} {wrong:>9}")
+
+
+if __name__ == '__main__':
+    main()
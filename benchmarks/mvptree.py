@@ -0,0 +1,84 @@
+"""Fan-out sweep of the m-ary vp-tree: for each m, build time, nodes visited
+(distance computations) and latency of nearest neighbor, k nearest neighbors
+and radius searches, on the EcoBici stations and on synthetic sets. The binary
+VpTree is listed first as a reference. Answers are checked against brute
+force on a subset of the queries.
+
+    python -m benchmarks.mvptree --sizes 100000 1000000 --m 2 4 8 16 32"""
+import argparse
+import time
+import numpy as np
+
+import vptree as vpt
+from benchmarks.common import (BruteForce, clustered_points, ecobici_points,
+                               uniform_points)
+from mvptree import MVpTree
+
+
+def timed(fn, queries: np.ndarray, index) -> tuple:
+    """Mean latency in microseconds and mean visits of fn over queries."""
+    visits = 0
+    start = time.perf_counter()
+    for q in queries:
+        fn(q)
+        visits += index.visits
+
+    n = queries.shape[0]
+    return 1e6 * (time.perf_counter() - start) / n, visits / n
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10**4, 10**5])
+    parser.add_argument('--m', type=int, nargs='+',
+                        default=[2, 3, 4, 8, 16, 32, 64])
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--check', type=int, default=100)
+    parser.add_argument('--k', type=int, default=5)
+    args = parser.parse_args()
+
+    datasets = [('ecobici', ecobici_points())]
+    for n in args.sizes:
+        datasets += [(f'uniform-{n}', uniform_points(n)),
+                     (f'clustered-{n}', clustered_points(n))]
+
+    print(f"{'dataset':>16} {'index':>7} {'build (s)':>10} {'nn visits':>10} "
+          f"{'nn (us)':>8} {'knn visits':>11} {'knn (us)':>9} "
+          f"{'radius (us)':>12} {'errors':>7}")
+    for name, points in datasets:
+        rng = np.random.default_rng(1)
+        queries = rng.uniform(points.min(axis=0), points.max(axis=0),
+                              size=(args.queries, 2))
+        brute = BruteForce(points)
+        d_true, _ = brute.query(queries[:args.check])
+        r = 2.0 * float(np.median(d_true))
+
+        builds = [('vp', lambda: vpt.VpTree(points))]
+        builds += [(f'm={m}', lambda m=m: MVpTree(points, m=m))
+                   for m in args.m]
+        for label, build in builds:
+            np.random.seed(0)
+            start = time.perf_counter()
+            index = build()
+            t_build = time.perf_counter() - start
+
+            nearest = (lambda q: index.nearest_neighbor(q)[1]) \
+                if label == 'vp' else \
+                (lambda q: index.nearest_neighbor(q)[0])
+            t_nn, v_nn = timed(nearest, queries, index)
+            t_knn, v_knn = timed(lambda q: index.knn(q, args.k), queries,
+                                 index)
+            t_radius, _ = timed(lambda q: index.query_radius(q, r), queries,
+                                index)
+
+            d, _ = index.query(queries[:args.check])
+            errors = int((~np.isclose(d, d_true, rtol=1e-12, atol=0.0)).sum())
+            print(f"{name:>16} {label:>7} {t_build:>10.3f} {v_nn:>10.1f} "
+                  f"{t_nn:>8.1f} {v_knn:>11.1f} {t_knn:>9.1f} "
+                  f"{t_radius:>12.1f} {errors:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Parallel batch nearest neighbor benchmark: throughput of QueryPool over the
+EcoBici stations for 1, 2, 4 and 8 worker processes, with synthetic queries
+spread over the stations' bounding box. One worker runs in-process."""
+import argparse
+import numpy as np
+
+import tree as kd
+import vptree as vpt
+from benchmarks.common import best_of, ecobici_points
+from parallel import QueryPool
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--queries', type=int, default=10**6)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-vptree', action='store_true',
+                        help='skip the vp-tree, whose batch query is a loop')
+    args = parser.parse_args()
+
+    points = ecobici_points()
+    lo, hi = points.min(axis=0), points.max(axis=0)
+    queries = np.random.default_rng(1).uniform(lo, hi, size=(args.queries, 2))
+    indexes = [('2d-tree', kd.Tree(points[:, 0], points[:, 1]))]
+    if not args.no_vptree:
+        indexes.append(('vp-tree', vpt.VpTree(points)))
+
+    print(f"{'index':>8} {'workers':>8} {'startup (s)':>12} {'q/s':>12} "
+          f"{'speedup':>8}")
+    for name, index in indexes:
+        base_qps, expected = None, None
+        for workers in args.workers:
+            if workers == 1:
+                startup = 0.0
+                t, (_, found) = best_of(lambda: index.query(queries),
+                                        args.repeat)
+            else:
+                startup, pool = best_of(lambda: QueryPool(index, workers), 1)
+                with pool:
+                    t, (_, found) = best_of(lambda: pool.query(queries),
+                                            args.repeat)
+            # every worker count must give the same answers
+            if expected is None:
+                expected = found
+            assert (found == expected).all()
+            qps = args.queries / t
+            base_qps = base_qps or qps
+            print(f"{name:>8} {workers:>8} {startup:>12.3f} {qps:>12.0f} "
+                  f"{qps / base_qps:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""2d-tree nearest neighbor benchmark: vectorized batch Tree.query against a
+Python loop over Tree.nearest_neighbor."""
+import argparse
+import numpy as np
+
+import tree as kd
+from benchmarks.common import best_of, ecobici_points, uniform_points
+
+
+def loop_query(tree: kd.Tree, queries: np.ndarray) -> np.ndarray:
+    """Answers queries one at a time, as ecobici.py used to."""
+    return np.array([tree.nearest_neighbor(q, tree.root)[0] for q in queries])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--queries', type=int, nargs='+',
+                        default=[10**3, 10**4, 10**5])
+    parser.add_argument('--points', type=int, nargs='+',
+                        default=[10**4, 10**5])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    datasets = [('ecobici', ecobici_points())]
+    datasets += [(f'uniform-{n}', uniform_points(n)) for n in args.points]
+    print(f"{'dataset':>15} {'m':>8} {'loop (q/s)':>12} {'batch (q/s)':>12} "
+          f"{'speedup':>8}")
+    for name, points in datasets:
+        tree = kd.Tree(points[:, 0], points[:, 1])
+        lo, hi = points.min(axis=0), points.max(axis=0)
+        for m in args.queries:
+            queries = np.random.default_rng(1).uniform(lo, hi, size=(m, 2))
+            # the per-point loop is slow, time it on a subset
+            sub = queries[:min(m, 10**4)]
+            t_loop, d_loop = best_of(lambda: loop_query(tree, sub), 1)
+            t_batch, (d_batch, _) = best_of(lambda: tree.query(queries),
+                                            args.repeat)
+            assert np.allclose(d_loop, d_batch[:sub.shape[0]])
+            loop_qps = sub.shape[0] / t_loop
+            batch_qps = m / t_batch
+            print(f"{name:>15} {m:>8} {loop_qps:>12.0f} {batch_qps:>12.0f} "
+                  f"{batch_qps / loop_qps:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
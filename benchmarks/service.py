@@ -0,0 +1,116 @@
+"""Open-loop load generator for async nearest neighbor serving. Requests
+arrive at a fixed mean rate (exponential gaps) over the EcoBici stations or
+a synthetic set, and each is answered by one of:
+    inline   a blocking nearest_neighbor call inside the coroutine
+    thread   a nearest_neighbor call on the default thread pool
+    batched  service.AsyncIndex micro-batches, for each --batches setting
+Latency runs from a request's scheduled arrival to its answer, so requests
+delayed by a busy event loop count as slow. Reports throughput and p50/p99
+latency per arrival rate.
+
+    python -m benchmarks.service --rates 5000 20000 50000 --batches 64:100"""
+import argparse
+import asyncio
+import time
+import numpy as np
+
+import tree as kd
+import vptree as vpt
+from benchmarks.common import ecobici_points, uniform_points
+from service import AsyncIndex
+
+INDEXES = {
+    '2d': lambda p: kd.Tree(p[:, 0], p[:, 1]),
+    'vp': lambda p: vpt.VpTree(p),
+}
+
+
+async def run_load(call, queries: list, rate: float, duration: float,
+                   seed: int = 0) -> tuple:
+    """Sends requests at the given mean rate and times them.
+    ----------------------------------------------------------------------------
+    Args:
+        call: coroutine function answering one query
+        queries: list of query coords, cycled through
+        rate: mean arrivals per second
+        duration: seconds of arrivals
+        seed: random generator seed
+    Returns:
+        qps: answered requests per second, until the last answer
+        latency: array of per-request latencies in seconds"""
+    rng = np.random.default_rng(seed)
+    n = max(int(rate * duration), 1)
+    arrivals = np.cumsum(rng.exponential(1.0 / rate, size=n)).tolist()
+    latency = np.empty(n)
+
+    async def request(j: int, arrival: float):
+        await call(queries[j % len(queries)])
+        latency[j] = time.perf_counter() - arrival
+
+    start = time.perf_counter()
+    tasks, j = [], 0
+    while j < n:
+        now = time.perf_counter() - start
+        # start every request due by now, the loop may be late
+        while j < n and arrivals[j] <= now:
+            tasks.append(asyncio.ensure_future(
+                request(j, start + arrivals[j])))
+            j += 1
+        await asyncio.sleep(arrivals[j] - now if j < n else 0)
+    await asyncio.gather(*tasks)
+
+    return n / (time.perf_counter() - start), latency
+
+
+async def run(args, index, queries: list):
+    loop = asyncio.get_running_loop()
+
+    async def inline(q):
+        return index.nearest_neighbor(q)
+
+    async def thread(q):
+        return await loop.run_in_executor(None, index.nearest_neighbor, q)
+
+    print(f"{'mode':>16} {'rate':>7} {'qps':>7} {'p50 (us)':>9} "
+          f"{'p99 (us)':>9} {'mean batch':>11}")
+    for rate in args.rates:
+        modes = [('inline', inline, None), ('thread', thread, None)]
+        for setting in args.batches:
+            max_batch, max_wait = setting.split(':')
+            server = AsyncIndex(index, int(max_batch), float(max_wait))
+            modes.append((f'batched {setting}', server.nearest_neighbor,
+                          server))
+        for name, call, server in modes:
+            qps, latency = await run_load(call, queries, rate, args.duration)
+            p50, p99 = 1e6 * np.percentile(latency, [50, 99])
+            batch = ''
+            if server is not None:
+                batch = f"{server.stats['mean_batch']:.1f}"
+                await server.close()
+            print(f"{name:>16} {rate:>7.0f} {qps:>7.0f} {p50:>9.0f} "
+                  f"{p99:>9.0f} {batch:>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--index', default='2d', choices=list(INDEXES))
+    parser.add_argument('--size', type=int, default=0,
+                        help='uniform synthetic stations, 0 for EcoBici')
+    parser.add_argument('--rates', type=float, nargs='+',
+                        default=[2000, 10000, 40000])
+    parser.add_argument('--batches', nargs='+', default=['64:100', '256:500'],
+                        help='max_batch:max_wait_us settings')
+    parser.add_argument('--duration', type=float, default=2.0)
+    args = parser.parse_args()
+
+    points = uniform_points(args.size) if args.size else ecobici_points()
+    index = INDEXES[args.index](points)
+    rng = np.random.default_rng(1)
+    queries = rng.uniform(points.min(axis=0), points.max(axis=0),
+                          size=(10**4, 2)).tolist()
+    asyncio.run(run(args, index, queries))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Import time and cold start budget of query-only use of ecobici.py. Each
+command runs in a fresh interpreter, after a warm-up run that writes the
+bytecode and index caches, and the median wall-clock time is reported:
+    python          an empty interpreter
+    import numpy    the floor of any query
+    import ecobici  the library, without plotting or dataframe packages
+    query           `python ecobici.py query` on the cached 2d-tree
+The script exits with status 1 if importing ecobici costs more than the
+import budget over importing NumPy, if the query command costs more than the
+query budget over importing NumPy, or if the import loads any of the heavy
+packages below.
+
+    python -m benchmarks.startup --repeat 20 --import-budget 30"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+
+# packages query-only use must not import
+HEAVY = ['matplotlib', 'pandas', 'geopandas', 'multiprocessing', 'scipy']
+COMMANDS = {
+    'python': ['-c', 'pass'],
+    'import numpy': ['-c', 'import numpy'],
+    'import ecobici': ['-c', 'import ecobici'],
+    'query': ['ecobici.py', 'query', '-99.17', '19.42'],
+}
+
+
+def run_time(args: list, env: dict, repeat: int) -> float:
+    """Median wall-clock time of a python command in fresh interpreters.
+    ----------------------------------------------------------------------------
+    Args:
+        args: arguments of the python executable
+        env: environment of the child processes
+        repeat: number of runs
+    Returns:
+        seconds: median run time"""
+    times = []
+    for _ in range(repeat + 1): # the first run warms the caches
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+
+    return float(np.median(times[1:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--import-budget', type=float, default=30.0,
+                        help='ms of importing ecobici over importing NumPy')
+    parser.add_argument('--query-budget', type=float, default=60.0,
+                        help='ms of a query command over importing NumPy')
+    args = parser.parse_args()
+
+    # cold starts should read cached bytecode, as installed code does
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    times = {name: 1e3 * run_time(command, env, args.repeat)
+             for name, command in COMMANDS.items()}
+    for name, t in times.items():
+        print(f"{name:>16} {t:>8.1f} ms")
+
+    check = ('import ecobici, sys; print(" ".join(m for m in %r '
+             'if m in sys.modules))' % HEAVY)
+    loaded = subprocess.run([sys.executable, '-c', check], env=env,
+                            check=True, capture_output=True,
+                            text=True).stdout.split()
+    overheads = {'import ecobici': args.import_budget,
+                 'query': args.query_budget}
+    failed = bool(loaded)
+    if loaded:
+        print(f"import ecobici loads {', '.join(loaded)}")
+    for name, budget in overheads.items():
+        extra = times[name] - times['import numpy']
+        over = extra > budget
+        failed |= over
+        print(f"{name:>16} {extra:>8.1f} ms over NumPy, budget {budget:.0f} "
+              f"ms{' EXCEEDED' if over else ''}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
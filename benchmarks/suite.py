@@ -0,0 +1,206 @@
+"""Benchmark and correctness suite for the 2d-tree, the binary and 4-ary
+vp-trees, the uniform grid and a NumPy brute-force baseline. For each dataset
+and size it measures build time, peak memory during the build, single nearest
+neighbor latency percentiles and nodes (or points) visited per query, and
+batch query throughput. Every index is checked against brute force on a
+subset of the queries (nearest neighbor, k nearest neighbors and radius
+searches), and the script exits with status 1 on any mismatch.
+
+    python -m benchmarks.suite --sizes 10000 100000 --json out/bench.json"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from typing import Callable, Dict, Tuple
+
+import tree as kd
+import vptree as vpt
+from grid import GridIndex
+from mvptree import MVpTree
+from benchmarks.common import (BruteForce, best_of, clustered_points,
+                               duplicate_points, ecobici_points,
+                               line_points, uniform_points)
+
+DATASETS = {
+    'ecobici': lambda n, seed: ecobici_points(), # fixed size
+    'uniform': uniform_points,
+    'clustered': clustered_points,
+    'duplicates': duplicate_points,
+    'line': line_points,
+}
+
+
+def tree_nearest(index: kd.Tree, q: np.ndarray) -> Tuple[float, int]:
+    """Single nearest neighbor (dist, index) of a 2d-tree."""
+    d, node = index.nearest_neighbor(q)
+    return d, node.index
+
+
+def vptree_nearest(index: vpt.VpTree, q: np.ndarray) -> Tuple[float, int]:
+    """Single nearest neighbor (dist, index) of a vp-tree."""
+    node, d = index.nearest_neighbor(q)
+    return d, node.index
+
+
+def brute_nearest(index: BruteForce, q: np.ndarray) -> Tuple[float, int]:
+    """Nearest neighbor (dist, index) of a single query by brute force."""
+    d, i = index.query(q)
+    return d.item(0), i.item(0)
+
+
+# build from an (n, 2) array, and single nearest neighbor (dist, index) of a
+# query
+INDEXES = {
+    '2d': (lambda p: kd.Tree(p[:, 0], p[:, 1]), tree_nearest),
+    'vp': (lambda p: vpt.VpTree(p), vptree_nearest),
+    'mvp': (lambda p: MVpTree(p, m=4),
+            lambda index, q: index.nearest_neighbor(q)),
+    'grid': (GridIndex, lambda index, q: index.nearest_neighbor(q)),
+    'brute': (BruteForce, brute_nearest),
+}
+
+
+def peak_memory(fn: Callable) -> int:
+    """Peak bytes allocated while running fn."""
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+
+    return peak
+
+
+def check(index, nearest: Callable, brute: BruteForce, queries: np.ndarray,
+          k: int, r: float) -> Dict[str, int]:
+    """Counts the queries where an index disagrees with brute force. Ties
+    must go to the lowest index, in batch and single-point searches alike.
+    ----------------------------------------------------------------------------
+    Args:
+        index: index under test
+        nearest: single nearest neighbor search, see INDEXES
+        brute: brute-force baseline over the same points
+        queries: (m, 2)-shape array of query coords
+        k: number of neighbors for k nearest neighbors search
+        r: radius for radius search
+    Returns:
+        mismatches: number of wrong answers by search type"""
+    d_nn, i_nn = brute.query(queries)
+    d, i = index.query(queries)
+    # distance formulas differ between indexes in the last bits
+    wrong = ~np.isclose(d, d_nn, rtol=1e-12, atol=0.0) | (i != i_nn)
+    mismatches = {'nn': int(wrong.sum()), 'knn': 0, 'radius': 0}
+    for j, q in enumerate(queries):
+        d, i = nearest(index, q)
+        if not np.isclose(d, d_nn[j], rtol=1e-12, atol=0.0) or i != i_nn[j]:
+            mismatches['nn'] += 1
+        d, i = index.knn(q, k)
+        d_true, i_true = brute.knn(q, k)
+        if not (np.allclose(d, d_true) and np.array_equal(i, i_true)):
+            mismatches['knn'] += 1
+        d, i = index.query_radius(q, r)
+        d_true, i_true = brute.query_radius(q, r)
+        if not np.array_equal(np.sort(i), np.sort(i_true)):
+            mismatches['radius'] += 1
+
+    return mismatches
+
+
+def run(name: str, points: np.ndarray, args) -> list:
+    """Benchmarks every index on one dataset, returns one record per index."""
+    n = points.shape[0]
+    rng = np.random.default_rng(args.seed)
+    lo, hi = points.min(axis=0), points.max(axis=0)
+    queries = rng.uniform(lo, hi, size=(args.queries, 2))
+    batch = rng.uniform(lo, hi, size=(args.batch, 2))
+    brute = BruteForce(points)
+    # radius holding a few points on average around the check queries
+    r = 2.0 * float(np.median(brute.query(queries[:args.check])[0]))
+
+    records = []
+    for index_name in args.indexes:
+        build, nearest = INDEXES[index_name]
+        t_build, index = best_of(lambda: build(points), args.repeat)
+        peak = peak_memory(lambda: build(points))
+
+        latency, visits = np.empty(args.queries), np.empty(args.queries)
+        for j, q in enumerate(queries):
+            start = time.perf_counter()
+            nearest(index, q)
+            latency[j] = time.perf_counter() - start
+            visits[j] = index.visits
+        p50, p90, p99 = np.percentile(1e6 * latency, [50, 90, 99])
+
+        # exhaustive search is quadratic, time it on fewer queries
+        m = args.batch if index_name != 'brute' else \
+            min(args.batch, max(1, 10**8 // max(n, 1)))
+        t_batch, _ = best_of(lambda: index.query(batch[:m]), args.repeat)
+        mismatches = check(index, nearest, brute, queries[:args.check],
+                           args.k, r)
+
+        records.append({
+            'dataset': name, 'n': n, 'index': index_name,
+            'build_s': t_build, 'build_peak_bytes': peak,
+            'nn_latency_us': {'mean': 1e6 * float(latency.mean()),
+                              'p50': p50, 'p90': p90, 'p99': p99},
+            'nn_visits_mean': float(visits.mean()),
+            'batch_qps': m / t_batch,
+            'mismatches': mismatches,
+        })
+        print(f"{name:>11} {n:>8} {index_name:>6} {t_build:>9.3f} "
+              f"{peak / 2**20:>9.1f} {p50:>8.1f} {p99:>8.1f} "
+              f"{visits.mean():>8.1f} {m / t_batch:>10.0f} "
+              f"{sum(mismatches.values()):>6}")
+
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--datasets', nargs='+', default=list(DATASETS),
+                        choices=list(DATASETS))
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10**3, 10**4, 10**5],
+                        help='sizes of the synthetic datasets')
+    parser.add_argument('--indexes', nargs='+', default=list(INDEXES),
+                        choices=list(INDEXES))
+    parser.add_argument('--queries', type=int, default=1000,
+                        help='single queries timed for latency')
+    parser.add_argument('--batch', type=int, default=10**4,
+                        help='queries per batch for throughput')
+    parser.add_argument('--check', type=int, default=200,
+                        help='queries checked against brute force')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    print(f"{'dataset':>11} {'n':>8} {'index':>6} {'build (s)':>9} "
+          f"{'peak (MB)':>9} {'p50 (us)':>8} {'p99 (us)':>8} {'visits':>8} "
+          f"{'batch q/s':>10} {'errors':>6}")
+    records = []
+    for name in args.datasets:
+        sizes = [None] if name == 'ecobici' else args.sizes
+        for n in sizes:
+            records += run(name, DATASETS[name](n, args.seed), args)
+
+    if args.json:
+        meta = {'python': platform.python_version(),
+                'numpy': np.__version__, 'platform': platform.platform(),
+                'args': vars(args)}
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': records}, f, indent=2)
+
+    errors = sum(sum(rec['mismatches'].values()) for rec in records)
+    if errors:
+        print(f"{errors} results differ from brute force", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
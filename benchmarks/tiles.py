@@ -0,0 +1,212 @@
+"""Out-of-core tiled index: builds a TiledIndex from a raw binary file of
+uniform or clustered points, written chunk by chunk so the points are never
+all in memory, and reports build time and index size. With --memory, it also
+reports the peak traced memory of a second build and of an in-memory Tree
+over the same points read whole from the file, and exits with status 1 if
+the tiled build does not stay below the in-memory one (use sizes well above
+the chunk and tile sizes, like the default 4·10^6). Then runs nearest
+neighbor queries, uniform over the box ('random') or along a random walk of
+50 m steps ('walk', like a GPS trace), with several tile cache sizes. Tile
+files are dropped from the OS page cache before each run, and per query it
+reports tiles searched, tiles opened, kB of tile files mapped, major page
+faults, kB read from storage (when /proc/self/io reports it) and latency
+percentiles. Answers are checked against a streamed brute force on a sample
+of queries.
+
+    python -m benchmarks.tiles --sizes 10000000 --tile-size 262144"""
+import argparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+import tree as kd
+from metrics import Euclidean
+from tiles import TiledIndex, iter_array_chunks
+
+CHUNK = 1 << 20 # points per generated and streamed chunk
+
+
+def write_points(path: str, n: int, kind: str, seed: int = 0):
+    """Writes n uniform or clustered points to a raw float64 file, one chunk
+    at a time, over the box of benchmarks.common.
+    ----------------------------------------------------------------------------
+    Args:
+        path: output file path
+        n: number of points
+        kind: 'uniform' or 'clustered'
+        seed: random generator seed"""
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(low=-9.0, high=9.0, size=(20, 2))
+    spread = rng.uniform(low=0.1, high=0.5, size=20)
+    with open(path, 'wb') as f:
+        for start in range(0, n, CHUNK):
+            m = min(CHUNK, n - start)
+            if kind == 'uniform':
+                chunk = rng.uniform(low=-10.0, high=10.0, size=(m, 2))
+            else:
+                blob = rng.integers(20, size=m)
+                chunk = centers[blob] + rng.normal(size=(m, 2)) * \
+                    spread[blob, None]
+            chunk.astype('<f8').tofile(f)
+
+
+def in_memory_tree(path: str) -> kd.Tree:
+    """2d-tree over a point file read whole into memory."""
+    points = np.fromfile(path, dtype='<f8').reshape(-1, 2)
+    return kd.Tree(points[:, 0], points[:, 1])
+
+
+def traced_peak(fn) -> float:
+    """Peak traced memory while running fn, in MB."""
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    del result
+
+    return peak
+
+
+def brute_force(path: str, queries: np.ndarray) -> tuple:
+    """Nearest neighbors of a few queries, streaming the point file."""
+    dists = np.full(queries.shape[0], np.inf)
+    indices = np.full(queries.shape[0], -1, dtype=np.int64)
+    offset = 0
+    for xs, ys in iter_array_chunks(path, CHUNK):
+        for j, (xq, yq) in enumerate(queries):
+            d = Euclidean.dists(xs, ys, xq, yq)
+            i = int(d.argmin())
+            if d[i] < dists[j]: # earlier chunks win ties
+                dists[j], indices[j] = d[i], offset + i
+        offset += xs.shape[0]
+
+    return dists, indices
+
+
+def drop_page_cache(directory: str):
+    """Asks the OS to drop the cached pages of every file in a directory."""
+    for name in os.listdir(directory):
+        fd = os.open(os.path.join(directory, name), os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def read_bytes() -> int:
+    """Bytes this process read from storage, 0 if not reported."""
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f)
+        return int(fields['read_bytes'])
+    except (OSError, KeyError):
+        return 0
+
+
+def workload(kind: str, m: int, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    if kind == 'random':
+        return rng.uniform(low=-10.0, high=10.0, size=(m, 2))
+    steps = rng.normal(scale=0.05, size=(m, 2))
+    return np.clip(np.cumsum(steps, axis=0), -10.0, 10.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4 * 10**6])
+    parser.add_argument('--tile-size', type=int, default=1 << 18)
+    parser.add_argument('--caches', type=int, nargs='+', default=[1, 8, 64])
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--check', type=int, default=100,
+                        help='queries checked against brute force')
+    parser.add_argument('--memory', action='store_true',
+                        help='trace the peak memory of a second build and '
+                        'of an in-memory Tree')
+    parser.add_argument('--dir', default=None,
+                        help='working directory, a temporary one if unset')
+    args = parser.parse_args()
+
+    root = args.dir or tempfile.mkdtemp(prefix='tiles-')
+    page = resource.getpagesize()
+    print(f"{'dataset':>18} {'tiles':>6} {'build (s)':>10} {'peak (MB)':>10} "
+          f"{'tree (MB)':>10} {'size (MB)':>10} {'errors':>7}")
+    runs = []
+    failed = False
+    for n in args.sizes:
+        for kind in ('uniform', 'clustered'):
+            name = f'{kind}-{n}'
+            path = os.path.join(root, f'{name}.bin')
+            directory = os.path.join(root, name)
+            write_points(path, n, kind)
+
+            build = lambda: TiledIndex.from_chunks(
+                lambda: iter_array_chunks(path, CHUNK), directory,
+                args.tile_size)
+            start = time.perf_counter()
+            index = build()
+            t_build = time.perf_counter() - start
+            peak = tree_peak = '-'
+            if args.memory: # tracing slows the build down, so it is redone
+                tiled = traced_peak(build)
+                in_memory = traced_peak(lambda: in_memory_tree(path))
+                failed |= tiled >= in_memory
+                peak, tree_peak = f'{tiled:.1f}', f'{in_memory:.1f}'
+            size = sum(os.path.getsize(os.path.join(directory, f))
+                       for f in os.listdir(directory))
+
+            queries = workload('random', args.check)
+            d_true, i_true = brute_force(path, queries)
+            d, i = index.query(queries)
+            errors = int((d != d_true).sum() + (i != i_true).sum())
+            for j, q in enumerate(queries.tolist()):
+                errors += index.nearest_neighbor(q) != (d_true[j], i_true[j])
+            print(f"{name:>18} {index.n_tiles:>6} {t_build:>10.1f} "
+                  f"{peak:>10} {tree_peak:>10} {size / 2**20:>10.1f} "
+                  f"{errors:>7}")
+            runs.append((name, path, directory))
+
+    print(f"\n{'dataset':>18} {'queries':>8} {'cache':>6} {'tiles/q':>8} "
+          f"{'opened/q':>9} {'mapped kB/q':>12} {'faults/q':>9} "
+          f"{'read kB/q':>10} {'p50 (us)':>9} {'p99 (us)':>9}")
+    for name, path, directory in runs:
+        for kind in ('random', 'walk'):
+            queries = workload(kind, args.queries).tolist()
+            for cache in args.caches:
+                drop_page_cache(directory)
+                index = TiledIndex(directory, cache_tiles=cache)
+                latency = np.empty(len(queries))
+                faults = resource.getrusage(resource.RUSAGE_SELF).ru_majflt
+                read = read_bytes()
+                for j, q in enumerate(queries):
+                    start = time.perf_counter()
+                    index.nearest_neighbor(q)
+                    latency[j] = time.perf_counter() - start
+                faults = resource.getrusage(
+                    resource.RUSAGE_SELF).ru_majflt - faults
+                read = read_bytes() - read
+                m = len(queries)
+                stats = index.stats
+                p50, p99 = 1e6 * np.percentile(latency, [50, 99])
+                print(f"{name:>18} {kind:>8} {cache:>6} "
+                      f"{stats['tile_searches'] / m:>8.2f} "
+                      f"{stats['tile_loads'] / m:>9.3f} "
+                      f"{stats['bytes_mapped'] / m / 1024:>12.1f} "
+                      f"{faults / m:>9.2f} {read / m / 1024:>10.1f} "
+                      f"{p50:>9.0f} {p99:>9.0f}")
+        os.remove(path)
+    print(f"\npage size {page} bytes")
+    if args.dir is None:
+        shutil.rmtree(root)
+    if failed:
+        print("the tiled build used as much memory as an in-memory Tree")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""2d-tree sustained mixed workload: rounds of station moves (a delete and an
+insert) interleaved with nearest neighbor queries. Update cost and query
+latency should stay flat across rounds instead of degrading as the tree
+changes. A full rebuild is timed for reference. Finally, a tree with slots
+freed by scapegoat rebuilds is saved, loaded and updated again, and checked
+against brute force; the script exits with status 1 on any mismatch."""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+import tree as kd
+from benchmarks.common import BruteForce, best_of, uniform_points
+
+
+def check_roundtrip(n: int = 2000, seed: int = 0) -> int:
+    """Saves and loads a tree holding free slots, then updates the loaded
+    tree and compares its answers with brute force.
+    ----------------------------------------------------------------------------
+    Args:
+        n: number of initial points
+        seed: random generator seed
+    Returns:
+        mismatches: wrong nearest neighbors, sizes or free slot lists"""
+    points = uniform_points(n, seed)
+    tree = kd.Tree(points[:, 0], points[:, 1])
+    live = dict(enumerate(map(tuple, points.tolist())))
+    # a chain of points, deleted, then a second chain over its tombstones:
+    # the scapegoat rebuilds drop the tombstones and free their slots
+    for j in range(200):
+        tree.insert(-5 + 0.001 * j, -5 + 0.001 * j, n + j)
+    for j in range(200):
+        tree.delete(n + j)
+    for j in range(200):
+        x, y = -5 + 0.001 * j + 0.0005, -5 + 0.001 * j
+        tree.insert(x, y, n + 200 + j)
+        live[n + 200 + j] = (x, y)
+
+    mismatches = 0
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tree.idx')
+        tree.save(path)
+        for mmap in (True, False):
+            loaded = kd.Tree.load(path, mmap=mmap)
+            mismatches += loaded._free != tree._free
+            points = dict(live)
+            for j, (x, y) in enumerate(rng.uniform(-10, 10, (100, 2))):
+                loaded.insert(x, y, n + 400 + j)
+                points[n + 400 + j] = (x, y)
+            for i in rng.choice(sorted(points), n // 2, replace=False):
+                loaded.delete(i)
+                del points[i]
+            ids = np.array(sorted(points))
+            queries = rng.uniform(-10, 10, (500, 2))
+            d_true, i_true = BruteForce(np.array(
+                [points[i] for i in ids])).query(queries)
+            d, i = loaded.query(queries)
+            mismatches += int((~np.isclose(d, d_true) |
+                               (i != ids[i_true])).sum())
+            mismatches += len(loaded) != len(points)
+
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=10**5)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--moves', type=int, default=10**4,
+                        help='moves per round')
+    parser.add_argument('--queries', type=int, default=1000,
+                        help='queries per round')
+    args = parser.parse_args()
+
+    points = uniform_points(args.points)
+    rng = np.random.default_rng(1)
+    t_build, tree = best_of(lambda: kd.Tree(points[:, 0], points[:, 1]), 1)
+    print(f"full build of {args.points} points: {t_build:.2f} s "
+          f"({1e6 * t_build / args.points:.1f} us/point)")
+
+    live = np.arange(args.points) # ids of the points in the tree
+    next_id = args.points
+    print(f"{'round':>6} {'move (us)':>10} {'nn p50 (us)':>12} "
+          f"{'nn p99 (us)':>12} {'slots':>9}")
+    for r in range(args.rounds):
+        # move random stations: delete them and insert them elsewhere
+        moved = rng.choice(live.shape[0], size=args.moves, replace=False)
+        new = uniform_points(args.moves, seed=r + 2)
+        start = time.perf_counter()
+        for j, (x, y) in zip(moved, new):
+            tree.delete(live[j])
+            tree.insert(x, y, next_id)
+            live[j] = next_id
+            next_id += 1
+        t_move = (time.perf_counter() - start) / args.moves
+
+        queries = uniform_points(args.queries, seed=10**6 + r)
+        lat = np.empty(args.queries)
+        for j, q in enumerate(queries):
+            start = time.perf_counter()
+            tree.nearest_neighbor(q)
+            lat[j] = time.perf_counter() - start
+        p50, p99 = np.percentile(1e6 * lat, [50, 99])
+        print(f"{r:>6} {1e6 * t_move:>10.1f} {p50:>12.1f} {p99:>12.1f} "
+              f"{tree._size:>9}")
+
+    mismatches = check_roundtrip()
+    print(f"save, load and update after rebuilds: {mismatches} mismatches")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
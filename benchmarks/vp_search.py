@@ -0,0 +1,58 @@
+"""VP-tree nearest neighbor validation: checks VpTree.nearest_neighbor against
+a NumPy brute force scan and reports the nodes visited per query, which should
+grow sub-linearly with the number of points."""
+import argparse
+import time
+import numpy as np
+
+import vptree as vpt
+from benchmarks.common import ecobici_points, uniform_points
+
+
+def brute_force(points: np.ndarray, query: np.ndarray) -> float:
+    """Distance from query to its nearest point, by a full scan."""
+    return np.sqrt(np.min(np.sum((points - query)**2, axis=1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10**3, 10**4, 10**5])
+    parser.add_argument('--queries', type=int, default=1000)
+    args = parser.parse_args()
+
+    datasets = [('ecobici', ecobici_points())]
+    datasets += [(f'uniform-{n}', uniform_points(n)) for n in args.sizes]
+    print(f"{'dataset':>16} {'n':>9} {'build (s)':>10} {'visits':>8} "
+          f"{'visits/n':>9} {'us/query':>9} {'errors':>7}")
+    sizes, visits = [], []
+    for name, points in datasets:
+        n = points.shape[0]
+        start = time.perf_counter()
+        tree = vpt.VpTree(list(points))
+        t_build = time.perf_counter() - start
+
+        lo, hi = points.min(axis=0), points.max(axis=0)
+        queries = np.random.default_rng(1).uniform(lo, hi,
+                                                   size=(args.queries, 2))
+        counts, errors, elapsed = [], 0, 0.0
+        for query in queries:
+            start = time.perf_counter()
+            _, tau = tree.nearest_neighbor(query)
+            elapsed += time.perf_counter() - start
+            counts.append(tree.visits)
+            errors += not np.isclose(tau, brute_force(points, query))
+        mean = np.mean(counts)
+        sizes.append(n)
+        visits.append(mean)
+        print(f"{name:>16} {n:>9} {t_build:>10.2f} {mean:>8.1f} "
+              f"{mean / n:>9.4f} {1e6 * elapsed / args.queries:>9.1f} "
+              f"{errors:>7}")
+
+    # growth exponent of visits with n, 1 for a linear scan
+    slope = np.polyfit(np.log(sizes), np.log(visits), 1)[0]
+    print(f"visits ~ n^{slope:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""Nearest neighbor result cache in front of a Tree or a VpTree.
+
+Without a cell size, answers are cached by exact query coords. With a cell
+size h, queries are snapped to a square grid and each cell caches a candidate
+set that provably holds the nearest neighbor of every point in the cell: if c
+is the cell's center and d_c the distance from c to its nearest neighbor, a
+query q in the cell is at most h / sqrt(2) from c, so its nearest neighbor is
+at most d_c + h / sqrt(2) from q and d_c + sqrt(2) h from c. A cell hit then
+costs a scan of the candidates instead of a tree traversal, and answers are
+exact. Entries are evicted least recently used first and dropped whenever the
+index's version changes."""
+import math
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from metrics import Euclidean
+
+# relative slack on the candidate radius, absorbs rounding in the distances
+TOL = 1e-9
+
+
+class QueryCache:
+    def __init__(
+            self,
+            index,
+            cell_size: float = None,
+            max_entries: int = 4096,
+            max_candidates: int = 64):
+        """Constructor method.
+        ------------------------------------------------------------------------
+        Args:
+            index: Tree or VpTree to answer misses
+            cell_size: side of the grid cells in the index's units, None to
+                cache exact queries only
+            max_entries: number of cached queries or cells
+            max_candidates: cells with more candidates are not cached, their
+                queries go straight to the index"""
+        metric = getattr(index, 'metric', None)
+        if cell_size is not None and metric is not None and \
+                metric.name != 'euclidean':
+            # candidate radii assume cells and distances in the same units
+            raise ValueError(f"grid cells need a euclidean index, got "
+                             f"{metric.name}")
+        self.index = index
+        self.cell_size = cell_size
+        self.max_entries = max_entries
+        self.max_candidates = max_candidates
+        self._entries = OrderedDict() # key: cached answer or candidate set
+        self._version = index.version
+        self.hits = self.misses = self.bypasses = 0
+        self.evictions = self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        """Drops every entry, the counters are kept."""
+        self._entries.clear()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Counters and hit rate since the cache was created.
+        ------------------------------------------------------------------------
+        """
+        lookups = self.hits + self.misses + self.bypasses
+        return {'hits': self.hits, 'misses': self.misses,
+                'bypasses': self.bypasses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'entries': len(self),
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def nearest_neighbor(self, query: List[float]) -> Tuple[float, int]:
+        """Finds the nearest neighbor of a query point, ties by lowest index.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords
+        Returns:
+            dist: distance from query to its nearest neighbor
+            index: nearest neighbor's index, -1 for an empty index"""
+        if self.index.version != self._version:
+            self._entries.clear()
+            self._version = self.index.version
+            self.invalidations += 1
+
+        xq, yq = float(query[0]), float(query[1])
+        if self.cell_size is None:
+            key = (xq, yq)
+        else:
+            key = (math.floor(xq / self.cell_size),
+                   math.floor(yq / self.cell_size))
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        else:
+            entry = self.__entry(key, xq, yq)
+            if entry is None: # cell not cached
+                self.bypasses += 1
+                return self.__nearest((xq, yq))
+            self.misses += 1
+            self._entries[key] = entry
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        if self.cell_size is None:
+            return entry
+        # scan the cell's candidates, sorted by index so ties go to the lowest
+        xs, ys, ids = entry
+        d = Euclidean.dists(xs, ys, xq, yq)
+        j = int(d.argmin())
+        return float(d[j]), int(ids[j])
+
+    def query(self, points: np.ndarray) -> Tuple[np.ndarray]:
+        """Batch nearest neighbor search through the cache, with the same
+        outputs as the index's query method.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+        Returns:
+            dists: (m,)-shape array of distances to the nearest neighbors
+            indices: (m,)-shape array of the nearest neighbors' indices"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        dists = np.empty(points.shape[0])
+        indices = np.empty(points.shape[0], dtype=np.int64)
+        for j, query in enumerate(points.tolist()):
+            dists[j], indices[j] = self.nearest_neighbor(query)
+
+        return dists, indices
+
+    def __nearest(self, query: Tuple[float]) -> Tuple[float, int]:
+        """Uncached nearest neighbor, ties by lowest index."""
+        dists, indices = self.index.knn(query, 1)
+        if indices.shape[0] == 0: # empty index
+            return math.inf, -1
+        return float(dists[0]), int(indices[0])
+
+    def __entry(self, key: Tuple, xq: float, yq: float):
+        """Computes the cache entry of a key: the answer itself for exact
+        queries, or the candidate set of a grid cell.
+        ------------------------------------------------------------------------
+        Args:
+            key: exact query or cell coords
+            xq, yq: query coords
+        Returns:
+            entry: (dist, index) answer, (xs, ys, ids) candidates sorted by
+                index, or None if the cell is not cached because it has more
+                than max_candidates or the index is empty"""
+        if self.cell_size is None:
+            return self.__nearest((xq, yq))
+
+        h = self.cell_size
+        center = ((key[0] + 0.5) * h, (key[1] + 0.5) * h)
+        d_c, _ = self.__nearest(center)
+        if math.isinf(d_c): # empty index
+            return None
+        r = (d_c + math.sqrt(2.0) * h) * (1.0 + TOL)
+        _, ids = self.index.query_radius(center, r)
+        if ids.shape[0] > self.max_candidates:
+            return None
+        ids = np.sort(ids)
+        xs, ys = self.index.coords(ids)
+
+        return xs, ys, ids
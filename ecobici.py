@@ -1,36 +1,130 @@
-import geopandas as gpd
-import math
-import matplotlib.pyplot as plt
+"""Nearest EcoBici station search, as a library and a command line tool.
+
+Importing this module only loads NumPy and the index modules. Indexes are
+built from the station file on first use and cached in out/, then memory
+mapped by later runs, and matplotlib is imported by the plotting functions
+only. The command line interface has four commands:
+
+    python ecobici.py build [--force]
+    python ecobici.py query LON LAT [--k 3] [--index vp]
+    python ecobici.py batch-query trips.csv [--output out/matches.csv]
+    python ecobici.py plot
+
+Without a command, it builds the indexes if needed and renders the plots of
+the README in out/. Query coords are longitudes and latitudes, distances are
+km in the stations' local projection."""
+import argparse
+import os
+import sys
 import numpy as np
-import pandas as pd
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 import tree as kd
 import vptree as vpt
+from ingest import LocalProjection, build_tree, build_vptree, load_lonlat
+
+# indexes are cached on disk and rebuilt only when the station data changes
+DATA_PATH = 'data/station_information.json'
+OUT_DIR = 'out'
+INDEX_PATHS = {'2d': 'out/tree.idx', 'vp': 'out/vptree.idx'}
+INDEX_TYPES = {'2d': (kd.Tree, build_tree), 'vp': (vpt.VpTree, build_vptree)}
+
+colors = ['red', 'orange', 'brown', 'green', 'cyan', 'magenta', 'black', 'gray']
 
-def latlon_to_global(coords: np.ndarray) -> Tuple[float]:
-    """Converts latitude and longitude coordinates to local x, y positions
-    (around the mean). This is a first order approximation.
+
+def is_cached(path: str, data_path: str = DATA_PATH) -> bool:
+    """Whether an index file exists and is newer than the station data."""
+    return os.path.exists(path) and \
+        os.path.getmtime(path) >= os.path.getmtime(data_path)
+
+
+def load_index(kind: str = '2d', data_path: str = DATA_PATH,
+               force: bool = False):
+    """Loads a cached index, building and saving it first if the cache is
+    missing or older than the station data.
     ----------------------------------------------------------------------------
     Args:
-        coords: (2,)-shape numpy array containint latitude/longitude coords
-    Retuns:
-        x, y: x, y positions
-    """
-    rad = 6371.0 # earth radius
-    dlon = math.pi * (coords[0] - lon_mean) / 180.0
-    dlat = math.pi * (coords[1] - lat_mean) / 180.0
-    x = rad * dlon * math.cos(math.pi * lat_mean / 180.0)
-    y = rad * dlat
-
-    return x, y
+        kind: '2d' for the 2d-tree, 'vp' for the vp-tree
+        data_path: station information file
+        force: rebuild even if the cache is fresh
+    Returns:
+        index: Tree or VpTree over the projected stations"""
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"unknown index {kind!r}, expected one of "
+                         f"{list(INDEX_TYPES)}")
+    cls, build = INDEX_TYPES[kind]
+    path = INDEX_PATHS[kind]
+    if not force and is_cached(path, data_path):
+        return cls.load(path)
+    # stream station coords, projected to x,y positions around their mean
+    index = build(data_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    index.save(path)
+
+    return index
+
+
+def load_indexes(data_path: str = DATA_PATH,
+                 force: bool = False) -> Dict[str, object]:
+    """Loads (or builds) both cached indexes, see load_index."""
+    return {kind: load_index(kind, data_path, force) for kind in INDEX_TYPES}
+
+
+def projection_of(index) -> LocalProjection:
+    """Projection of the coords an index was built from."""
+    return LocalProjection(*index.projection)
+
+
+def nearest_stations(
+        index,
+        lon: float,
+        lat: float,
+        k: int = 1) -> Tuple[np.ndarray]:
+    """Finds the k nearest stations of a location.
+    ----------------------------------------------------------------------------
+    Args:
+        index: index loaded with load_index
+        lon, lat: query coords in degrees
+        k: number of stations
+    Returns:
+        dists: (k,)-shape array of sorted distances in km
+        indices: (k,)-shape array of station positions in the data file
+        lon, lat: (k,)-shape arrays of station coords"""
+    projection = projection_of(index)
+    x, y = projection.forward(lon, lat)
+    dists, indices = index.knn((float(x), float(y)), k)
+
+    return (dists, indices, *projection.inverse(*index.coords(indices)))
 
-colors = ['red', 'orange', 'brown', 'green', 'cyan', 'magenta', 'black', 'gray']
 
-def draw_subtree(node: kd.TreeNode, s: int, color: str) -> None:
+def match_stations(index, lon: np.ndarray, lat: np.ndarray) -> Tuple:
+    """Finds the nearest station of every location in one batch query.
+    ----------------------------------------------------------------------------
+    Args:
+        index: index loaded with load_index
+        lon, lat: (m,)-shape arrays of query coords in degrees
+    Returns:
+        dists: (m,)-shape array of distances in km
+        indices: (m,)-shape array of station positions in the data file"""
+    xs, ys = projection_of(index).forward(lon, lat)
+
+    return index.query(np.column_stack((xs, ys)))
+
+
+def draw_subtree(tree: kd.Tree, node: kd.TreeNode, s: int,
+                 color: str) -> None:
+    import matplotlib.pyplot as plt
     width = 8 - s
+    if node.bucket > 0:
+        # leaf blocks split nothing, draw their points instead
+        block = [tree.node(j, node.bounds)
+                 for j in range(node.slot, node.slot + node.bucket)]
+        block = [p for p in block if p.index >= 0] # skip tombstones
+        plt.scatter([p.x for p in block], [p.y for p in block], color=color,
+                    linewidth=0.05)
+        return
     if node.left != None:
-        draw_subtree(node.left, s + 1, color=colors[(s + 1) % 7])
+        draw_subtree(tree, node.left, s + 1, color=colors[(s + 1) % 7])
     # draw current node as a line segment
     if width > 0:
         if node.split_x == True:
@@ -41,10 +135,11 @@ def draw_subtree(node: kd.TreeNode, s: int, color: str) -> None:
                      linewidth=width, color=color)
 
     if node.right != None:
-        draw_subtree(node.right, s + 1, color=colors[(s + 1) % 7])
+        draw_subtree(tree, node.right, s + 1, color=colors[(s + 1) % 7])
 
 def draw(tree: kd.Tree) -> None:
-    draw_subtree(tree.root, 0, colors[0])
+    if tree.root is not None:
+        draw_subtree(tree, tree.root, 0, colors[0])
 
 
 def plot_random(n: int = 5) -> List[np.ndarray]:
@@ -54,7 +149,8 @@ def plot_random(n: int = 5) -> List[np.ndarray]:
         n: number of random points
     Returns:
         points: List of two (n,)-shape arrays containing pairs of coords"""
-    xs = np.random.uniform(low=-4, high=4, size=n)            
+    import matplotlib.pyplot as plt
+    xs = np.random.uniform(low=-4, high=4, size=n)
     ys = np.random.uniform(low=-6, high=5, size=n)
 
     # plot points
@@ -62,65 +158,121 @@ def plot_random(n: int = 5) -> List[np.ndarray]:
 
     return [xs, ys]
 
-# read data
-df = pd.read_json('data/station_information.json')
-station_pos = df[['lon','lat']].values.reshape(-1, 2)
-
-# compute average
-lon_mean = np.average(station_pos[:, 0])
-lat_mean = np.average(station_pos[:, 1])
-
-# convert coords into x,y position
-locs_bike = np.apply_along_axis(latlon_to_global, 1, station_pos)
-
-# plot station positions
-plt.figure()
-plt.scatter(locs_bike[:, 0], locs_bike[:, 1], linewidth=0.05)
-plt.gca().set_aspect('equal', adjustable='box')
-plt.legend('Ecobici Stations')
-plt.savefig('out/station_locations.png')
-
-# plot 2d-tree
-plt.figure()
-# create 2d-tree using ecobike data
-tree = kd.Tree(locs_bike[:, 0], locs_bike[:, 1])
-plt.scatter(locs_bike[:, 0], locs_bike[:, 1], linewidth=0.05)
-plt.gca().set_aspect('equal', adjustable='box')
-draw(tree)
-plt.savefig('out/tree.png')
-
-# plot query points and their nearest neighbors
-plt.figure()
-plt.scatter(locs_bike[:, 0], locs_bike[:, 1], linewidth=0.05)
-plt.gca().set_aspect('equal', adjustable='box')
-points = plot_random(n=30)
-# compute and plot nearest neighbor for all random points
-nearest_neighbors = []
-for query in zip(points[0], points[1]):
-    _, nearest = tree.nearest_neighbor(query, tree.root)
-    # plot node and draw a line to the query point
-    plt.scatter([nearest.x], [nearest.y], color='red', linewidth=0.05)
-    plt.plot([nearest.x, query[0]], [nearest.y, query[1]], color='k')
-
-plt.savefig('out/nearest.png')
-
-# plot query points and their nearest neighbors using VpTree
-plt.figure()
-# create vp-tree using ecobike data
-locs = []
-for coord in locs_bike:
-    locs.append(coord)
-vptree = vpt.VpTree(locs)
-
-plt.scatter(locs_bike[:, 0], locs_bike[:, 1], linewidth=0.05)
-plt.gca().set_aspect('equal', adjustable='box')
-points = plot_random(n=30)
-# compute and plot nearest neighbor for all random points
-nearest_neighbors = []
-for query in zip(points[0], points[1]):
-    nearest, _ = vptree.nearest_neighbor(query)
-    # plot node and draw a line to the query point
-    plt.scatter([nearest.vp[0]], [nearest.vp[1]], color='red', linewidth=0.05)
-    plt.plot([nearest.vp[0], query[0]], [nearest.vp[1], query[1]], color='k')
-
-plt.savefig('out/nearest_vpt.png')
+
+def plot_stations(locs_bike: np.ndarray):
+    """Starts a figure with the station positions."""
+    import matplotlib.pyplot as plt
+    plt.figure()
+    plt.scatter(locs_bike[:, 0], locs_bike[:, 1], linewidth=0.05)
+    plt.gca().set_aspect('equal', adjustable='box')
+
+
+def plot_all(tree: kd.Tree, vptree: vpt.VpTree, out_dir: str = OUT_DIR):
+    """Renders the station, 2d-tree and nearest neighbor figures.
+    ----------------------------------------------------------------------------
+    Args:
+        tree: 2d-tree over the stations
+        vptree: vp-tree over the same stations
+        out_dir: folder of the png files"""
+    import matplotlib.pyplot as plt
+    locs_bike = vptree.points
+
+    # plot station positions
+    plot_stations(locs_bike)
+    plt.legend('Ecobici Stations')
+    plt.savefig(os.path.join(out_dir, 'station_locations.png'))
+
+    # plot 2d-tree
+    plot_stations(locs_bike)
+    draw(tree)
+    plt.savefig(os.path.join(out_dir, 'tree.png'))
+
+    # plot query points and their nearest neighbors
+    plot_stations(locs_bike)
+    points = plot_random(n=30)
+    # compute nearest neighbor for all random points in a single batch
+    queries = np.column_stack(points)
+    _, nearest_idx = tree.query(queries)
+    for query, nearest in zip(queries, locs_bike[nearest_idx]):
+        # plot node and draw a line to the query point
+        plt.scatter([nearest[0]], [nearest[1]], color='red', linewidth=0.05)
+        plt.plot([nearest[0], query[0]], [nearest[1], query[1]], color='k')
+    plt.savefig(os.path.join(out_dir, 'nearest.png'))
+
+    # plot query points and their nearest neighbors using VpTree
+    plot_stations(locs_bike)
+    points = plot_random(n=30)
+    # compute and plot nearest neighbor for all random points
+    for query in zip(points[0], points[1]):
+        nearest, _ = vptree.nearest_neighbor(query)
+        # plot node and draw a line to the query point
+        plt.scatter([nearest.vp[0]], [nearest.vp[1]], color='red',
+                    linewidth=0.05)
+        plt.plot([nearest.vp[0], query[0]], [nearest.vp[1], query[1]],
+                 color='k')
+    plt.savefig(os.path.join(out_dir, 'nearest_vpt.png'))
+    plt.close('all')
+
+
+def positive_int(value: str) -> int:
+    """Argparse type of a positive integer argument."""
+    try:
+        k = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected an integer, got "
+                                         f"{value!r}")
+    if k < 1:
+        raise argparse.ArgumentTypeError(f"must be positive, got {k}")
+    return k
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--data', default=DATA_PATH,
+                        help='station information file')
+    commands = parser.add_subparsers(dest='command')
+    build = commands.add_parser('build', help='build and cache both indexes')
+    build.add_argument('--force', action='store_true',
+                       help='rebuild even if the cache is fresh')
+    query = commands.add_parser('query', help='nearest stations of a location')
+    query.add_argument('lon', type=float)
+    query.add_argument('lat', type=float)
+    query.add_argument('--k', type=positive_int, default=1)
+    query.add_argument('--index', default='2d', choices=list(INDEX_TYPES))
+    batch = commands.add_parser(
+        'batch-query', help='nearest station of every location in a file')
+    batch.add_argument('path', help='json, ndjson or csv file with lon and '
+                       'lat fields')
+    batch.add_argument('--output', help='csv file, standard output if unset')
+    batch.add_argument('--index', default='2d', choices=list(INDEX_TYPES))
+    commands.add_parser('plot', help='render the figures in out/')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        for kind, index in load_indexes(args.data, args.force).items():
+            print(f"{kind}: {len(index)} stations, {INDEX_PATHS[kind]}")
+    elif args.command == 'query':
+        index = load_index(args.index, args.data)
+        for d, i, lon, lat in zip(*nearest_stations(index, args.lon, args.lat,
+                                                    args.k)):
+            print(f"station {i} at ({lon:.6f}, {lat:.6f}), {d:.3f} km")
+    elif args.command == 'batch-query':
+        index = load_index(args.index, args.data)
+        lon, lat = load_lonlat(args.path)
+        dists, indices = match_stations(index, lon, lat)
+        out = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            np.savetxt(out, np.column_stack((lon, lat, indices, dists)),
+                       fmt=('%.6f', '%.6f', '%d', '%.6f'), delimiter=',',
+                       header='lon,lat,station,dist_km', comments='')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    else:
+        indexes = load_indexes(args.data)
+        plot_all(indexes['2d'], indexes['vp'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,478 @@
+"""Uniform grid (cell list) spatial index for dense 2d point sets.
+
+Points are bucketed into square cells over their bounding box and stored in
+CSR layout: coords and ids sorted by cell, plus an array of cell start
+offsets. Cells are numbered row by row, so a run of cells along a row is one
+contiguous slice of the point arrays. Searches visit rings of cells around
+the query's cell, ring k being the cells at Chebyshev distance k, and stop
+as soon as the best distance found is below the distance from the query to
+the next ring, which makes the answers exact."""
+import math
+import numpy as np
+from typing import List, Tuple
+
+from metrics import Euclidean
+from neighbors import (group_hits, knn_each, push_bounded, sorted_heap,
+                       update_best)
+from storage import read_index, write_index
+
+# points per cell aimed at when the cell size is chosen from density
+TARGET_OCCUPANCY = 2.0
+
+
+class GridIndex:
+    def __init__(self, points, cell_size: float = None):
+        """Buckets 2d-points into a uniform grid covering their bounding box.
+        ------------------------------------------------------------------------
+        Args:
+            points: sequence of (2,)-shape points
+            cell_size: side of the cells, by default chosen so cells hold
+                TARGET_OCCUPANCY points on average"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        n = points.shape[0]
+        lo = points.min(axis=0) if n > 0 else np.zeros(2)
+        w, h = points.max(axis=0) - lo if n > 0 else (0.0, 0.0)
+        if cell_size is None:
+            if max(w, h) > 0:
+                # at most about n / TARGET_OCCUPANCY cells, also for points
+                # on or near a line, whose area-based cells would be tiny
+                cell_size = max(math.sqrt(w * h * TARGET_OCCUPANCY / n),
+                                max(w, h) * TARGET_OCCUPANCY / n)
+            else:
+                cell_size = 1.0
+        self._x0, self._y0 = float(lo[0]), float(lo[1])
+        self._h = float(cell_size)
+        self._nx = int(w // self._h) + 1
+        self._ny = int(h // self._h) + 1
+
+        # sort points by cell, ties by index so buckets list lowest ids first
+        cells = self.__cell(points[:, 0], points[:, 1])
+        order = np.argsort(cells, kind='stable')
+        self._x = points[order, 0].copy()
+        self._y = points[order, 1].copy()
+        self._ids = order.astype(np.int64)
+        # points of cell c are in [_start[c], _start[c + 1])
+        self._start = np.zeros(self._nx * self._ny + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=self._nx * self._ny),
+                  out=self._start[1:])
+        self.visits = 0 # points examined by the last single-point search
+        self.version = 0 # grids are static, it never changes
+        self.projection = None
+
+    def __len__(self) -> int:
+        return self._x.shape[0]
+
+    @property
+    def cell_size(self) -> float:
+        return self._h
+
+    @property
+    def shape(self) -> Tuple[int]:
+        """Number of cells along x and along y.
+        ------------------------------------------------------------------------
+        """
+        return self._nx, self._ny
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by the point and bucket arrays in bytes.
+        ------------------------------------------------------------------------
+        """
+        return sum(a.nbytes for a in (self._x, self._y, self._ids,
+                                      self._start))
+
+    def __cell(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """Cell numbers of points inside the grid."""
+        cx = np.minimum(((xs - self._x0) // self._h).astype(np.int64),
+                        self._nx - 1)
+        cy = np.minimum(((ys - self._y0) // self._h).astype(np.int64),
+                        self._ny - 1)
+        return cy * self._nx + cx
+
+    def coords(self, ids: np.ndarray) -> Tuple[np.ndarray]:
+        """Looks up the coords of points by index.
+        ------------------------------------------------------------------------
+        Args:
+            ids: array of point indices
+        Returns:
+            xs, ys: arrays of the points' coords"""
+        if not hasattr(self, '_pos'): # position of each id in the buckets
+            self._pos = np.empty(len(self), dtype=np.int64)
+            self._pos[self._ids] = np.arange(len(self))
+        pos = self._pos[np.asarray(ids, dtype=np.int64)]
+        return self._x[pos], self._y[pos]
+
+    def _state(self) -> Tuple[dict]:
+        """Arrays and scalar attributes that fully describe the grid, used to
+        save it and to share it with other processes.
+        ------------------------------------------------------------------------
+        Returns:
+            arrays: named arrays
+            attrs: JSON serializable scalar attributes"""
+        arrays = {'x': self._x, 'y': self._y, 'ids': self._ids,
+                  'start': self._start}
+        attrs = {'x0': self._x0, 'y0': self._y0, 'h': self._h,
+                 'nx': self._nx, 'ny': self._ny,
+                 'projection': self.projection}
+        return arrays, attrs
+
+    @classmethod
+    def _from_state(cls, arrays: dict, attrs: dict) -> 'GridIndex':
+        """Wraps arrays returned by _state into a grid, without copying them.
+        ------------------------------------------------------------------------
+        Args:
+            arrays: named arrays
+            attrs: scalar attributes
+        Returns:
+            grid: GridIndex using the given arrays"""
+        grid = cls.__new__(cls)
+        grid._x, grid._y = arrays['x'], arrays['y']
+        grid._ids, grid._start = arrays['ids'], arrays['start']
+        grid._x0, grid._y0, grid._h = attrs['x0'], attrs['y0'], attrs['h']
+        grid._nx, grid._ny = attrs['nx'], attrs['ny']
+        grid.visits = grid.version = 0
+        projection = attrs['projection']
+        grid.projection = tuple(projection) if projection else None
+
+        return grid
+
+    def save(self, path: str):
+        """Writes the point and bucket arrays to a binary index file, see
+        storage.py.
+        ------------------------------------------------------------------------
+        Args:
+            path: output file path"""
+        write_index(path, 'grid', *self._state())
+
+    @classmethod
+    def load(
+            cls,
+            path: str,
+            mmap: bool = True,
+            verify: bool = None) -> 'GridIndex':
+        """Loads a grid written by save, see Tree.load.
+        ------------------------------------------------------------------------
+        Args:
+            path: input file path
+            mmap: map the file instead of reading it into memory
+            verify: check the data checksum, by default only when not mapping
+        Returns:
+            grid: loaded GridIndex"""
+        return cls._from_state(*read_index(path, 'grid', mmap, verify))
+
+    def __locate(self, query: Tuple[float]) -> Tuple:
+        """Position of a query in cell units, its cell and the range of rings
+        holding cells of the grid.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+        Returns:
+            fx, fy: query coords in cell units
+            cx, cy: query's cell, possibly outside the grid
+            k0, k1: first and last rings overlapping the grid"""
+        fx = (query[0] - self._x0) / self._h
+        fy = (query[1] - self._y0) / self._h
+        cx, cy = math.floor(fx), math.floor(fy)
+        k0 = max(0, -cx, cx - self._nx + 1, -cy, cy - self._ny + 1)
+        k1 = max(cx, self._nx - 1 - cx, cy, self._ny - 1 - cy)
+        return fx, fy, cx, cy, k0, k1
+
+    def __ring(self, cx: int, cy: int, k: int) -> List[Tuple[int]]:
+        """Slices of the point arrays holding ring k around cell (cx, cy): its
+        bottom and top rows, then the cells of its sides in between.
+        ------------------------------------------------------------------------
+        Args:
+            cx, cy: center cell
+            k: ring number
+        Returns:
+            slices: list of (start, stop) point positions"""
+        segments = [(cy - k, cx - k, cx + k)]
+        if k > 0:
+            segments.append((cy + k, cx - k, cx + k))
+            for y in range(max(cy - k + 1, 0), min(cy + k, self._ny)):
+                segments += [(y, cx - k, cx - k), (y, cx + k, cx + k)]
+
+        slices = []
+        for y, xlo, xhi in segments:
+            xlo, xhi = max(xlo, 0), min(xhi, self._nx - 1)
+            if 0 <= y < self._ny and xlo <= xhi:
+                row = y * self._nx
+                slices.append((self._start.item(row + xlo),
+                               self._start.item(row + xhi + 1)))
+
+        return slices
+
+    def __ring_bound(self, fx: float, fy: float, cx: int, cy: int,
+                     k: int) -> float:
+        """Distance from a query to the cells beyond ring k."""
+        return self._h * min(fx - cx + k, cx + k + 1 - fx,
+                             fy - cy + k, cy + k + 1 - fy)
+
+    def nearest_neighbor(self, query: List[float]) -> Tuple[float, int]:
+        """Finds the nearest neighbor of a query point, ties by lowest index.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords
+        Returns:
+            dist: distance from query to its nearest neighbor
+            index: nearest neighbor's index, -1 for an empty grid"""
+        xq, yq = float(query[0]), float(query[1])
+        fx, fy, cx, cy, k0, k1 = self.__locate((xq, yq))
+        x, y, ids = self._x, self._y, self._ids
+        dmin, nn, visits = math.inf, -1, 0
+        for k in range(k0, k1 + 1) if len(self) > 0 else ():
+            for start, stop in self.__ring(cx, cy, k):
+                visits += stop - start
+                for p in range(start, stop):
+                    dx, dy = xq - x.item(p), yq - y.item(p)
+                    d = math.sqrt(dx * dx + dy * dy)
+                    if d < dmin or (d == dmin and ids.item(p) < nn):
+                        dmin, nn = d, ids.item(p)
+            # cells beyond ring k are farther than the best point
+            if dmin < self.__ring_bound(fx, fy, cx, cy, k):
+                break
+
+        self.visits = visits
+        return dmin, nn
+
+    def knn(self, query: List[float], k: int) -> Tuple[np.ndarray]:
+        """Finds the k nearest neighbors of a query point. Rings are visited
+        until the k-th candidate is closer than the next ring. Results are
+        sorted by distance, ties by index.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords
+            k: number of neighbors
+        Returns:
+            dists: (min(k, n),)-shape array of sorted distances
+            indices: (min(k, n),)-shape array of neighbors' indices"""
+        if k < 1:
+            raise ValueError(f"k must be positive, got {k}")
+        xq, yq = float(query[0]), float(query[1])
+        fx, fy, cx, cy, k0, k1 = self.__locate((xq, yq))
+        x, y, ids = self._x, self._y, self._ids
+        heap, visits = [], 0 # max-heap of (-dist, -index) pairs
+        for ring in range(k0, k1 + 1) if len(self) > 0 else ():
+            for start, stop in self.__ring(cx, cy, ring):
+                visits += stop - start
+                for p in range(start, stop):
+                    dx, dy = xq - x.item(p), yq - y.item(p)
+                    push_bounded(heap, k, math.sqrt(dx * dx + dy * dy),
+                                 ids.item(p))
+            if len(heap) == k and \
+                    -heap[0][0] < self.__ring_bound(fx, fy, cx, cy, ring):
+                break
+
+        self.visits = visits
+        return sorted_heap(heap)
+
+    def knn_batch(self, points: np.ndarray, k: int) -> Tuple[np.ndarray]:
+        """Batch k nearest neighbors search.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            k: number of neighbors
+        Returns:
+            dists: (m, min(k, n))-shape array of sorted distances
+            indices: (m, min(k, n))-shape array of neighbors' indices"""
+        return knn_each(self.knn, points, k, len(self))
+
+    def query_radius(self, query: List[float], r: float) -> Tuple[np.ndarray]:
+        """Finds all points within distance r of a query point, scanning the
+        rows of cells overlapping the circle's bounding box. Results are
+        sorted by distance, ties by index.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords
+            r: search radius
+        Returns:
+            dists: array of sorted distances
+            indices: array of indices of the points within the radius"""
+        xq, yq = float(query[0]), float(query[1])
+        dists, indices = [np.empty(0)], [np.empty(0, dtype=np.int64)]
+        xlo = max(math.floor((xq - r - self._x0) / self._h), 0)
+        xhi = min(math.floor((xq + r - self._x0) / self._h), self._nx - 1)
+        ylo = max(math.floor((yq - r - self._y0) / self._h), 0)
+        yhi = min(math.floor((yq + r - self._y0) / self._h), self._ny - 1)
+        visits = 0
+        for row in range(ylo * self._nx, (yhi + 1) * self._nx, self._nx):
+            if xlo > xhi or len(self) == 0:
+                break
+            start = self._start.item(row + xlo)
+            stop = self._start.item(row + xhi + 1)
+            visits += stop - start
+            d = Euclidean.dists(self._x[start:stop], self._y[start:stop],
+                                xq, yq)
+            hit = d <= r
+            dists.append(d[hit])
+            indices.append(self._ids[start:stop][hit])
+
+        self.visits = visits
+        dists, indices = np.concatenate(dists), np.concatenate(indices)
+        order = np.lexsort((indices, dists))
+        return dists[order], indices[order]
+
+    def __pairs(
+            self,
+            q: np.ndarray,
+            y: np.ndarray,
+            xlo: np.ndarray,
+            xhi: np.ndarray) -> Tuple[np.ndarray]:
+        """Expands row segments of cells into (query, point position) pairs.
+        ------------------------------------------------------------------------
+        Args:
+            q: (s,)-shape array of query positions owning the segments
+            y: (s,)-shape array of segment rows
+            xlo, xhi: (s,)-shape arrays of first and last segment columns
+        Returns:
+            q, p: arrays of query positions and point positions"""
+        xlo, xhi = np.maximum(xlo, 0), np.minimum(xhi, self._nx - 1)
+        valid = (y >= 0) & (y < self._ny) & (xlo <= xhi)
+        q, row = q[valid], y[valid] * self._nx
+        start = self._start[row + xlo[valid]]
+        counts = self._start[row + xhi[valid] + 1] - start
+        # position of each pair within its segment
+        offsets = np.arange(counts.sum()) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+
+        return np.repeat(q, counts), np.repeat(start, counts) + offsets
+
+    def query(self, points: np.ndarray) -> Tuple[np.ndarray]:
+        """Batch nearest neighbor search. All queries expand their rings
+        together: at each step every active query contributes the row
+        segments of its current ring, segments become (query, point) pairs,
+        and queries whose best distance is below their next ring's distance
+        drop out. Ties go to the lowest point index.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+        Returns:
+            dists: (m,)-shape array of distances to the nearest neighbors
+            indices: (m,)-shape array with the nearest neighbors' indices in
+                the input points, -1 for an empty grid"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        m = points.shape[0]
+        dists = np.full(m, math.inf)
+        indices = np.full(m, -1, dtype=np.int64)
+        if len(self) == 0 or m == 0:
+            return dists, indices
+        xq, yq = points[:, 0], points[:, 1]
+        fx, fy = (xq - self._x0) / self._h, (yq - self._y0) / self._h
+        cx, cy = np.floor(fx).astype(np.int64), np.floor(fy).astype(np.int64)
+        # first and last rings overlapping the grid
+        k = np.maximum.reduce([np.zeros(m, dtype=np.int64), -cx,
+                               cx - self._nx + 1, -cy, cy - self._ny + 1])
+        k1 = np.maximum.reduce([cx, self._nx - 1 - cx, cy,
+                                self._ny - 1 - cy])
+
+        q = np.arange(m)
+        while q.shape[0] > 0:
+            # row segments of ring k that fall inside the grid: bottom and
+            # top rows, then the side cells of the rows in between
+            kq, cxq, cyq = k[q], cx[q], cy[q]
+            sq, y, xlo, xhi = [], [], [], []
+            for row, valid in ((cyq - kq, np.ones(q.shape[0], dtype=bool)),
+                               (cyq + kq, kq > 0)):
+                valid &= (row >= 0) & (row < self._ny)
+                sq.append(q[valid])
+                y.append(row[valid])
+                xlo.append(cxq[valid] - kq[valid])
+                xhi.append(cxq[valid] + kq[valid])
+            rlo = np.maximum(cyq - kq + 1, 0)
+            rows = np.maximum(np.minimum(cyq + kq, self._ny) - rlo, 0)
+            for col in (cxq - kq, cxq + kq):
+                valid = (kq > 0) & (col >= 0) & (col < self._nx) & (rows > 0)
+                n = rows[valid]
+                j = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+                sq.append(np.repeat(q[valid], n))
+                y.append(np.repeat(rlo[valid], n) + j)
+                xlo.append(np.repeat(col[valid], n))
+                xhi.append(xlo[-1])
+            sq, y = np.concatenate(sq), np.concatenate(y)
+            xlo, xhi = np.concatenate(xlo), np.concatenate(xhi)
+            pq, p = self.__pairs(sq, y, xlo, xhi)
+            self.__update_best(dists, indices, pq, p, xq, yq)
+
+            # distance to the cells beyond ring k
+            fxq, fyq = fx[q], fy[q]
+            bound = self._h * np.minimum.reduce(
+                [fxq - cxq + kq, cxq + kq + 1 - fxq,
+                 fyq - cyq + kq, cyq + kq + 1 - fyq])
+            done = (dists[q] < bound) | (kq >= k1[q])
+            q = q[~done]
+            k[q] += 1
+
+        return dists, indices
+
+    def __update_best(
+            self,
+            dists: np.ndarray,
+            indices: np.ndarray,
+            q: np.ndarray,
+            p: np.ndarray,
+            xq: np.ndarray,
+            yq: np.ndarray):
+        """Updates in place the best distances and indices of a batch of
+        queries with a set of (query, point position) pairs, among equally
+        distant points the lowest index is kept.
+        ------------------------------------------------------------------------
+        Args:
+            dists: (m,)-shape array of current nearest distances
+            indices: (m,)-shape array of current nearest indices
+            q: (k,)-shape array of query positions
+            p: (k,)-shape array of point positions
+            xq: (m,)-shape array of query x-coords
+            yq: (m,)-shape array of query y-coords"""
+        d = Euclidean.dists(xq[q], yq[q], self._x[p], self._y[p])
+        update_best(dists, indices, q, d, self._ids[p])
+
+    def parallel_query(
+            self,
+            points: np.ndarray,
+            workers: int = None) -> Tuple[np.ndarray]:
+        """Batch nearest neighbor search split across worker processes that
+        share the grid arrays through shared memory, see parallel.py.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            workers: number of worker processes, defaults to the CPU count
+        Returns:
+            dists: (m,)-shape array of distances to the nearest neighbors
+            indices: (m,)-shape array of the nearest neighbors' indices"""
+        import parallel # loads multiprocessing, only when needed
+        return parallel.parallel_query(self, points, workers)
+
+    def query_radius_batch(
+            self,
+            points: np.ndarray,
+            r: float) -> List[Tuple[np.ndarray]]:
+        """Batch radius search over the rows of cells overlapping each query's
+        circle bounding box.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            r: search radius
+        Returns:
+            results: list with a (dists, indices) pair of sorted arrays for
+                each query"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        m = points.shape[0]
+        xq, yq = points[:, 0], points[:, 1]
+        xlo = np.floor((xq - r - self._x0) / self._h).astype(np.int64)
+        xhi = np.floor((xq + r - self._x0) / self._h).astype(np.int64)
+        ylo = np.maximum(
+            np.floor((yq - r - self._y0) / self._h).astype(np.int64), 0)
+        yhi = np.minimum(
+            np.floor((yq + r - self._y0) / self._h).astype(np.int64),
+            self._ny - 1)
+        # one row segment per query and row
+        rows = np.maximum(yhi - ylo + 1, 0) if len(self) > 0 else \
+            np.zeros(m, dtype=np.int64)
+        sq = np.repeat(np.arange(m), rows)
+        y = np.repeat(ylo, rows) + np.arange(rows.sum()) - \
+            np.repeat(np.cumsum(rows) - rows, rows)
+        q, p = self.__pairs(sq, y, xlo[sq], xhi[sq])
+
+        d = Euclidean.dists(xq[q], yq[q], self._x[p], self._y[p])
+        hit = d <= r
+        return group_hits(m, q[hit], d[hit], self._ids[p[hit]])
@@ -0,0 +1,271 @@
+"""Streaming ingestion of station and point data.
+
+Readers parse JSON arrays (plain, or GBFS feeds with the records under a
+"stations" key), NDJSON and CSV files record by record and hand out lon/lat
+coordinates in fixed-size chunks, so no DataFrame or list of records is ever
+held in memory. load_points collects the chunks into coordinate arrays and
+projects them in place with a LocalProjection, and build_tree/build_vptree feed
+them straight into index construction. Indexes using the haversine metric are
+built over the raw lon/lat coords instead, see load_lonlat."""
+import csv
+import json
+import math
+import numpy as np
+from typing import Iterator, NamedTuple, Tuple
+
+import tree as kd
+import vptree as vpt
+from metrics import EARTH_RADIUS, get_metric
+
+CHUNK_SIZE = 65536 # records per chunk
+BLOCK_SIZE = 1 << 20 # characters read at a time from JSON arrays
+FORMATS = {'.json': 'json', '.geojson': 'json', '.ndjson': 'ndjson',
+           '.jsonl': 'ndjson', '.csv': 'csv'}
+
+
+class LocalProjection(NamedTuple):
+    """First order projection of longitude/latitude degrees to x, y positions
+    in km around an origin, accurate at city scale. Being a tuple of the
+    origin coords, it is stored as the projection of the indexes."""
+    lon0: float
+    lat0: float
+
+    @classmethod
+    def fit(cls, lon: np.ndarray, lat: np.ndarray) -> 'LocalProjection':
+        """Projection around the mean of a set of coords.
+        ------------------------------------------------------------------------
+        Args:
+            lon: array of longitudes
+            lat: array of latitudes
+        Returns:
+            projection: LocalProjection centered at the mean coords"""
+        return cls(float(np.mean(lon)), float(np.mean(lat)))
+
+    @property
+    def scale(self) -> Tuple[float]:
+        """km per degree of longitude and of latitude around the origin."""
+        ky = EARTH_RADIUS * math.pi / 180.0
+        return ky * math.cos(math.radians(self.lat0)), ky
+
+    def forward(
+            self,
+            lon: np.ndarray,
+            lat: np.ndarray,
+            out: Tuple[np.ndarray] = None) -> Tuple[np.ndarray]:
+        """Projects longitudes and latitudes to x, y positions.
+        ------------------------------------------------------------------------
+        Args:
+            lon: array of longitudes
+            lat: array of latitudes
+            out: optional (x, y) arrays to write to, may be lon and lat
+        Returns:
+            x, y: arrays of positions in km"""
+        x, y = out if out is not None else (None, None)
+        kx, ky = self.scale
+        x = np.multiply(np.subtract(lon, self.lon0, out=x), kx, out=x)
+        y = np.multiply(np.subtract(lat, self.lat0, out=y), ky, out=y)
+
+        return x, y
+
+    def inverse(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray]:
+        """Maps x, y positions back to longitudes and latitudes.
+        ------------------------------------------------------------------------
+        Args:
+            x: array of x positions in km
+            y: array of y positions in km
+        Returns:
+            lon, lat: arrays of coords in degrees"""
+        kx, ky = self.scale
+        return np.asarray(x) / kx + self.lon0, np.asarray(y) / ky + self.lat0
+
+
+def _iter_json_array(f) -> Iterator[dict]:
+    """Yields the records of a JSON array one at a time, decoding from a
+    buffer refilled in blocks. The array is the top level value or, for GBFS
+    feeds, the value of the first "stations" key."""
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+
+    def fill() -> bool:
+        nonlocal buf, pos, eof
+        block = f.read(BLOCK_SIZE)
+        eof = not block
+        buf, pos = buf[pos:] + block, 0
+        return not eof
+
+    def skip(chars: str):
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf) or not fill():
+                return
+
+    skip(' \t\r\n')
+    if buf[pos:pos + 1] == '{': # GBFS feed, find the stations array
+        while (start := buf.find('"stations"', pos)) < 0:
+            pos = max(pos, len(buf) - len('"stations"'))
+            if not fill():
+                raise ValueError("no stations array in JSON object")
+        pos = start + len('"stations"')
+        skip(' \t\r\n:')
+    if buf[pos:pos + 1] != '[':
+        raise ValueError("expected a JSON array of records")
+    pos += 1
+
+    while True:
+        skip(' \t\r\n,')
+        if pos >= len(buf):
+            raise ValueError("unterminated JSON array")
+        if buf[pos] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # the record continues past the buffer
+            if not fill():
+                raise
+            continue
+        pos = end
+        yield record
+
+
+def iter_records(path: str, format: str = None) -> Iterator[dict]:
+    """Yields the records of a JSON, NDJSON or CSV file one at a time.
+    ----------------------------------------------------------------------------
+    Args:
+        path: input file path
+        format: 'json', 'ndjson' or 'csv', guessed from the extension if None
+    Returns:
+        records: iterator over dicts"""
+    if format is None:
+        ext = path[path.rfind('.'):].lower()
+        if ext not in FORMATS:
+            raise ValueError(f"cannot guess the format of {path}")
+        format = FORMATS[ext]
+
+    with open(path, newline='' if format == 'csv' else None,
+              encoding='utf-8') as f:
+        if format == 'json':
+            yield from _iter_json_array(f)
+        elif format == 'ndjson':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif format == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            raise ValueError(f"unknown format {format}")
+
+
+def iter_chunks(
+        path: str,
+        format: str = None,
+        chunk_size: int = CHUNK_SIZE,
+        lon_key: str = 'lon',
+        lat_key: str = 'lat') -> Iterator[Tuple[np.ndarray]]:
+    """Yields the coords of a file's records in chunks.
+    ----------------------------------------------------------------------------
+    Args:
+        path: input file path
+        format: 'json', 'ndjson' or 'csv', guessed from the extension if None
+        chunk_size: records per chunk
+        lon_key, lat_key: record fields holding the coords
+    Returns:
+        chunks: iterator over (lon, lat) pairs of arrays of up to chunk_size
+            coords"""
+    lon, lat, k = np.empty(chunk_size), np.empty(chunk_size), 0
+    for record in iter_records(path, format):
+        lon[k], lat[k] = float(record[lon_key]), float(record[lat_key])
+        k += 1
+        if k == chunk_size:
+            yield lon, lat
+            lon, lat, k = np.empty(chunk_size), np.empty(chunk_size), 0
+    if k > 0:
+        yield lon[:k], lat[:k]
+
+
+def load_lonlat(
+        path: str,
+        format: str = None,
+        chunk_size: int = CHUNK_SIZE,
+        lon_key: str = 'lon',
+        lat_key: str = 'lat') -> Tuple[np.ndarray]:
+    """Streams a file's coords into arrays. Besides the output, memory holds a
+    single chunk of records.
+    ----------------------------------------------------------------------------
+    Args:
+        path: input file path
+        format: 'json', 'ndjson' or 'csv', guessed from the extension if None
+        chunk_size: records per chunk
+        lon_key, lat_key: record fields holding the coords
+    Returns:
+        lon, lat: arrays of coords in degrees"""
+    lon, lat, n = np.empty(chunk_size), np.empty(chunk_size), 0
+    for chunk_lon, chunk_lat in iter_chunks(path, format, chunk_size, lon_key,
+                                            lat_key):
+        k = chunk_lon.shape[0]
+        if n + k > lon.shape[0]: # grow geometrically
+            lon, lat = np.resize(lon, 2 * n), np.resize(lat, 2 * n)
+        lon[n:n + k], lat[n:n + k] = chunk_lon, chunk_lat
+        n += k
+
+    return lon[:n], lat[:n]
+
+
+def load_points(
+        path: str,
+        projection: LocalProjection = None,
+        format: str = None,
+        chunk_size: int = CHUNK_SIZE,
+        lon_key: str = 'lon',
+        lat_key: str = 'lat') -> Tuple:
+    """Streams a file's coords into arrays and projects them in place. Besides
+    the output, memory holds a single chunk of records.
+    ----------------------------------------------------------------------------
+    Args:
+        path: input file path
+        projection: projection to apply, by default centered at the mean
+        format: 'json', 'ndjson' or 'csv', guessed from the extension if None
+        chunk_size: records per chunk
+        lon_key, lat_key: record fields holding the coords
+    Returns:
+        xs, ys: arrays of projected positions in km
+        projection: projection used"""
+    lon, lat = load_lonlat(path, format, chunk_size, lon_key, lat_key)
+    if projection is None:
+        projection = LocalProjection.fit(lon, lat) if lon.shape[0] > 0 else \
+            LocalProjection(0.0, 0.0)
+    xs, ys = projection.forward(lon, lat, out=(lon, lat))
+
+    return xs, ys, projection
+
+
+def build_tree(path: str, metric: str = 'euclidean', **kwargs) -> kd.Tree:
+    """Builds a 2d-tree over a file's coords, see load_points for the keyword
+    arguments. Coords are projected and the projection is kept in
+    tree.projection, except for the haversine metric which takes lon/lat."""
+    if get_metric(metric).name == 'haversine':
+        kwargs.pop('projection', None)
+        return kd.Tree(*load_lonlat(path, **kwargs), metric=metric)
+    xs, ys, projection = load_points(path, **kwargs)
+    tree = kd.Tree(xs, ys, metric=metric)
+    tree.projection = projection
+
+    return tree
+
+
+def build_vptree(
+        path: str,
+        metric: str = 'euclidean',
+        **kwargs) -> vpt.VpTree:
+    """Builds a vp-tree over a file's coords, see build_tree."""
+    if get_metric(metric).name == 'haversine':
+        kwargs.pop('projection', None)
+        return vpt.VpTree(np.column_stack(load_lonlat(path, **kwargs)),
+                          metric=metric)
+    xs, ys, projection = load_points(path, **kwargs)
+    tree = vpt.VpTree(np.column_stack((xs, ys)), metric=metric)
+    tree.projection = projection
+
+    return tree
@@ -0,0 +1,355 @@
+"""Bulk nearest neighbor joins between two 2d-trees by dual-tree traversal.
+
+Every query point gets its nearest reference point. The query set is indexed
+by a 2d-tree as well, and both trees are walked together. The state is a set
+of (query entity, reference entity) pairs. An entity is either a node's own
+points (the node's point, or the points of a leaf block) or the node's whole
+subtree, and carries a tight bounding box. A pair is pruned when the distance
+between the two boxes exceeds the query entity's bound, i.e. the largest
+nearest distance found so far among its query points. Kept pairs are split
+level by level: a subtree splits into its own points and its two child
+subtrees. Pairs of own points are evaluated directly. Every round is a handful
+of vectorized NumPy calls over all pairs, and one pruned pair discards a whole
+block of query points at once. A greedy descent of each query point gives
+the initial bounds.
+
+The same traversal over a single tree, skipping every point's match with
+itself, gives the all nearest neighbors of a point set and its closest pair.
+Boxes are compared with the euclidean distance, so joins need euclidean
+trees."""
+import math
+import numpy as np
+from typing import Tuple
+
+from metrics import Euclidean
+from neighbors import update_best
+
+# leaf blocks of the query trees built by nearest_join, larger than the
+# default as they halve the build time at little cost in the traversal
+QUERY_LEAF_SIZE = 64
+
+
+def _check_metric(*trees):
+    for tree in trees:
+        if tree.metric.name != 'euclidean':
+            # box to box distances assume planar coords
+            raise ValueError(f"joins need euclidean trees, got "
+                             f"{tree.metric.name}")
+
+
+def _levels(tree) -> list:
+    """Node slots of a tree grouped by depth, root first."""
+    levels = []
+    level = np.array([tree._root] if tree._root >= 0 else [], dtype=np.int64)
+    while level.shape[0] > 0:
+        levels.append(level)
+        children = np.concatenate((tree._left[level], tree._right[level]))
+        level = children[children >= 0].astype(np.int64)
+
+    return levels
+
+
+def _blocks(keys: np.ndarray, slots: np.ndarray, bucket: np.ndarray):
+    """Expands (key, slot) pairs whose slot starts a leaf block into one pair
+    per point of the block.
+    ----------------------------------------------------------------------------
+    Args:
+        keys: (k,)-shape array of keys carried along
+        slots: (k,)-shape array of node slots
+        bucket: leaf block sizes of the tree, by slot
+    Returns:
+        keys, slots: arrays of keys and point slots"""
+    size = np.maximum(bucket[slots], 1)
+    offsets = np.arange(size.sum()) - np.repeat(np.cumsum(size) - size, size)
+
+    return np.repeat(keys, size), np.repeat(slots, size) + offsets
+
+
+class _Boxes:
+    def __init__(self, tree):
+        """Tight bounding boxes and live point counts of the own points and of
+        the subtree of every node of a tree, and the codes of the entities
+        below each node.
+        ------------------------------------------------------------------------
+        Args:
+            tree: Tree to describe"""
+        n = tree._size
+        x, y, bucket = tree._x[:n], tree._y[:n], tree._bucket[:n]
+        self.levels = _levels(tree)
+        # own boxes, a node's point or the box of its leaf block
+        own = np.stack((x, x, y, y)).copy()
+        own_live = (tree._index[:n] >= 0).astype(np.int64)
+        starts = np.flatnonzero(bucket > 0)
+        if starts.shape[0] > 0:
+            keys, slots = _blocks(np.arange(starts.shape[0]), starts, bucket)
+            cuts = np.searchsorted(keys, np.arange(starts.shape[0]))
+            own[0, starts] = np.minimum.reduceat(x[slots], cuts)
+            own[1, starts] = np.maximum.reduceat(x[slots], cuts)
+            own[2, starts] = np.minimum.reduceat(y[slots], cuts)
+            own[3, starts] = np.maximum.reduceat(y[slots], cuts)
+            own_live[starts] = np.add.reduceat(own_live[slots], cuts)
+        # subtree boxes, merged bottom up one level at a time
+        full, full_live = own.copy(), own_live.copy()
+        for level in reversed(self.levels):
+            for child in (tree._left[level], tree._right[level]):
+                has = child >= 0
+                i, c = level[has], child[has]
+                full[0, i] = np.minimum(full[0, i], full[0, c])
+                full[1, i] = np.maximum(full[1, i], full[1, c])
+                full[2, i] = np.minimum(full[2, i], full[2, c])
+                full[3, i] = np.maximum(full[3, i], full[3, c])
+                full_live[i] += full_live[c]
+        # entity codes: 2 * slot for own points, 2 * slot + 1 for a subtree,
+        # used only for nodes with children
+        inner = (tree._left[:n] >= 0) | (tree._right[:n] >= 0)
+        self.boxes = np.empty((4, 2 * n))
+        self.boxes[:, 0::2], self.boxes[:, 1::2] = own, full
+        self.live = np.empty(2 * n, dtype=np.int64)
+        self.live[0::2], self.live[1::2] = own_live, full_live
+        # half perimeter of the boxes, decides which side of a pair splits
+        self.extent = (self.boxes[1] - self.boxes[0] +
+                       self.boxes[3] - self.boxes[2])
+        self.own = 2 * np.arange(n)
+        self.left = np.where(tree._left[:n] >= 0, 2 * tree._left[:n] +
+                             inner[np.maximum(tree._left[:n], 0)], -1)
+        self.right = np.where(tree._right[:n] >= 0, 2 * tree._right[:n] +
+                              inner[np.maximum(tree._right[:n], 0)], -1)
+        self.root = 2 * tree._root + inner[tree._root] if tree._root >= 0 \
+            else -1
+
+    def box_dists(
+            self,
+            x: np.ndarray,
+            y: np.ndarray,
+            codes: np.ndarray) -> np.ndarray:
+        """Distances from points to the boxes of entities."""
+        box = self.boxes[:, codes]
+        dx = np.maximum(np.maximum(box[0] - x, x - box[1]), 0.0)
+        dy = np.maximum(np.maximum(box[2] - y, y - box[3]), 0.0)
+
+        return np.sqrt(dx * dx + dy * dy)
+
+    def split(self, codes: np.ndarray) -> np.ndarray:
+        """Entities below a set of subtree entities: own points, left and
+        right subtrees.
+        ------------------------------------------------------------------------
+        Args:
+            codes: (k,)-shape array of subtree entity codes
+        Returns:
+            parts: (k, 3)-shape array of entity codes, -1 for no entity"""
+        slots = codes // 2
+
+        return np.stack((self.own[slots], self.left[slots],
+                         self.right[slots]), axis=1)
+
+
+def _scan(tree, xq, yq, qid, slots, dists, indices, exclude_self: bool):
+    """Updates in place the best distances and indices of query points with
+    the own points of reference nodes, one node per query entry. Each entry's
+    nearest point is found with reductions over its run of points, so only
+    one candidate per entry is scattered into the results.
+    ----------------------------------------------------------------------------
+    Args:
+        tree: reference Tree
+        xq, yq: (k,)-shape arrays of query coords
+        qid: (k,)-shape array of query ids
+        slots: (k,)-shape array of reference node slots
+        dists: nearest distances by query id
+        indices: nearest indices by query id
+        exclude_self: skip reference points with the query's id"""
+    size = np.maximum(tree._bucket[slots], 1)
+    starts = np.cumsum(size) - size
+    run = np.repeat(np.arange(slots.shape[0]), size)
+    pi = np.repeat(slots, size) + (np.arange(run.shape[0]) -
+                                   np.repeat(starts, size))
+    d = Euclidean.dists(xq[run], yq[run], tree._x[pi], tree._y[pi])
+    index = tree._index[pi]
+    skip = index < 0 # tombstones
+    if exclude_self:
+        skip |= index == qid[run]
+    d[skip] = math.inf
+    dmin = np.minimum.reduceat(d, starts)
+    hit = d == np.repeat(dmin, size)
+    imin = np.minimum.reduceat(np.where(hit, index, np.iinfo(np.int64).max),
+                               starts)
+    ok = (dmin <= dists[qid]) & (dmin < math.inf)
+    update_best(dists, indices, qid[ok], dmin[ok], imin[ok])
+
+
+def _descend(tree, qtree, dists, indices, exclude_self: bool):
+    """Greedy descent of every live query point towards its leaf in the
+    reference tree. Scanning the leaf gives the initial nearest neighbor
+    bounds."""
+    n = qtree._size
+    slots = np.flatnonzero(qtree._index[:n] >= 0)
+    ids = qtree._index[slots]
+    xq, yq = qtree._x[slots], qtree._y[slots]
+    leaf = np.empty(slots.shape[0], dtype=np.int64)
+    q = np.arange(slots.shape[0])
+    i = np.full(q.shape[0], tree._root, dtype=np.int64)
+    while q.shape[0] > 0:
+        near_left = np.where(tree._split_x[i], xq[q] <= tree._x[i],
+                             yq[q] <= tree._y[i])
+        child = np.where(near_left, tree._left[i], tree._right[i])
+        end = child < 0
+        leaf[q[end]] = i[end]
+        q, i = q[~end], child[~end]
+    _scan(tree, xq, yq, ids, leaf, dists, indices, exclude_self)
+
+
+def _bounds(qtree, qboxes: _Boxes, dists: np.ndarray) -> np.ndarray:
+    """Largest current nearest distance among the query points of every
+    query entity, by entity code. Deleted query points need no answer and
+    do not count."""
+    n = qtree._size
+    index = qtree._index[:n]
+    own = np.where(index >= 0, dists[np.maximum(index, 0)], -math.inf)
+    starts = np.flatnonzero(qtree._bucket[:n] > 0)
+    if starts.shape[0] > 0:
+        keys, slots = _blocks(np.arange(starts.shape[0]), starts,
+                              qtree._bucket)
+        cuts = np.searchsorted(keys, np.arange(starts.shape[0]))
+        own[starts] = np.maximum.reduceat(own[slots], cuts)
+    full = own.copy()
+    for level in reversed(qboxes.levels):
+        for child in (qtree._left[level], qtree._right[level]):
+            has = child >= 0
+            full[level[has]] = np.maximum(full[level[has]], full[child[has]])
+
+    bounds = np.empty(2 * n)
+    bounds[0::2], bounds[1::2] = own, full
+    return bounds
+
+
+def _join(tree, qtree, exclude_self: bool) -> Tuple[np.ndarray]:
+    """Dual-tree nearest neighbor search of the live points of qtree among
+    the live points of tree.
+    ----------------------------------------------------------------------------
+    Args:
+        tree: reference Tree
+        qtree: query Tree
+        exclude_self: skip candidates with the query's own id, for joins of
+            a tree with itself
+    Returns:
+        dists: distances to the nearest neighbors, by query point id
+        indices: nearest neighbors' ids, -1 for ids without a live point or
+            without a neighbor"""
+    live = qtree._index[:qtree._size]
+    m = int(live.max()) + 1 if live.shape[0] > 0 and live.max() >= 0 else 0
+    dists = np.full(m, math.inf)
+    indices = np.full(m, np.iinfo(np.int64).max, dtype=np.int64)
+    if m > 0 and tree._root >= 0:
+        _descend(tree, qtree, dists, indices, exclude_self)
+        qboxes = _Boxes(qtree)
+        rboxes = qboxes if tree is qtree else _Boxes(tree)
+        # a reference entity with a live point other than the query's bounds
+        # its nearest distance by the largest distance between the boxes
+        min_live = 2 if exclude_self else 1
+        reach = np.full(qboxes.boxes.shape[1], math.inf)
+        stale = True
+        qe = np.array([qboxes.root], dtype=np.int64)
+        re = np.array([rboxes.root], dtype=np.int64)
+        while qe.shape[0] > 0:
+            qb, rb = qboxes.boxes[:, qe], rboxes.boxes[:, re]
+            dx = np.maximum(qb[1] - rb[0], rb[1] - qb[0])
+            dy = np.maximum(qb[3] - rb[2], rb[3] - qb[2])
+            far = np.where(rboxes.live[re] >= min_live,
+                           np.sqrt(dx * dx + dy * dy), math.inf)
+            np.minimum.at(reach, qe, far)
+            # prune pairs whose boxes are farther than the query bound, pairs
+            # as far as the bound may hold a lower index
+            if stale: # nearest distances changed in the last round
+                within = _bounds(qtree, qboxes, dists)
+                stale = False
+            bounds = np.minimum(within, reach)
+            dx = np.maximum(np.maximum(qb[0] - rb[1], rb[0] - qb[1]), 0.0)
+            dy = np.maximum(np.maximum(qb[2] - rb[3], rb[2] - qb[3]), 0.0)
+            keep = np.sqrt(dx * dx + dy * dy) <= bounds[qe]
+            qe, re = qe[keep], re[keep]
+
+            # own points against own points are evaluated directly, for the
+            # query points whose bound reaches the reference box
+            base = (qe % 2 == 0) & (re % 2 == 0)
+            if base.any():
+                rs, qs = _blocks(re[base] // 2, qe[base] // 2, qtree._bucket)
+                qid = qtree._index[qs]
+                xq, yq = qtree._x[qs], qtree._y[qs]
+                live = qid >= 0
+                gap = rboxes.box_dists(xq[live], yq[live], 2 * rs[live])
+                live[live] = gap <= dists[qid[live]]
+                _scan(tree, xq[live], yq[live], qid[live], rs[live], dists,
+                      indices, exclude_self)
+                stale = True
+            qe, re = qe[~base], re[~base]
+
+            # split the side with the larger box, own points never split
+            split_q = (qe % 2 == 1) & ((re % 2 == 0) |
+                                       (qboxes.extent[qe] >= rboxes.extent[re]))
+            qe_split = qboxes.split(qe[split_q]).ravel()
+            re_split = np.repeat(re[split_q], 3)
+            # query entities inherit the reach of their parent subtree
+            has = qe_split >= 0
+            np.minimum.at(reach, qe_split[has],
+                          np.repeat(reach[qe[split_q]], 3)[has])
+            parts = rboxes.split(re[~split_q])
+            qe = np.concatenate((qe_split, np.repeat(qe[~split_q], 3)))
+            re = np.concatenate((re_split, parts.ravel()))
+            valid = (qe >= 0) & (re >= 0)
+            qe, re = qe[valid], re[valid]
+
+    indices[indices == np.iinfo(np.int64).max] = -1
+    return dists, indices
+
+
+def nearest_join(tree, queries) -> Tuple[np.ndarray]:
+    """Nearest reference point of every query point, by dual-tree traversal.
+    ----------------------------------------------------------------------------
+    Args:
+        tree: reference Tree
+        queries: (m, 2)-shape array of query coords, or a Tree over them,
+            which can be reused across joins
+    Returns:
+        dists: distances to the nearest neighbors, position j for query j
+            (for a query Tree, for its point with id j)
+        indices: nearest neighbors' indices, ties by lowest index, -1 for an
+            empty reference tree or ids without a live query point"""
+    if not isinstance(queries, type(tree)):
+        points = np.asarray(queries, dtype=float).reshape(-1, 2)
+        queries = type(tree)(points[:, 0], points[:, 1],
+                             leaf_size=QUERY_LEAF_SIZE)
+    _check_metric(tree, queries)
+
+    return _join(tree, queries, exclude_self=False)
+
+
+def all_nearest_neighbors(tree) -> Tuple[np.ndarray]:
+    """Nearest other point of every point of a tree.
+    ----------------------------------------------------------------------------
+    Args:
+        tree: Tree over the point set
+    Returns:
+        dists: distances to the nearest other points, by point id
+        indices: nearest other points' ids, ties by lowest id, -1 for ids
+            without a live point and for a single point"""
+    _check_metric(tree)
+    return _join(tree, tree, exclude_self=True)
+
+
+def closest_pair(tree) -> Tuple[float, int, int]:
+    """Closest pair of distinct points of a tree.
+    ----------------------------------------------------------------------------
+    Args:
+        tree: Tree over the point set
+    Returns:
+        dist: distance between the pair, inf with fewer than two points
+        i, j: ids of the pair with i < j, the lowest (i, j) among ties, -1
+            with fewer than two points"""
+    dists, indices = all_nearest_neighbors(tree)
+    ids = np.flatnonzero(indices >= 0)
+    if ids.shape[0] == 0:
+        return math.inf, -1, -1
+    lo = np.minimum(ids, indices[ids])
+    hi = np.maximum(ids, indices[ids])
+    best = np.lexsort((hi, lo, dists[ids]))[0]
+
+    return float(dists[ids[best]]), int(lo[best]), int(hi[best])
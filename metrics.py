@@ -0,0 +1,215 @@
+"""Distance metrics for the trees.
+
+A metric provides four kernels over (x, y) coords: the distance between two
+points, the same distance vectorized over arrays, and a lower bound on the
+distance from a point to an axis-aligned rectangle (xmin, xmax, ymin, ymax),
+scalar and vectorized. The vp-tree only needs distances; the 2d-tree prunes
+its regions with the rectangle bounds. Vectorized kernels take an optional out
+array and compute in place into it and a single scratch array.
+
+Euclidean is the plane metric over projected coords. Haversine is the great
+circle distance in km over (lon, lat) degrees, so data needs no projection.
+Metrics are referred to by name in saved indexes, see METRICS."""
+import math
+import numpy as np
+from typing import Tuple
+
+EARTH_RADIUS = 6371.0 # km
+# relative slack on haversine rectangle bounds, so that rounding errors do
+# not prune regions holding points tied with the current candidates
+TOL = 1e-9
+
+
+class Euclidean:
+    """Plane distance between (x, y) points. Distances are computed as
+    sqrt(dx * dx + dy * dy), whose steps are correctly rounded both in Python
+    and in NumPy, so scalar and vectorized kernels agree to the last bit and
+    ties break the same way whichever kernel found them."""
+    name = 'euclidean'
+
+    @staticmethod
+    def dist(x1: float, y1: float, x2: float, y2: float) -> float:
+        dx, dy = x1 - x2, y1 - y2
+        return math.sqrt(dx * dx + dy * dy)
+
+    @staticmethod
+    def dists(
+            x1: np.ndarray,
+            y1: np.ndarray,
+            x2: np.ndarray,
+            y2: np.ndarray,
+            out: np.ndarray = None) -> np.ndarray:
+        """Vectorized distances between broadcast point arrays.
+        ------------------------------------------------------------------------
+        Args:
+            x1, y1: coords of the first points
+            x2, y2: coords of the second points
+            out: optional output array of the broadcast shape
+        Returns:
+            d: array of distances"""
+        out = np.subtract(x1, x2, out=out)
+        np.multiply(out, out, out=out)
+        tmp = np.subtract(y1, y2)
+        np.multiply(tmp, tmp, out=tmp)
+        np.add(out, tmp, out=out)
+
+        return np.sqrt(out, out=out)
+
+    @staticmethod
+    def rect_dist(x: float, y: float, bounds: Tuple[float]) -> float:
+        """Distance from a point to a rectangle, zero inside it.
+        ------------------------------------------------------------------------
+        Args:
+            x, y: point coords
+            bounds: (4,)-tuple with the rectangle (xmin, xmax, ymin, ymax)
+        Returns:
+            d: minimum distance from the point to the rectangle"""
+        xmin, xmax, ymin, ymax = bounds
+        # distance to [xmin, xmax] and [ymin, ymax], zero if inside interval
+        dx = max(xmin - x, 0.0, x - xmax)
+        dy = max(ymin - y, 0.0, y - ymax)
+
+        return math.sqrt(dx * dx + dy * dy)
+
+    @staticmethod
+    def rect_dists(
+            x: np.ndarray,
+            y: np.ndarray,
+            xmin: np.ndarray,
+            xmax: np.ndarray,
+            ymin: np.ndarray,
+            ymax: np.ndarray) -> np.ndarray:
+        """Vectorized rect_dist over arrays of points and rectangles."""
+        dx = np.maximum(np.maximum(xmin - x, 0.0), x - xmax)
+        dy = np.maximum(np.maximum(ymin - y, 0.0), y - ymax)
+        return np.sqrt(dx * dx + dy * dy)
+
+
+class Haversine:
+    """Great circle distance in km between (lon, lat) points in degrees."""
+    name = 'haversine'
+
+    @staticmethod
+    def dist(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+        lat1, lat2 = math.radians(lat1), math.radians(lat2)
+        h = math.sin(0.5 * (lat2 - lat1))**2 + math.cos(lat1) * \
+            math.cos(lat2) * math.sin(0.5 * math.radians(lon2 - lon1))**2
+
+        return 2.0 * EARTH_RADIUS * math.asin(math.sqrt(min(h, 1.0)))
+
+    @staticmethod
+    def dists(
+            lon1: np.ndarray,
+            lat1: np.ndarray,
+            lon2: np.ndarray,
+            lat2: np.ndarray,
+            out: np.ndarray = None) -> np.ndarray:
+        """Vectorized distances between broadcast point arrays, see
+        Euclidean.dists."""
+        rad = math.pi / 180.0
+        # out holds the longitude term, tmp the latitude one
+        out = np.subtract(lon2, lon1, out=out)
+        np.multiply(out, 0.5 * rad, out=out)
+        np.sin(out, out=out)
+        np.square(out, out=out)
+        tmp = np.multiply(lat1, rad, out=np.empty_like(out))
+        np.cos(tmp, out=tmp)
+        np.multiply(out, tmp, out=out)
+        np.multiply(lat2, rad, out=tmp)
+        np.cos(tmp, out=tmp)
+        np.multiply(out, tmp, out=out)
+        np.subtract(lat2, lat1, out=tmp)
+        np.multiply(tmp, 0.5 * rad, out=tmp)
+        np.sin(tmp, out=tmp)
+        np.square(tmp, out=tmp)
+        np.add(out, tmp, out=out)
+        np.minimum(out, 1.0, out=out)
+        np.sqrt(out, out=out)
+        np.arcsin(out, out=out)
+
+        return np.multiply(out, 2.0 * EARTH_RADIUS, out=out)
+
+    def rect_dist(self, lon: float, lat: float,
+                  bounds: Tuple[float]) -> float:
+        """Great circle distance from a point to a lon/lat rectangle, zero
+        inside it. If the point's longitude is within the rectangle's, the
+        nearest point is on its meridian. Otherwise distance grows with the
+        longitude difference at any latitude, so the nearest point is on the
+        edge meridian closest in longitude, either at a corner or where the
+        great circle distance to the meridian is stationary, at latitude
+        atan(tan(lat) / cos(dlon)).
+        ------------------------------------------------------------------------
+        Args:
+            lon, lat: point coords in degrees
+            bounds: (4,)-tuple with the rectangle (lonmin, lonmax, latmin,
+                latmax), possibly unbounded
+        Returns:
+            d: lower bound on the distance from the point to the rectangle"""
+        xmin, xmax, ymin, ymax = bounds
+        xmin, xmax = max(xmin, -180.0), min(xmax, 180.0)
+        ymin, ymax = max(ymin, -90.0), min(ymax, 90.0)
+        if xmin <= lon <= xmax:
+            gap = max(ymin - lat, 0.0, lat - ymax)
+            return EARTH_RADIUS * math.radians(gap) * (1.0 - TOL)
+
+        # longitude differences east to xmin and west to xmax
+        east, west = (xmin - lon) % 360.0, (lon - xmax) % 360.0
+        edge, dlon = (xmin, east) if east <= west else (xmax, west)
+        d = min(self.dist(lon, lat, edge, ymin),
+                self.dist(lon, lat, edge, ymax))
+        if dlon < 90.0: # the stationary point is the nearest on the meridian
+            stationary = math.degrees(math.atan(
+                math.tan(math.radians(lat)) / math.cos(math.radians(dlon))))
+            if ymin < stationary < ymax:
+                d = min(d, self.dist(lon, lat, edge, stationary))
+
+        return d * (1.0 - TOL)
+
+    def rect_dists(
+            self,
+            lon: np.ndarray,
+            lat: np.ndarray,
+            xmin: np.ndarray,
+            xmax: np.ndarray,
+            ymin: np.ndarray,
+            ymax: np.ndarray) -> np.ndarray:
+        """Vectorized rect_dist over arrays of points and rectangles."""
+        xmin, xmax = np.maximum(xmin, -180.0), np.minimum(xmax, 180.0)
+        ymin, ymax = np.maximum(ymin, -90.0), np.minimum(ymax, 90.0)
+        inside = (xmin <= lon) & (lon <= xmax)
+        gap = np.maximum(np.maximum(ymin - lat, 0.0), lat - ymax)
+
+        east, west = np.mod(xmin - lon, 360.0), np.mod(lon - xmax, 360.0)
+        edge = np.where(east <= west, xmin, xmax)
+        dlon = np.minimum(east, west)
+        d = np.minimum(self.dists(lon, lat, edge, ymin),
+                       self.dists(lon, lat, edge, ymax))
+        with np.errstate(divide='ignore'):
+            stationary = np.degrees(np.arctan(
+                np.tan(np.radians(lat)) / np.cos(np.radians(dlon))))
+        mid = (dlon < 90.0) & (ymin < stationary) & (stationary < ymax)
+        d[mid] = np.minimum(d[mid], self.dists(lon[mid], lat[mid], edge[mid],
+                                               stationary[mid]))
+        d = np.where(inside, EARTH_RADIUS * np.radians(gap), d)
+
+        return np.multiply(d, 1.0 - TOL, out=d)
+
+
+# metrics by name, indexes store the name of theirs
+METRICS = {'euclidean': Euclidean(), 'haversine': Haversine()}
+
+
+def get_metric(metric):
+    """Resolves a metric name, metric objects are returned unchanged.
+    ----------------------------------------------------------------------------
+    Args:
+        metric: name in METRICS or metric object
+    Returns:
+        metric: metric object"""
+    if isinstance(metric, str):
+        if metric not in METRICS:
+            raise ValueError(f"unknown metric {metric}, expected one of "
+                             f"{', '.join(METRICS)}")
+        return METRICS[metric]
+
+    return metric
@@ -0,0 +1,357 @@
+"""Multi-way vantage point tree.
+
+Each node splits the points of its range into m shells by distance to its
+vantage point, m - 1 radii instead of the single mu of VpTree. A node holds
+one point, so nodes are stored in preorder in flat arrays like VpTree: node k
+covers a range of a permutation of point indices starting at k. Children are
+linked as first child and next sibling slots, and every child stores the
+smallest and largest distance from its parent's vantage point to the points of
+its shell, so memory does not depend on m. A search at distance d from a
+vantage point skips a shell [lo, hi] unless max(lo - d, d - hi) is within the
+current search radius, by the triangle inequality. See the README for the
+trade-off between m and search cost."""
+import math
+import numpy as np
+from typing import List, Tuple
+
+from metrics import get_metric
+from neighbors import knn_each, push_bounded, sorted_heap
+from storage import read_index, write_index
+from vptree import (SMALL_RANGE, TOL, pick_vantage_point, sort_small_range,
+                    vantage_draws)
+
+
+class MVpTree:
+    def __init__(self, datapoints, m: int = 4, metric: str = 'euclidean'):
+        """Builds an m-ary vp-tree over a sequence of 2d-points. Vantage points
+        are drawn from numpy's global random state.
+        ------------------------------------------------------------------------
+        Args:
+            datapoints: sequence of (2,)-shape points, (lon, lat) for
+                haversine
+            m: number of shells per node, at least 2
+            metric: metric name or object, see metrics.py"""
+        if m < 2:
+            raise ValueError(f"m must be at least 2, got {m}")
+        self._points = np.asarray(datapoints, dtype=float).reshape(-1, 2)
+        n = self._points.shape[0]
+        self.m = m
+        self._vp = np.arange(n) # permutation, slot k holds node k's vp
+        self._child = np.full(n, -1, dtype=np.int32) # first child slot
+        self._sibling = np.full(n, -1, dtype=np.int32) # next sibling slot
+        # distance range from the parent's vp to the points of the shell
+        self._lo, self._hi = np.zeros(n), np.zeros(n)
+        self.visits = 0 # nodes visited by the last search
+        self.version = 0 # vp-trees are static, it never changes
+        # (lon_mean, lat_mean) used to project the input coords, if any
+        self.projection = None
+        self.metric = get_metric(metric)
+        self._root = self.__build(n)
+
+    def __len__(self) -> int:
+        return self._points.shape[0]
+
+    @property
+    def points(self) -> np.ndarray:
+        """(n, 2)-shape array of the indexed points in input order.
+        ------------------------------------------------------------------------
+        """
+        return self._points
+
+    def _state(self) -> Tuple[dict]:
+        """Point and node arrays and scalar attributes that fully describe the
+        tree, used to save it and to share it with other processes.
+        ------------------------------------------------------------------------
+        Returns:
+            arrays: named arrays
+            attrs: JSON serializable scalar attributes"""
+        arrays = {'points': self._points, 'vp': self._vp,
+                  'child': self._child, 'sibling': self._sibling,
+                  'lo': self._lo, 'hi': self._hi}
+        attrs = {'root': int(self._root), 'm': self.m,
+                 'projection': self.projection, 'metric': self.metric.name}
+        return arrays, attrs
+
+    @classmethod
+    def _from_state(cls, arrays: dict, attrs: dict) -> 'MVpTree':
+        """Wraps arrays returned by _state into a tree, without copying them.
+        ------------------------------------------------------------------------
+        Args:
+            arrays: named arrays
+            attrs: scalar attributes
+        Returns:
+            tree: MVpTree using the given arrays"""
+        tree = cls.__new__(cls)
+        tree._points, tree._vp = arrays['points'], arrays['vp']
+        tree._child, tree._sibling = arrays['child'], arrays['sibling']
+        tree._lo, tree._hi = arrays['lo'], arrays['hi']
+        tree._root, tree.m = attrs['root'], attrs['m']
+        tree.visits = tree.version = 0
+        projection = attrs['projection']
+        tree.projection = tuple(projection) if projection else None
+        tree.metric = get_metric(attrs['metric'])
+
+        return tree
+
+    def coords(self, ids: np.ndarray) -> Tuple[np.ndarray]:
+        """Looks up the coords of points by index.
+        ------------------------------------------------------------------------
+        Args:
+            ids: array of point indices
+        Returns:
+            xs, ys: arrays of the points' coords"""
+        points = self._points[np.asarray(ids, dtype=np.int64)]
+        return points[:, 0], points[:, 1]
+
+    def save(self, path: str):
+        """Writes the points and node arrays to a binary index file, see
+        storage.py.
+        ------------------------------------------------------------------------
+        Args:
+            path: output file path"""
+        write_index(path, 'mvptree', *self._state())
+
+    @classmethod
+    def load(
+            cls,
+            path: str,
+            mmap: bool = True,
+            verify: bool = None) -> 'MVpTree':
+        """Loads a tree written by save, see VpTree.load.
+        ------------------------------------------------------------------------
+        Args:
+            path: input file path
+            mmap: map the file instead of reading it into memory
+            verify: check the data checksum, by default only when not mapping
+        Returns:
+            tree: loaded MVpTree"""
+        return cls._from_state(*read_index(path, 'mvptree', mmap, verify))
+
+    def __build(self, n: int) -> int:
+        """Iterative building method, with pending index ranges kept in an
+        explicit stack. At each node, distances from the vantage point to the
+        rest of the range are computed at once and the range is partitioned
+        into m shells of nearly equal sizes with a multi-pivot argpartition.
+        ------------------------------------------------------------------------
+        Args:
+            n: number of points
+        Returns:
+            root: slot of the root node, -1 if there are no points"""
+        xs, ys = self._points[:, 0], self._points[:, 1]
+        dist, perm, m = self.metric.dist, self._vp, self.m
+        draws = vantage_draws(n)
+        stack = [(0, n)] if n > 0 else []
+        while stack:
+            low_idx, up_idx = stack.pop()
+            size = up_idx - low_idx
+            if size == 1: # leaf
+                continue
+
+            vp = pick_vantage_point(perm, low_idx, size, draws[low_idx])
+            rest = perm[low_idx + 1:up_idx]
+            # shell j holds sorted positions [bounds[j], bounds[j + 1])
+            shells = min(m, size - 1)
+            bounds = [(size - 1) * j // shells for j in range(shells + 1)]
+            if size <= SMALL_RANGE:
+                dists = sort_small_range(dist, xs, ys, perm, low_idx, up_idx)
+                lo = [dists[b] for b in bounds[:-1]]
+                hi = [dists[b - 1] for b in bounds[1:]]
+            else:
+                dists = self.metric.dists(xs[vp], ys[vp], xs[rest], ys[rest])
+                order = dists.argpartition(bounds[1:-1]) if shells > 1 else \
+                    np.arange(size - 1)
+                rest[:] = rest[order]
+                dists = dists[order]
+                lo = np.minimum.reduceat(dists, bounds[:-1]).tolist()
+                hi = np.maximum.reduceat(dists, bounds[:-1]).tolist()
+
+            # link the shells' subtrees, each starting at its range's slot
+            prev = -1
+            for j in range(shells):
+                child = low_idx + 1 + bounds[j]
+                self._lo[child], self._hi[child] = lo[j], hi[j]
+                if prev < 0:
+                    self._child[low_idx] = child
+                else:
+                    self._sibling[prev] = child
+                prev = child
+                stack.append((child, low_idx + 1 + bounds[j + 1]))
+
+        return 0 if n > 0 else -1
+
+    def __vp_distance(self, query: Tuple[float], slot: int) -> float:
+        """Distance from query to the vantage point of a node."""
+        v = self._vp.item(slot)
+        return self.metric.dist(query[0], query[1], self._points.item(v, 0),
+                                self._points.item(v, 1))
+
+    def __push_children(self, stack: List[Tuple], slot: int, d: float):
+        """Pushes a node's children along with lower bounds on the distance
+        from the query to their points, max(lo - d, d - hi) for a shell
+        [lo, hi], so that the nearest shells are popped first.
+        ------------------------------------------------------------------------
+        Args:
+            stack: pending (slot, lower bound) pairs
+            slot: node slot
+            d: distance from query to node's vp"""
+        children = []
+        child = self._child.item(slot)
+        while child >= 0:
+            lo, hi = self._lo.item(child), self._hi.item(child)
+            gap = max(lo - d, d - hi) - TOL * (d + hi)
+            children.append((gap, child))
+            child = self._sibling.item(child)
+        children.sort(reverse=True)
+        stack.extend((child, gap) for gap, child in children)
+
+    def nearest_neighbor(self, query: List[float]) -> Tuple[float, int]:
+        """Finds the nearest neighbor of a query point, ties by lowest index.
+        The result is a (dist, index) pair, as for GridIndex and QueryCache:
+        this tree has no node views to return. Tree.nearest_neighbor returns
+        (dist, node view) and VpTree.nearest_neighbor (node view, dist), kept
+        from their original interfaces.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords
+        Returns:
+            dist: distance from query to its nearest neighbor
+            index: nearest neighbor's index, -1 for an empty tree"""
+        query = (float(query[0]), float(query[1]))
+        tau, nn, visits = math.inf, -1, 0
+        # pending subtrees as (slot, lower bound on distance to its points)
+        stack = [(self._root, -math.inf)] if self._root >= 0 else []
+        while stack:
+            slot, gap = stack.pop()
+            if gap > tau: # shell does not intersect the ball of radius tau
+                continue
+
+            visits += 1
+            d = self.__vp_distance(query, slot)
+            index = self._vp.item(slot)
+            if d < tau or (d == tau and index < nn):
+                tau, nn = d, index
+            self.__push_children(stack, slot, d)
+
+        self.visits = visits
+        return tau, nn
+
+    def query(self, points: np.ndarray) -> Tuple[np.ndarray]:
+        """Batch nearest neighbor search, with the same outputs as Tree.query.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+        Returns:
+            dists: (m,)-shape array of distances to the nearest neighbors
+            indices: (m,)-shape array with the nearest neighbors' indices in
+                the input points, -1 for an empty tree"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        dists = np.empty(points.shape[0])
+        indices = np.empty(points.shape[0], dtype=np.int64)
+        for j, query in enumerate(points.tolist()):
+            dists[j], indices[j] = self.nearest_neighbor(query)
+
+        return dists, indices
+
+    def parallel_query(
+            self,
+            points: np.ndarray,
+            workers: int = None) -> Tuple[np.ndarray]:
+        """Batch nearest neighbor search split across worker processes that
+        share the node arrays through shared memory, see parallel.py.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            workers: number of worker processes, defaults to the CPU count
+        Returns:
+            dists: (m,)-shape array of distances to the nearest neighbors
+            indices: (m,)-shape array of the nearest neighbors' indices"""
+        import parallel # loads multiprocessing, only when needed
+        return parallel.parallel_query(self, points, workers)
+
+    def knn(self, query: List[float], k: int) -> Tuple[np.ndarray]:
+        """Finds the k nearest neighbors of a query point, with the k-th
+        candidate distance as search radius. Results are sorted by distance,
+        ties by index.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords
+            k: number of neighbors
+        Returns:
+            dists: (min(k, n),)-shape array of sorted distances
+            indices: (min(k, n),)-shape array of neighbors' indices"""
+        if k < 1:
+            raise ValueError(f"k must be positive, got {k}")
+        query = (float(query[0]), float(query[1]))
+        heap, visits = [], 0 # max-heap of (-dist, -index) pairs
+        stack = [(self._root, -math.inf)] if self._root >= 0 else []
+        while stack:
+            slot, gap = stack.pop()
+            # tau is the k-th candidate distance, ties may hold a lower index
+            if len(heap) == k and gap > -heap[0][0]:
+                continue
+
+            visits += 1
+            d = self.__vp_distance(query, slot)
+            push_bounded(heap, k, d, self._vp.item(slot))
+            self.__push_children(stack, slot, d)
+
+        self.visits = visits
+        return sorted_heap(heap)
+
+    def knn_batch(self, points: np.ndarray, k: int) -> Tuple[np.ndarray]:
+        """Batch k nearest neighbors search.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            k: number of neighbors
+        Returns:
+            dists: (m, min(k, n))-shape array of sorted distances
+            indices: (m, min(k, n))-shape array of neighbors' indices"""
+        return knn_each(self.knn, points, k, len(self))
+
+    def query_radius(self, query: List[float], r: float) -> Tuple[np.ndarray]:
+        """Finds all points within distance r of a query point, skipping the
+        shells that do not intersect the query ball. Results are sorted by
+        distance, ties by index.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords
+            r: search radius
+        Returns:
+            dists: array of sorted distances
+            indices: array of indices of the points within the radius"""
+        query = (float(query[0]), float(query[1]))
+        hits, visits = [], 0 # (dist, index) pairs
+        stack = [(self._root, -math.inf)] if self._root >= 0 else []
+        while stack:
+            slot, gap = stack.pop()
+            if gap > r:
+                continue
+
+            visits += 1
+            d = self.__vp_distance(query, slot)
+            if d <= r:
+                hits.append((d, self._vp.item(slot)))
+            self.__push_children(stack, slot, d)
+
+        self.visits = visits
+        hits.sort()
+        dists = np.array([d for d, _ in hits], dtype=float)
+        indices = np.array([i for _, i in hits], dtype=np.int64)
+
+        return dists, indices
+
+    def query_radius_batch(
+            self,
+            points: np.ndarray,
+            r: float) -> List[Tuple[np.ndarray]]:
+        """Batch radius search.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            r: search radius
+        Returns:
+            results: list with a (dists, indices) pair of sorted arrays for
+                each query"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return [self.query_radius(query, r) for query in points]
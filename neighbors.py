@@ -0,0 +1,104 @@
+"""Helpers shared by the nearest neighbor, k nearest neighbors and radius
+searches of the spatial indexes and joins."""
+import heapq
+import numpy as np
+from typing import List, Tuple
+
+
+def push_bounded(heap: List[Tuple], k: int, d: float, index: int):
+    """Pushes a candidate into a max-heap bounded to k items, ordered by
+    distance and then by index.
+    ----------------------------------------------------------------------------
+    Args:
+        heap: max-heap of (-dist, -index) pairs
+        k: heap capacity
+        d: candidate distance
+        index: candidate index"""
+    if len(heap) < k:
+        heapq.heappush(heap, (-d, -index))
+    elif (d, index) < (-heap[0][0], -heap[0][1]):
+        heapq.heapreplace(heap, (-d, -index))
+
+
+def sorted_heap(heap: List[Tuple]) -> Tuple[np.ndarray]:
+    """Converts a bounded max-heap into sorted distance and index arrays.
+    ----------------------------------------------------------------------------
+    Args:
+        heap: max-heap of (-dist, -index) pairs
+    Returns:
+        dists: sorted distances
+        indices: indices matching dists"""
+    items = sorted((-d, -index) for d, index in heap)
+    dists = np.array([d for d, _ in items], dtype=float)
+    indices = np.array([index for _, index in items], dtype=np.int64)
+
+    return dists, indices
+
+
+def group_hits(
+        m: int,
+        q: np.ndarray,
+        d: np.ndarray,
+        indices: np.ndarray) -> List[Tuple[np.ndarray]]:
+    """Splits (query, distance, index) hits into per-query arrays sorted by
+    distance and then by index.
+    ----------------------------------------------------------------------------
+    Args:
+        m: number of queries
+        q: query position of each hit
+        d: distance of each hit
+        indices: point index of each hit
+    Returns:
+        results: list with a (dists, indices) pair for each query"""
+    order = np.lexsort((indices, d, q))
+    q, d, indices = q[order], d[order], indices[order]
+    cuts = np.searchsorted(q, np.arange(m + 1))
+
+    return [(d[cuts[j]:cuts[j+1]], indices[cuts[j]:cuts[j+1]])
+            for j in range(m)]
+
+
+def knn_each(knn, points: np.ndarray, k: int, n: int) -> Tuple[np.ndarray]:
+    """Batch k nearest neighbors search with one single-point search per
+    query.
+    ----------------------------------------------------------------------------
+    Args:
+        knn: single-point search, knn(query, k) -> (dists, indices)
+        points: (m, 2)-shape array of query coords
+        k: number of neighbors
+        n: number of indexed points
+    Returns:
+        dists: (m, min(k, n))-shape array of sorted distances
+        indices: (m, min(k, n))-shape array of neighbors' indices"""
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    k_eff = min(k, n)
+    dists = np.empty((points.shape[0], k_eff))
+    indices = np.empty((points.shape[0], k_eff), dtype=np.int64)
+    for j, query in enumerate(points):
+        dists[j], indices[j] = knn(query, k)
+
+    return dists, indices
+
+
+def update_best(
+        dists: np.ndarray,
+        indices: np.ndarray,
+        q: np.ndarray,
+        d: np.ndarray,
+        ids: np.ndarray):
+    """Updates in place the best distances and indices of a batch of queries
+    with a set of candidates. A query may get more than one candidate; among
+    equally distant candidates the lowest index is kept.
+    ----------------------------------------------------------------------------
+    Args:
+        dists: (m,)-shape array of current nearest distances
+        indices: (m,)-shape array of current nearest indices
+        q: (k,)-shape array of query positions
+        d: (k,)-shape array of candidate distances
+        ids: (k,)-shape array of candidate indices"""
+    prev = dists[q]
+    np.minimum.at(dists, q, d)
+    # forget indices of queries whose nearest distance strictly improved
+    indices[q[dists[q] < prev]] = np.iinfo(np.int64).max
+    hit = d == dists[q]
+    np.minimum.at(indices, q[hit], ids[hit])
@@ -0,0 +1,146 @@
+"""Multi-process batch nearest neighbor queries over a shared-memory index.
+
+The node arrays of a tree are copied once into a multiprocessing shared memory
+block. Pool workers attach to it when they start and wrap it into a tree of
+their own without copying, so tasks only carry chunk bounds. Query points and
+results live in a second shared block per batch: each worker answers a slice
+of the queries and writes its results in place, which keeps them in order."""
+import math
+import multiprocessing as mp
+import numpy as np
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Tuple
+
+ALIGN = 64 # array offsets inside a shared block are multiples of ALIGN
+
+# worker process state, set by _init_worker
+_shm = None
+_index = None
+
+
+def _layout(arrays: Dict[str, Tuple]) -> Tuple[List[Tuple], int]:
+    """Places arrays one after the other in a block, aligned to ALIGN bytes.
+    ----------------------------------------------------------------------------
+    Args:
+        arrays: (dtype, shape) pairs by name
+    Returns:
+        spec: (name, dtype, shape, offset) tuples
+        size: block size in bytes"""
+    spec, offset = [], 0
+    for name, (dtype, shape) in arrays.items():
+        offset = -(-offset // ALIGN) * ALIGN
+        spec.append((name, np.dtype(dtype).str, tuple(shape), offset))
+        offset += np.dtype(dtype).itemsize * math.prod(shape)
+
+    return spec, max(offset, 1) # zero sized blocks are not allowed
+
+
+def _views(shm: SharedMemory, spec: List[Tuple]) -> Dict[str, np.ndarray]:
+    return {name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            for name, dtype, shape, offset in spec}
+
+
+def _init_worker(name: str, spec: List[Tuple], cls: type, attrs: dict):
+    """Pool initializer, attaches the shared index once per worker."""
+    global _index, _shm
+    _shm = SharedMemory(name=name)
+    arrays = _views(_shm, spec)
+    for a in arrays.values():
+        a.flags.writeable = False
+    _index = cls._from_state(arrays, attrs)
+
+
+def _query_chunk(task: Tuple):
+    """Answers queries [start, stop) of a batch block, in place."""
+    name, spec, start, stop = task
+    shm = SharedMemory(name=name)
+    batch = _views(shm, spec)
+    batch['dists'][start:stop], batch['indices'][start:stop] = \
+        _index.query(batch['points'][start:stop])
+    del batch # views must be released before closing the block
+    shm.close()
+
+
+class QueryPool:
+    def __init__(self, index, workers: int = None):
+        """Copies an index into shared memory and starts a pool of workers
+        attached to it. The pool can answer many batches; close it, or use it
+        as a context manager, to stop the workers and free the shared memory.
+        ------------------------------------------------------------------------
+        Args:
+            index: Tree or VpTree
+            workers: number of worker processes, defaults to the CPU count"""
+        self.workers = workers or mp.cpu_count()
+        arrays, attrs = index._state()
+        spec, size = _layout({name: (a.dtype, a.shape)
+                              for name, a in arrays.items()})
+        self._shm = SharedMemory(create=True, size=size)
+        for name, a in _views(self._shm, spec).items():
+            a[...] = arrays[name]
+        self._pool = mp.Pool(self.workers, initializer=_init_worker,
+                             initargs=(self._shm.name, spec, type(index),
+                                       attrs))
+
+    def query(
+            self,
+            points: np.ndarray,
+            chunk_size: int = None) -> Tuple[np.ndarray]:
+        """Batch nearest neighbor search split across the workers, with the
+        same outputs as the index's query method.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            chunk_size: queries per task, defaults to four tasks per worker
+        Returns:
+            dists: (m,)-shape array of distances to the nearest neighbors
+            indices: (m,)-shape array of the nearest neighbors' indices"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        m = points.shape[0]
+        chunk_size = chunk_size or max(1, -(-m // (4 * self.workers)))
+        spec, size = _layout({'points': (np.float64, (m, 2)),
+                              'dists': (np.float64, (m,)),
+                              'indices': (np.int64, (m,))})
+        shm = SharedMemory(create=True, size=size)
+        try:
+            batch = _views(shm, spec)
+            batch['points'][...] = points
+            tasks = [(shm.name, spec, start, min(start + chunk_size, m))
+                     for start in range(0, m, chunk_size)]
+            self._pool.map(_query_chunk, tasks)
+            dists, indices = batch['dists'].copy(), batch['indices'].copy()
+        finally:
+            batch = None # views must be released before closing the block
+            shm.close()
+            shm.unlink()
+
+        return dists, indices
+
+    def close(self):
+        """Stops the workers and frees the shared index."""
+        self._pool.close()
+        self._pool.join()
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self) -> 'QueryPool':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parallel_query(index, points: np.ndarray, workers: int = None):
+    """One-off parallel batch nearest neighbor search. Use a QueryPool to
+    share the index once for several batches.
+    ----------------------------------------------------------------------------
+    Args:
+        index: Tree or VpTree
+        points: (m, 2)-shape array of query coords
+        workers: number of worker processes, defaults to the CPU count
+    Returns:
+        dists: (m,)-shape array of distances to the nearest neighbors
+        indices: (m,)-shape array of the nearest neighbors' indices"""
+    if workers == 1:
+        return index.query(points)
+    with QueryPool(index, workers) as pool:
+        return pool.query(points)
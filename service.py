@@ -0,0 +1,170 @@
+"""Asyncio front-end that micro-batches single-point nearest neighbor requests.
+
+An async service awaiting one blocking nearest_neighbor call per request
+either stalls its event loop or pays a thread hop per request. AsyncIndex
+queues concurrent requests instead and answers them together: a batch is
+sent as soon as it holds max_batch requests, or max_wait_us microseconds
+after its first request arrived. Each batch goes through one vectorized
+index.query call on a worker thread, off the event loop, and every request's
+future is resolved with its row of the results. Works with any index with a
+batch query method (Tree, VpTree, MVpTree, GridIndex, QueryCache).
+
+Batches read the index on worker threads while the event loop keeps running,
+so the index must not be updated directly while any batch is in flight,
+whatever the number of workers. Updates go through AsyncIndex.update (or
+insert and delete), which waits for the running batches, holds new ones back
+and applies the update on a worker thread."""
+import asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+
+class AsyncIndex:
+    def __init__(
+            self,
+            index,
+            max_batch: int = 256,
+            max_wait_us: float = 200.0,
+            workers: int = 1):
+        """Constructor method, to be called with the event loop running.
+        ------------------------------------------------------------------------
+        Args:
+            index: index with a query(points) -> (dists, indices) method
+            max_batch: largest number of requests per batch
+            max_wait_us: longest time a request waits for its batch to fill,
+                in microseconds
+            workers: threads running batches concurrently. Whatever their
+                number, update the index through update, insert or delete"""
+        if max_batch < 1:
+            raise ValueError(f"max_batch must be positive, got {max_batch}")
+        if max_wait_us < 0:
+            raise ValueError(f"max_wait_us must be non-negative, got "
+                             f"{max_wait_us}")
+        self.index = index
+        self.max_batch = max_batch
+        self.max_wait = max_wait_us * 1e-6
+        self._loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(workers)
+        self._pending = [] # (x, y, future) of the batch being filled
+        self._timer = None # flushes the pending batch after max_wait
+        self._running = set() # batches sent to the executor
+        self._update_lock = asyncio.Lock() # one update at a time
+        self._updating = False # holds new batches back during an update
+        self._closed = False
+        self.requests = self.batches = 0
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Counters since the wrapper was created.
+        ------------------------------------------------------------------------
+        """
+        return {'requests': self.requests, 'batches': self.batches,
+                'pending': len(self._pending),
+                'mean_batch': self.requests / self.batches if self.batches
+                else 0.0}
+
+    async def nearest_neighbor(self, query: List[float]) -> Tuple[float, int]:
+        """Finds the nearest neighbor of a query point as part of a batch.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords
+        Returns:
+            dist: distance from query to its nearest neighbor
+            index: nearest neighbor's index, -1 for an empty index"""
+        if self._closed:
+            raise RuntimeError("AsyncIndex is closed")
+        future = self._loop.create_future()
+        self._pending.append((float(query[0]), float(query[1]), future))
+        if len(self._pending) >= self.max_batch:
+            self.__flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.max_wait, self.__flush)
+
+        return await future
+
+    def __flush(self):
+        """Sends the pending requests to the executor, in batches of at most
+        max_batch requests (more may be pending after an update)."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._updating:
+            return
+        pending, self._pending = self._pending, []
+        for start in range(0, len(pending), self.max_batch):
+            batch = pending[start:start + self.max_batch]
+            self.requests += len(batch)
+            self.batches += 1
+            points = np.array([(x, y) for x, y, _ in batch])
+            task = self._loop.create_task(self.__run(points, batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def __run(self, points: np.ndarray, batch: List[Tuple]):
+        """Runs one batch off the event loop and resolves its futures."""
+        try:
+            dists, indices = await self._loop.run_in_executor(
+                self._executor, self.index.query, points)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, future), d, i in zip(batch, dists.tolist(),
+                                        indices.tolist()):
+            if not future.done(): # skip cancelled requests
+                future.set_result((d, i))
+
+    async def update(self, fn, *args):
+        """Applies an update to the index without racing the batches. New
+        batches are held back until the running ones finished and the update
+        ran on a worker thread, then the requests queued meanwhile are sent.
+        ------------------------------------------------------------------------
+        Args:
+            fn: function updating the index, such as index.insert
+            args: arguments of fn
+        Returns:
+            result: return value of fn"""
+        if self._closed:
+            raise RuntimeError("AsyncIndex is closed")
+        async with self._update_lock:
+            self._updating = True
+            try:
+                while self._running:
+                    await asyncio.gather(*self._running,
+                                         return_exceptions=True)
+                return await self._loop.run_in_executor(self._executor, fn,
+                                                        *args)
+            finally:
+                self._updating = False
+                if len(self._pending) >= self.max_batch:
+                    self.__flush()
+                elif self._pending and self._timer is None:
+                    self._timer = self._loop.call_later(self.max_wait,
+                                                        self.__flush)
+
+    async def insert(self, x: float, y: float, id: int):
+        """Inserts a point into the index, see update and Tree.insert."""
+        await self.update(self.index.insert, x, y, id)
+
+    async def delete(self, id: int):
+        """Deletes a point from the index, see update and Tree.delete."""
+        await self.update(self.index.delete, id)
+
+    async def close(self):
+        """Answers the pending requests, waits for the running batches and
+        stops the worker threads, after any update in progress."""
+        async with self._update_lock:
+            self._closed = True
+            self.__flush()
+            if self._running:
+                await asyncio.gather(*self._running)
+            self._executor.shutdown(wait=True)
+
+    async def __aenter__(self) -> 'AsyncIndex':
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
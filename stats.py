@@ -0,0 +1,233 @@
+"""Opt-in search and build statistics for the spatial indexes.
+
+A Stats object is attached to an index with `Tree(xs, ys, stats=Stats())`,
+`VpTree(points, stats=Stats())` or by setting `index.stats` later, and one
+object may be shared by several indexes. Indexes without one only keep the
+visits of their last search. With one, every single-point search records its
+latency and counters: points whose distance was computed (visits), lower
+bounds evaluated for subtrees (checks: region distances in the 2d-tree,
+shell gaps in the vp-tree), subtrees skipped by their bound (pruned) and the
+deepest node reached (depth). Vectorized batch searches record their latency
+and number of queries, and builds their time spent sorting, partitioning and
+laying out nodes. Aggregates are kept as fixed-bucket histograms, which can be
+exported as JSON or in the Prometheus text exposition format."""
+import bisect
+import json
+import math
+from typing import Dict, List, Tuple
+
+# histogram bucket upper bounds, latencies in seconds
+LATENCY_BUCKETS = tuple(float(f'{m}e{e}') for e in range(-6, 0)
+                        for m in (1, 2.5, 5)) + (1.0,)
+COUNT_BUCKETS = tuple(2 ** e for e in range(17))
+COUNTERS = ('visits', 'checks', 'pruned', 'depth')
+BUILD_PHASES = ('sort', 'partition', 'layout')
+
+
+class Histogram:
+    def __init__(self, bounds: Tuple[float]):
+        """Constructor method.
+        ------------------------------------------------------------------------
+        Args:
+            bounds: increasing bucket upper bounds, an overflow bucket is
+                added"""
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile.
+        ------------------------------------------------------------------------
+        Args:
+            q: quantile in [0, 1]
+        Returns:
+            bound: bucket upper bound, inf for the overflow bucket and nan
+                for an empty histogram"""
+        if self.count == 0:
+            return math.nan
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return bound
+        return math.inf
+
+    def to_dict(self) -> Dict:
+        return {'count': self.count, 'sum': self.sum,
+                'mean': self.sum / self.count if self.count else math.nan,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99), 'bounds': list(self.bounds),
+                'counts': list(self.counts)}
+
+
+class Stats:
+    def __init__(self):
+        """Empty statistics, keyed by index kind ('kdtree', 'vptree') and
+        operation ('nn', 'knn', 'radius' or 'query' for batches)."""
+        self.reset()
+
+    def reset(self):
+        """Drops everything recorded so far."""
+        self._queries = {} # (index, op): histograms of latency and counters
+        self._batches = {} # (index, op): [batches, queries, latency hist]
+        self._builds = {} # index: [builds, points, seconds per phase]
+
+    def record_query(
+            self,
+            index: str,
+            op: str,
+            seconds: float,
+            visits: int,
+            checks: int,
+            pruned: int,
+            depth: int):
+        """Records a single-point search.
+        ------------------------------------------------------------------------
+        Args:
+            index: index kind
+            op: search operation
+            seconds: latency
+            visits: points whose distance to the query was computed
+            checks: subtree lower bounds evaluated
+            pruned: subtrees skipped by their lower bound
+            depth: depth of the deepest node reached, 0 for the root"""
+        hists = self._queries.get((index, op))
+        if hists is None:
+            hists = self._queries[index, op] = (
+                [Histogram(LATENCY_BUCKETS)] +
+                [Histogram(COUNT_BUCKETS) for _ in COUNTERS])
+        hists[0].observe(seconds)
+        for hist, value in zip(hists[1:], (visits, checks, pruned, depth)):
+            hist.observe(value)
+
+    def record_batch(self, index: str, op: str, seconds: float, queries: int):
+        """Records a vectorized batch search.
+        ------------------------------------------------------------------------
+        Args:
+            index: index kind
+            op: search operation
+            seconds: latency of the whole batch
+            queries: number of queries in the batch"""
+        entry = self._batches.get((index, op))
+        if entry is None:
+            entry = self._batches[index, op] = [0, 0,
+                                                Histogram(LATENCY_BUCKETS)]
+        entry[0] += 1
+        entry[1] += queries
+        entry[2].observe(seconds)
+
+    def record_build(self, index: str, points: int, phases: Dict[str, float]):
+        """Records a build or a subtree rebuild.
+        ------------------------------------------------------------------------
+        Args:
+            index: index kind
+            points: number of points laid out
+            phases: seconds spent in each of BUILD_PHASES"""
+        entry = self._builds.get(index)
+        if entry is None:
+            entry = self._builds[index] = [0, 0, dict.fromkeys(BUILD_PHASES,
+                                                               0.0)]
+        entry[0] += 1
+        entry[1] += points
+        for phase, seconds in phases.items():
+            entry[2][phase] += seconds
+
+    def to_dict(self) -> Dict:
+        """Nested dicts of plain values, index kind then operation.
+        ------------------------------------------------------------------------
+        """
+        queries, batches, builds = {}, {}, {}
+        for (index, op), hists in self._queries.items():
+            names = ('seconds',) + COUNTERS
+            queries.setdefault(index, {})[op] = {
+                name: hist.to_dict() for name, hist in zip(names, hists)}
+        for (index, op), (count, m, hist) in self._batches.items():
+            batches.setdefault(index, {})[op] = {
+                'batches': count, 'queries': m, 'seconds': hist.to_dict()}
+        for index, (count, points, phases) in self._builds.items():
+            builds[index] = {'builds': count, 'points': points,
+                             'seconds': dict(phases)}
+
+        return {'queries': queries, 'batches': batches, 'builds': builds}
+
+    def to_json(self, indent: int = None) -> str:
+        # inf and nan quantiles are written as null
+        def clean(value):
+            if isinstance(value, dict):
+                return {k: clean(v) for k, v in value.items()}
+            if isinstance(value, list):
+                return [clean(v) for v in value]
+            if isinstance(value, float) and not math.isfinite(value):
+                return None
+            return value
+
+        return json.dumps(clean(self.to_dict()), indent=indent)
+
+    def to_prometheus(self, prefix: str = 'geosearch') -> str:
+        """Renders the statistics in the Prometheus text exposition format.
+        Per-query latencies and counters are histograms labeled by index and
+        op, batches and builds are counters.
+        ------------------------------------------------------------------------
+        Args:
+            prefix: metric name prefix
+        Returns:
+            text: exposition text, one sample per line"""
+        lines = []
+        names = (('query_seconds', 'Single-point search latency.'),
+                 ('query_visits', 'Points whose distance was computed.'),
+                 ('query_checks', 'Subtree lower bounds evaluated.'),
+                 ('query_pruned', 'Subtrees skipped by their lower bound.'),
+                 ('query_depth', 'Deepest node reached.'))
+        for k, (name, help_text) in enumerate(names):
+            lines += [f"# HELP {prefix}_{name} {help_text}",
+                      f"# TYPE {prefix}_{name} histogram"]
+            for (index, op), hists in sorted(self._queries.items()):
+                lines += _histogram_lines(f"{prefix}_{name}", hists[k],
+                                          f'index="{index}",op="{op}"')
+
+        lines += [f"# HELP {prefix}_batch_seconds Batch search latency.",
+                  f"# TYPE {prefix}_batch_seconds histogram"]
+        for (index, op), (_, _, hist) in sorted(self._batches.items()):
+            lines += _histogram_lines(f"{prefix}_batch_seconds", hist,
+                                      f'index="{index}",op="{op}"')
+        lines += [f"# HELP {prefix}_batch_queries_total Queries answered in "
+                  f"batches.", f"# TYPE {prefix}_batch_queries_total counter"]
+        for (index, op), (_, m, _) in sorted(self._batches.items()):
+            lines.append(f'{prefix}_batch_queries_total{{index="{index}",'
+                         f'op="{op}"}} {m}')
+
+        lines += [f"# HELP {prefix}_builds_total Builds and rebuilds.",
+                  f"# TYPE {prefix}_builds_total counter"]
+        lines += [f'{prefix}_builds_total{{index="{index}"}} {entry[0]}'
+                  for index, entry in sorted(self._builds.items())]
+        lines += [f"# HELP {prefix}_build_points_total Points laid out by "
+                  f"builds.", f"# TYPE {prefix}_build_points_total counter"]
+        lines += [f'{prefix}_build_points_total{{index="{index}"}} {entry[1]}'
+                  for index, entry in sorted(self._builds.items())]
+        lines += [f"# HELP {prefix}_build_seconds_total Build time per "
+                  f"phase.", f"# TYPE {prefix}_build_seconds_total counter"]
+        for index, (_, _, phases) in sorted(self._builds.items()):
+            lines += [f'{prefix}_build_seconds_total{{index="{index}",'
+                      f'phase="{phase}"}} {seconds!r}'
+                      for phase, seconds in phases.items()]
+
+        return '\n'.join(lines) + '\n'
+
+
+def _histogram_lines(name: str, hist: Histogram, labels: str) -> List[str]:
+    """Cumulative bucket, sum and count samples of a histogram."""
+    lines, seen = [], 0
+    for bound, count in zip(hist.bounds, hist.counts):
+        seen += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound!r}"}} {seen}')
+    lines += [f'{name}_bucket{{{labels},le="+Inf"}} {hist.count}',
+              f'{name}_sum{{{labels}}} {hist.sum!r}',
+              f'{name}_count{{{labels}}} {hist.count}']
+
+    return lines
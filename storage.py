@@ -0,0 +1,135 @@
+"""Versioned binary file format shared by the spatial indexes.
+
+A file starts with a fixed header followed by a JSON table of contents and
+the raw node arrays:
+
+    magic        8 bytes  b'GEOSRCH\\0'
+    version      uint32   FORMAT_VERSION
+    meta length  uint32   bytes of the JSON table of contents
+    meta crc32   uint32   checksum of the JSON table of contents
+    data crc32   uint32   checksum of every byte after the table of contents
+    meta         JSON     index kind, scalar attributes and array layout
+    arrays       raw      little-endian arrays, each aligned to ALIGN bytes
+
+Arrays are stored in the layout numpy uses in memory, so a file can be
+mapped with np.memmap and used without copying or parsing."""
+import json
+import struct
+import zlib
+import numpy as np
+from typing import Dict, Tuple
+
+MAGIC = b'GEOSRCH\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIII')
+ALIGN = 64 # array offsets are multiples of ALIGN bytes
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGN) * ALIGN
+
+
+def write_index(
+        path: str,
+        kind: str,
+        arrays: Dict[str, np.ndarray],
+        attrs: Dict) -> None:
+    """Writes node arrays and scalar attributes of an index to a file.
+    ----------------------------------------------------------------------------
+    Args:
+        path: output file path
+        kind: index type tag, checked on load
+        arrays: named node arrays
+        attrs: JSON serializable scalar attributes"""
+    arrays = {name: np.ascontiguousarray(a, dtype=a.dtype.newbyteorder('<'))
+              for name, a in arrays.items()}
+    # array offsets are relative to the end of the table of contents
+    layout, offset = {}, 0
+    for name, a in arrays.items():
+        offset = _aligned(offset)
+        layout[name] = {'dtype': a.dtype.str, 'shape': list(a.shape),
+                        'offset': offset}
+        offset += a.nbytes
+
+    meta = {'kind': kind, 'attrs': attrs, 'arrays': layout}
+    meta = json.dumps(meta).encode('utf-8')
+    # pad the table of contents so the data section starts aligned
+    end = HEADER.size + len(meta)
+    meta += b' ' * (_aligned(end) - end)
+
+    with open(path, 'wb') as f:
+        # the header is written last, once the data checksum is known
+        f.seek(HEADER.size)
+        f.write(meta)
+        data_crc, pos = 0, 0
+        for name, a in arrays.items():
+            pad = bytes(layout[name]['offset'] - pos)
+            data = memoryview(a.reshape(-1)).cast('B')
+            data_crc = zlib.crc32(data, zlib.crc32(pad, data_crc))
+            f.write(pad)
+            f.write(data)
+            pos = layout[name]['offset'] + a.nbytes
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(meta),
+                            zlib.crc32(meta), data_crc))
+
+
+def read_index(
+        path: str,
+        kind: str,
+        mmap: bool = True,
+        verify: bool = None) -> Tuple[Dict[str, np.ndarray], Dict]:
+    """Reads the node arrays and scalar attributes of an index from a file.
+    The header and table of contents are always checked. With mmap, arrays
+    are read-only views of a memory mapping of the file, shared through the
+    page cache by every process mapping it.
+    ----------------------------------------------------------------------------
+    Args:
+        path: input file path
+        kind: expected index type tag
+        mmap: map the arrays instead of reading them into memory
+        verify: check the data checksum, which reads the whole file. Defaults
+                to True when reading and False when mapping
+    Returns:
+        arrays: named node arrays
+        attrs: scalar attributes"""
+    if verify is None:
+        verify = not mmap
+    with open(path, 'rb') as f:
+        head = f.read(HEADER.size)
+        if len(head) < HEADER.size or head[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not an index file")
+        _, version, meta_len, meta_crc, data_crc = HEADER.unpack(head)
+        if version != FORMAT_VERSION:
+            raise ValueError(
+                f"{path} has format version {version}, "
+                f"expected {FORMAT_VERSION}")
+        meta = f.read(meta_len)
+        if len(meta) < meta_len or zlib.crc32(meta) != meta_crc:
+            raise ValueError(f"{path} has a corrupted header")
+        meta = json.loads(meta.decode('utf-8'))
+        if meta['kind'] != kind:
+            raise ValueError(f"{path} holds a {meta['kind']}, not a {kind}")
+        start = HEADER.size + meta_len
+        if mmap and f.seek(0, 2) > start: # empty mappings are not allowed
+            buf = np.memmap(f, dtype=np.uint8, mode='r', offset=start)
+        elif mmap:
+            buf = np.empty(0, dtype=np.uint8)
+        else:
+            f.seek(start)
+            buf = np.frombuffer(f.read(), dtype=np.uint8)
+
+    if verify and zlib.crc32(buf) != data_crc:
+        raise ValueError(f"{path} failed the data checksum")
+
+    arrays = {}
+    for name, spec in meta['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        end = spec['offset'] + count * dtype.itemsize
+        if end > buf.shape[0]:
+            raise ValueError(f"{path} is truncated")
+        a = buf[spec['offset']:end].view(dtype).reshape(spec['shape'])
+        arrays[name] = a
+
+    return arrays, meta['attrs']
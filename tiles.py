@@ -0,0 +1,463 @@
+"""Out-of-core tiled nearest neighbor index for point sets larger than memory.
+
+Points are split by a coarse 2d-tree of depth D into 2^D tiles. Its splits
+are medians of a random sample, so tiles hold about the same number of points.
+Each tile is an ordinary 2d-tree saved to its own file (see storage.py), with
+the ids of its points in the input stream. A directory holds the tile files
+and a manifest with the coarse splits and every tile's tight bounding box.
+
+Searches keep the manifest in memory. They visit tiles by increasing distance
+from the query to the tile box and stop at the first tile that cannot beat
+the current best distance. A bounded LRU cache keeps the last used tiles
+open. Tiles are memory mapped, so a search only pages in the nodes it reads.
+
+The bulk build streams its input twice and never holds it in memory. The
+first pass counts the points and keeps a random sample, which gives the
+projection and the coarse splits. The second pass routes each chunk to its
+tiles and appends it to per-tile spill files, buffering at most buffer_size
+points. Then each tile is read back, built and saved, one at a time."""
+import math
+import os
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+import tree as kd
+from ingest import CHUNK_SIZE, LocalProjection, iter_chunks
+from metrics import Euclidean
+from storage import read_index, write_index
+
+TILE_SIZE = 1 << 18 # target points per tile
+CACHE_TILES = 64 # open tiles kept by the LRU cache
+BUFFER_SIZE = 1 << 21 # points buffered before spilling to the tile files
+SAMPLE_SIZE = 1 << 16 # points sampled to place the coarse splits
+MANIFEST = 'manifest.idx'
+# spill file records, in stream order within each tile
+SPILL_DTYPE = np.dtype([('x', '<f8'), ('y', '<f8'), ('id', '<i8')])
+
+
+def _tile_path(directory: str, t: int) -> str:
+    return os.path.join(directory, f'tile_{t:05d}.idx')
+
+
+def _spill_path(directory: str, t: int) -> str:
+    return os.path.join(directory, f'tile_{t:05d}.spill')
+
+
+def _route(
+        axis: np.ndarray,
+        split: np.ndarray,
+        xs: np.ndarray,
+        ys: np.ndarray) -> np.ndarray:
+    """Tiles of a set of points, descending the coarse tree level by level.
+    ----------------------------------------------------------------------------
+    Args:
+        axis: (2^D - 1,)-shape array of split axes in heap order, 0 for x
+        split: (2^D - 1,)-shape array of split values in heap order
+        xs, ys: (m,)-shape arrays of point coords
+    Returns:
+        tiles: (m,)-shape array of tile numbers"""
+    node = np.zeros(xs.shape[0], dtype=np.int64)
+    for _ in range(int(math.log2(axis.shape[0] + 1))):
+        coord = np.where(axis[node] == 0, xs, ys)
+        node = 2 * node + 1 + (coord >= split[node])
+
+    return node - axis.shape[0]
+
+
+def _coarse_splits(
+        xs: np.ndarray,
+        ys: np.ndarray,
+        depth: int) -> Tuple[np.ndarray]:
+    """Places the coarse splits at sample medians, along the wider side of
+    each node's sample.
+    ----------------------------------------------------------------------------
+    Args:
+        xs, ys: arrays of sample coords
+        depth: number of levels D
+    Returns:
+        axis: (2^D - 1,)-shape array of split axes in heap order, 0 for x
+        split: (2^D - 1,)-shape array of split values in heap order"""
+    axis = np.zeros((1 << depth) - 1, dtype=np.int8)
+    split = np.full((1 << depth) - 1, math.inf)
+    parts = [np.arange(xs.shape[0])]
+    for level in range(depth):
+        children = []
+        for j, part in enumerate(parts):
+            node = (1 << level) - 1 + j
+            if part.shape[0] > 0: # empty samples send every point left
+                px, py = xs[part], ys[part]
+                axis[node] = int(np.ptp(py) > np.ptp(px))
+                coord = py if axis[node] else px
+                split[node] = np.median(coord)
+                right = coord >= split[node]
+                children += [part[~right], part[right]]
+            else:
+                children += [part, part]
+        parts = children
+
+    return axis, split
+
+
+class TiledIndex:
+    def __init__(
+            self,
+            directory: str,
+            cache_tiles: int = CACHE_TILES,
+            mmap: bool = True):
+        """Opens a tiled index written by TiledIndex.build. Only the manifest
+        is read, tiles are opened by the searches that need them.
+        ------------------------------------------------------------------------
+        Args:
+            directory: index directory
+            cache_tiles: number of open tiles kept, least recently used first
+                out
+            mmap: map the tile files instead of reading them whole"""
+        if cache_tiles < 1:
+            raise ValueError(f"cache_tiles must be positive, got "
+                             f"{cache_tiles}")
+        arrays, attrs = read_index(os.path.join(directory, MANIFEST), 'tiles',
+                                   mmap=False)
+        self.directory = directory
+        self.cache_tiles = cache_tiles
+        self.mmap = mmap
+        self._axis, self._split = arrays['axis'], arrays['split']
+        # tight bounding box of each tile, empty tiles have inverted boxes
+        self._xmin, self._xmax = arrays['xmin'], arrays['xmax']
+        self._ymin, self._ymax = arrays['ymin'], arrays['ymax']
+        self._counts = arrays['counts']
+        self._size = int(attrs['size'])
+        projection = attrs['projection']
+        self.projection = tuple(projection) if projection else None
+        self.metric = Euclidean
+        self._tiles = OrderedDict() # tile number: open 2d-tree
+        self.tile_loads = self.bytes_read = self.bytes_mapped = 0
+        self.tile_hits = self.evictions = self.tile_searches = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def n_tiles(self) -> int:
+        return self._counts.shape[0]
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Tile counters since the index was opened. bytes_read adds up the
+        size of the tile files read whole (without mmap). bytes_mapped adds up
+        the size of the tile files memory mapped, an upper bound on what the
+        searches may read from them, as pages are only read when touched.
+        ------------------------------------------------------------------------
+        """
+        lookups = self.tile_hits + self.tile_loads
+        return {'tile_searches': self.tile_searches,
+                'tile_loads': self.tile_loads, 'tile_hits': self.tile_hits,
+                'evictions': self.evictions,
+                'bytes_read': self.bytes_read,
+                'bytes_mapped': self.bytes_mapped,
+                'hit_rate': self.tile_hits / lookups if lookups else 0.0}
+
+    def clear(self):
+        """Closes every cached tile."""
+        self._tiles.clear()
+
+    def __tile(self, t: int) -> kd.Tree:
+        """Tile t's 2d-tree, from the cache or its file."""
+        tile = self._tiles.get(t)
+        if tile is not None:
+            self.tile_hits += 1
+            self._tiles.move_to_end(t)
+        else:
+            path = _tile_path(self.directory, t)
+            tile = kd.Tree.load(path, mmap=self.mmap)
+            self.tile_loads += 1
+            if self.mmap:
+                self.bytes_mapped += os.path.getsize(path)
+            else:
+                self.bytes_read += os.path.getsize(path)
+            self._tiles[t] = tile
+            if len(self._tiles) > self.cache_tiles:
+                self._tiles.popitem(last=False)
+                self.evictions += 1
+        self.tile_searches += 1
+
+        return tile
+
+    def __lower_bounds(self, xq: float, yq: float) -> np.ndarray:
+        """Distances from a query to every tile box, inf for empty tiles."""
+        dx = np.maximum(np.maximum(self._xmin - xq, xq - self._xmax), 0.0)
+        dy = np.maximum(np.maximum(self._ymin - yq, yq - self._ymax), 0.0)
+
+        return np.sqrt(dx * dx + dy * dy)
+
+    def nearest_neighbor(self, query: List[float]) -> Tuple[float, int]:
+        """Finds the nearest neighbor of a query point, ties by lowest id.
+        Tiles are searched by increasing box distance until the next box is
+        farther than the best distance found.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords, projected like the index
+        Returns:
+            dist: distance from query to its nearest neighbor
+            index: nearest neighbor's position in the input, -1 if empty"""
+        dists, indices = self.knn(query, 1)
+        if dists.shape[0] == 0:
+            return math.inf, -1
+        return float(dists[0]), int(indices[0])
+
+    def knn(self, query: List[float], k: int) -> Tuple[np.ndarray]:
+        """Finds the k nearest neighbors of a query point. Tiles are searched
+        by increasing box distance until the next box is farther than the
+        current k-th distance. Results are sorted by distance, ties by id.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords, projected like the index
+            k: number of neighbors
+        Returns:
+            dists: (min(k, n),)-shape array of sorted distances
+            indices: (min(k, n),)-shape array of neighbors' ids"""
+        if k < 1:
+            raise ValueError(f"k must be positive, got {k}")
+        xq, yq = float(query[0]), float(query[1])
+        lower = self.__lower_bounds(xq, yq)
+        dists, indices = np.empty(0), np.empty(0, dtype=np.int64)
+        for t in np.argsort(lower, kind='stable').tolist():
+            tau = dists[k - 1] if dists.shape[0] == k else math.inf
+            # equal bounds may still hold a tie with a lower id, empty tiles
+            # come last with infinite bounds
+            if lower[t] > tau or lower[t] == math.inf:
+                break
+            d, i = self.__tile(t).knn((xq, yq), k)
+            dists, indices = np.concatenate((dists, d)), \
+                np.concatenate((indices, i))
+            order = np.lexsort((indices, dists))[:k]
+            dists, indices = dists[order], indices[order]
+
+        return dists, indices
+
+    def query_radius(self, query: List[float], r: float) -> Tuple[np.ndarray]:
+        """Finds all points within distance r of a query point, searching the
+        tiles whose box is within r. Results are sorted by distance, ties by
+        id.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords, projected like the index
+            r: search radius
+        Returns:
+            dists: array of sorted distances
+            indices: array of ids of the points within the radius"""
+        xq, yq = float(query[0]), float(query[1])
+        near = (self.__lower_bounds(xq, yq) <= r) & (self._counts > 0)
+        hits = [self.__tile(t).query_radius((xq, yq), r)
+                for t in np.flatnonzero(near).tolist()]
+        if not hits:
+            return np.empty(0), np.empty(0, dtype=np.int64)
+        dists = np.concatenate([d for d, _ in hits])
+        indices = np.concatenate([i for _, i in hits])
+        order = np.lexsort((indices, dists))
+
+        return dists[order], indices[order]
+
+    def query(self, points: np.ndarray) -> Tuple[np.ndarray]:
+        """Batch nearest neighbor search, opening each tile at most twice.
+        Every query is first answered by a batch query of the tile it falls
+        in. Then each tile answers the queries whose distance to its box is
+        below their current best.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords, projected like the
+                index
+        Returns:
+            dists: (m,)-shape array of distances to the nearest neighbors
+            indices: (m,)-shape array with the nearest neighbors' ids, -1
+                for an empty index"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        px, py = points[:, 0], points[:, 1]
+        dists = np.full(points.shape[0], math.inf)
+        indices = np.full(points.shape[0], -1, dtype=np.int64)
+
+        def search(t: int, q: np.ndarray):
+            d, i = self.__tile(t).query(points[q])
+            better = (d < dists[q]) | ((d == dists[q]) & (i < indices[q]))
+            dists[q[better]], indices[q[better]] = d[better], i[better]
+
+        # home tiles, which tighten the bounds of the second pass
+        home = _route(self._axis, self._split, px, py)
+        order = np.argsort(home, kind='stable')
+        tiles, starts = np.unique(home[order], return_index=True)
+        for t, q in zip(tiles.tolist(), np.split(order, starts[1:])):
+            if self._counts[t] > 0:
+                search(t, q)
+        for t in np.flatnonzero(self._counts > 0).tolist():
+            dx = np.maximum(np.maximum(self._xmin[t] - px,
+                                       px - self._xmax[t]), 0.0)
+            dy = np.maximum(np.maximum(self._ymin[t] - py,
+                                       py - self._ymax[t]), 0.0)
+            q = np.flatnonzero((np.sqrt(dx * dx + dy * dy) <= dists) &
+                               (home != t))
+            if q.shape[0] > 0:
+                search(t, q)
+
+        return dists, indices
+
+    @classmethod
+    def build(
+            cls,
+            path: str,
+            directory: str,
+            tile_size: int = TILE_SIZE,
+            format: str = None,
+            chunk_size: int = CHUNK_SIZE,
+            lon_key: str = 'lon',
+            lat_key: str = 'lat',
+            **kwargs) -> 'TiledIndex':
+        """Builds a tiled index over a file's lon/lat coords, streamed with
+        ingest.iter_chunks. Coords are projected around their mean, as by
+        ingest.load_points, and the projection is kept in index.projection.
+        See from_chunks for the other keyword arguments.
+        ------------------------------------------------------------------------
+        Args:
+            path: input file path
+            directory: output directory, created if missing
+            tile_size: target points per tile
+            format: 'json', 'ndjson' or 'csv', guessed from the extension if
+                None
+            chunk_size: records per chunk
+            lon_key, lat_key: record fields holding the coords
+        Returns:
+            index: opened TiledIndex"""
+        chunks = lambda: iter_chunks(path, format, chunk_size, lon_key,
+                                     lat_key)
+        return cls.from_chunks(chunks, directory, tile_size,
+                               project=True, **kwargs)
+
+    @classmethod
+    def from_chunks(
+            cls,
+            chunks: Callable[[], Iterable[Tuple[np.ndarray]]],
+            directory: str,
+            tile_size: int = TILE_SIZE,
+            project: bool = False,
+            buffer_size: int = BUFFER_SIZE,
+            sample_size: int = SAMPLE_SIZE,
+            leaf_size: int = kd.LEAF_SIZE,
+            seed: int = 0,
+            **kwargs) -> 'TiledIndex':
+        """Builds a tiled index over a stream of coordinate chunks, read
+        twice. Point ids are positions in the stream. Memory holds one chunk,
+        the sample, the spill buffers and one tile at a time.
+        ------------------------------------------------------------------------
+        Args:
+            chunks: function returning a new iterable of (xs, ys) chunks
+            directory: output directory, created if missing
+            tile_size: target points per tile
+            project: whether chunks hold lon/lat degrees to be projected
+                around their mean
+            buffer_size: points buffered before spilling to the tile files
+            sample_size: points sampled to place the coarse splits
+            leaf_size: largest leaf block of the tile trees
+            seed: random generator seed of the sample
+            kwargs: TiledIndex constructor arguments
+        Returns:
+            index: opened TiledIndex"""
+        if tile_size < 1:
+            raise ValueError(f"tile_size must be positive, got {tile_size}")
+        os.makedirs(directory, exist_ok=True)
+        rng = np.random.default_rng(seed)
+
+        # first pass: count, mean and a uniform sample (smallest random keys)
+        n, sum_x, sum_y = 0, 0.0, 0.0
+        sample, keys = np.empty((0, 2)), np.empty(0)
+        for xs, ys in chunks():
+            n += xs.shape[0]
+            sum_x, sum_y = sum_x + float(np.sum(xs)), sum_y + float(np.sum(ys))
+            sample = np.concatenate((sample, np.column_stack((xs, ys))))
+            keys = np.concatenate((keys, rng.random(xs.shape[0])))
+            if keys.shape[0] > sample_size:
+                keep = np.argpartition(keys, sample_size)[:sample_size]
+                sample, keys = sample[keep], keys[keep]
+
+        projection = None
+        if project and n > 0:
+            projection = LocalProjection(sum_x / n, sum_y / n)
+            sample = np.column_stack(projection.forward(sample[:, 0],
+                                                        sample[:, 1]))
+        depth = max(math.ceil(math.log2(max(n / tile_size, 1.0))), 0)
+        axis, split = _coarse_splits(sample[:, 0], sample[:, 1], depth)
+        n_tiles = 1 << depth
+
+        # second pass: route chunks to their tiles through spill files
+        for t in range(n_tiles):
+            open(_spill_path(directory, t), 'wb').close()
+        buffers, buffered, offset = [[] for _ in range(n_tiles)], 0, 0
+        for xs, ys in chunks():
+            records = np.empty(xs.shape[0], dtype=SPILL_DTYPE)
+            if projection is not None:
+                xs, ys = projection.forward(xs, ys)
+            records['x'], records['y'] = xs, ys
+            records['id'] = np.arange(offset, offset + xs.shape[0])
+            offset += xs.shape[0]
+            tiles = _route(axis, split, records['x'], records['y'])
+            order = np.argsort(tiles, kind='stable')
+            used, starts = np.unique(tiles[order], return_index=True)
+            for t, part in zip(used.tolist(), np.split(records[order],
+                                                       starts[1:])):
+                buffers[t].append(part)
+            buffered += xs.shape[0]
+            if buffered >= buffer_size:
+                cls.__spill(directory, buffers)
+                buffered = 0
+        cls.__spill(directory, buffers)
+
+        # build and save each tile, with the stream positions as point ids
+        bounds = np.empty((4, n_tiles))
+        counts = np.zeros(n_tiles, dtype=np.int64)
+        for t in range(n_tiles):
+            records = np.fromfile(_spill_path(directory, t), dtype=SPILL_DTYPE)
+            os.remove(_spill_path(directory, t))
+            counts[t] = records.shape[0]
+            if counts[t] == 0:
+                bounds[:, t] = math.inf, -math.inf, math.inf, -math.inf
+                continue
+            xs, ys = records['x'], records['y']
+            bounds[:, t] = xs.min(), xs.max(), ys.min(), ys.max()
+            tile = kd.Tree(xs, ys, leaf_size=leaf_size)
+            # local positions to stream ids, increasing so ties are kept
+            tile._index = records['id'][tile._index]
+            tile.projection = projection
+            tile.save(_tile_path(directory, t))
+
+        arrays = {'axis': axis, 'split': split, 'xmin': bounds[0],
+                  'xmax': bounds[1], 'ymin': bounds[2], 'ymax': bounds[3],
+                  'counts': counts}
+        attrs = {'size': n, 'tile_size': tile_size, 'depth': depth,
+                 'projection': projection}
+        write_index(os.path.join(directory, MANIFEST), 'tiles', arrays, attrs)
+
+        return cls(directory, **kwargs)
+
+    @staticmethod
+    def __spill(directory: str, buffers: List[List[np.ndarray]]):
+        """Appends the buffered records of every tile to its spill file."""
+        for t, parts in enumerate(buffers):
+            if parts:
+                with open(_spill_path(directory, t), 'ab') as f:
+                    np.concatenate(parts).tofile(f)
+                parts.clear()
+
+
+def iter_array_chunks(
+        path: str,
+        chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[np.ndarray]]:
+    """Streams (x, y) chunks from a raw file of little-endian float64 pairs,
+    as written by ndarray.tofile on an (n, 2) array.
+    ----------------------------------------------------------------------------
+    Args:
+        path: input file path
+        chunk_size: points per chunk
+    Yields:
+        xs, ys: arrays of coords, copied out of the file"""
+    data = np.memmap(path, dtype='<f8', mode='r').reshape(-1, 2)
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = np.array(data[start:start + chunk_size])
+        yield chunk[:, 0], chunk[:, 1]
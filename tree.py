@@ -1,7 +1,24 @@
 import math
+import time
 import numpy as np
 from typing import List, Tuple
 
+import join
+from metrics import get_metric
+from neighbors import (group_hits, knn_each, push_bounded, sorted_heap,
+                       update_best)
+from stats import Stats
+from storage import read_index, write_index
+
+# region of the root node, (xmin, xmax, ymin, ymax)
+UNBOUNDED = (-math.inf, math.inf, -math.inf, math.inf)
+# scapegoat balance factor, a subtree is rebuilt when an insertion makes it
+# too deep and one of its children holds more than ALPHA of its nodes
+ALPHA = 0.7
+# default number of points below which subtrees are stored as flat leaf
+# blocks, chosen with benchmarks/leaf_size.py
+LEAF_SIZE = 16
+
 
 # Node Class
 class TreeNode:
@@ -10,7 +27,7 @@ class TreeNode:
             x: float,
             y: float,
             split_x: bool = True):
-        """Constructor method. Builds a 2d-tree node using spatial input coords 
+        """Constructor method. Builds a 2d-tree node using spatial input coords
         and splitting direction.
         -----------------------------------------------------------------------
         Args:
@@ -36,52 +53,259 @@ class TreeNode:
         return f"[(x={str(self.x)}, y={str(self.y)}), split_dir={split}]"
 
 
+class TreeNodeView(TreeNode):
+    def __init__(self, tree: 'Tree', slot: int, bounds: Tuple[float]):
+        """Constructor method. Builds a read-only node view over a node stored
+        in the flat arrays of a 2d-tree. Children are resolved lazily, so views
+        are cheap to create on demand.
+        -----------------------------------------------------------------------
+        Args:
+            tree: 2d-tree owning the node
+            slot: position of the node in the tree arrays
+            bounds: (4,)-tuple with node's region (xmin, xmax, ymin, ymax)"""
+        self._tree = tree
+        self.slot = slot
+        # original index of the point in the input coords
+        self.index = int(tree._index[slot])
+        self.x, self.y = float(tree._x[slot]), float(tree._y[slot])
+        self.split_x = bool(tree._split_x[slot])
+        # region bounds are not stored, they follow from ancestors' splits
+        self.xmin, self.xmax, self.ymin, self.ymax = bounds
+        # points of the leaf block starting at this node, 0 for plain nodes
+        self.bucket = int(tree._bucket[slot])
+
+    @property
+    def bounds(self) -> Tuple[float]:
+        return self.xmin, self.xmax, self.ymin, self.ymax
+
+    @property
+    def left(self) -> TreeNode:
+        return self._tree.node(
+            self._tree._left[self.slot],
+            self._tree._child_bounds(self.slot, self.bounds, left=True))
+
+    @property
+    def right(self) -> TreeNode:
+        return self._tree.node(
+            self._tree._right[self.slot],
+            self._tree._child_bounds(self.slot, self.bounds, left=False))
+
+
 # 2d-Tree class
 class Tree:
     def __init__(
-            self, 
-            xs: List[float], 
-            ys: List[float]):
-        """Constructor method. Builds a variance dependent 2d-tree using list of 
-        spatial input coords.
+            self,
+            xs: List[float],
+            ys: List[float],
+            metric: str = 'euclidean',
+            leaf_size: int = LEAF_SIZE,
+            stats: Stats = None):
+        """Constructor method. Builds a variance dependent 2d-tree using list of
+        spatial input coords. Nodes are stored in preorder in contiguous arrays
+        (coords, splitting direction and child slots) instead of per-node
+        objects. Region bounds are derived from the splits while traversing and
+        TreeNode views are created on demand. Subtrees of up to leaf_size points
+        are stored as leaf blocks in consecutive slots, which searches scan
+        with one vectorized distance call instead of descending.
         -----------------------------------------------------------------------
         Args:
-            xs: list of x-coordinates
-            ys: list of y-coordinates"""
-        # compute indices that would sort xs and ys
-        ix_sort, iy_sort = np.argsort(xs), np.argsort(ys)
-        # compute variances along xs and ys
-        x_var, y_var = np.var(xs), np.var(ys)
-        # splitting rule
-        split_x = True if x_var > y_var else False
-        
-        # build tree recursively
-        self.root = self.__build_tree(xs, ys, ix_sort, iy_sort, split_x)
+            xs: list of x-coordinates, longitudes for haversine
+            ys: list of y-coordinates, latitudes for haversine
+            metric: metric name or object, see metrics.py
+            leaf_size: largest leaf block, 1 for one point per node
+            stats: statistics recorder for searches and builds, see
+                stats.py, None to keep only the visits of the last search"""
+        if leaf_size < 1:
+            raise ValueError(f"leaf_size must be positive, got {leaf_size}")
+        xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+        n = xs.shape[0]
+        # node arrays, after a build slot i holds the i-th node in preorder
+        self._x, self._y = np.empty(n), np.empty(n)
+        self._split_x = np.empty(n, dtype=bool)
+        self._left = np.full(n, -1, dtype=np.int32)
+        self._right = np.full(n, -1, dtype=np.int32)
+        # point ids, deleted points are kept as tombstones holding ~id
+        self._index = np.empty(n, dtype=np.int64)
+        # size of the leaf block starting at each slot, 0 for plain nodes
+        self._bucket = np.zeros(n, dtype=np.int32)
+        self.leaf_size = leaf_size
+        self._size = n # number of slots in use
+        self._count = n # number of live points
+        self._free = [] # unused slots below _size, left by rebuilds
+        self._slots = None # id to slot map, built on the first update
+        self.visits = 0 # nodes visited by the last single-point search
+        self.version = 0 # incremented by every update
+        # (lon_mean, lat_mean) used to project the input coords, if any
+        self.projection = None
+        self.metric = get_metric(metric)
+        self.stats = stats
+
+        self._root = self.__build_tree(xs, ys, np.arange(n), np.arange(n))
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def root(self) -> TreeNode:
+        """Root node view, None for an empty tree.
+        ------------------------------------------------------------------------
+        """
+        return self.node(self._root, UNBOUNDED)
+
+    def node(self, slot: int, bounds: Tuple[float] = None) -> TreeNode:
+        """Builds a TreeNode view of the node stored at a given slot.
+        ------------------------------------------------------------------------
+        Args:
+            slot: node position in the tree arrays, -1 stands for no node
+            bounds: node's region if known, otherwise it is recovered from the
+                path to the root in O(n)
+        Returns:
+            view: TreeNode view or None if slot is -1"""
+        if slot < 0:
+            return None
+        if bounds is None:
+            bounds = self.__region(int(slot))
+
+        return TreeNodeView(self, int(slot), bounds)
+
+    def __region(self, slot: int) -> Tuple[float]:
+        """Recovers a node's region by replaying the splits along its path from
+        the root. Parents are not stored, so each step scans the child arrays.
+        ------------------------------------------------------------------------
+        Args:
+            slot: node position in the tree arrays
+        Returns:
+            (4,)-tuple containing rectangular boundaries"""
+        path = [] # (parent slot, node is left child) pairs up to the root
+        while slot != self._root:
+            parent = np.flatnonzero(self._left == slot)
+            if parent.shape[0] > 0:
+                path.append((int(parent[0]), True))
+            else:
+                path.append((int(np.flatnonzero(self._right == slot)[0]),
+                             False))
+            slot = path[-1][0]
+
+        bounds = UNBOUNDED
+        for parent, left in reversed(path):
+            bounds = self._child_bounds(parent, bounds, left)
+
+        return bounds
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by the node arrays in bytes.
+        ------------------------------------------------------------------------
+        """
+        arrays = (self._x, self._y, self._split_x, self._left, self._right,
+                  self._index, self._bucket)
+        return sum(a.nbytes for a in arrays)
+
+    def _state(self) -> Tuple[dict]:
+        """Node arrays and scalar attributes that fully describe the tree,
+        used to save it and to share it with other processes.
+        ------------------------------------------------------------------------
+        Returns:
+            arrays: named node arrays
+            attrs: JSON serializable scalar attributes"""
+        n = self._size
+        arrays = {'x': self._x[:n], 'y': self._y[:n],
+                  'split_x': self._split_x[:n], 'left': self._left[:n],
+                  'right': self._right[:n], 'index': self._index[:n],
+                  'bucket': self._bucket[:n],
+                  'free': np.array(self._free, dtype=np.int64)}
+        attrs = {'size': n, 'count': self._count, 'root': int(self._root),
+                 'projection': self.projection, 'metric': self.metric.name,
+                 'leaf_size': self.leaf_size}
+        return arrays, attrs
+
+    @classmethod
+    def _from_state(cls, arrays: dict, attrs: dict) -> 'Tree':
+        """Wraps arrays returned by _state into a tree, without copying them.
+        ------------------------------------------------------------------------
+        Args:
+            arrays: named node arrays
+            attrs: scalar attributes
+        Returns:
+            tree: Tree using the given arrays"""
+        tree = cls.__new__(cls)
+        tree._x, tree._y = arrays['x'], arrays['y']
+        tree._split_x = arrays['split_x']
+        tree._left, tree._right = arrays['left'], arrays['right']
+        tree._index = arrays['index']
+        # files written before leaf blocks hold one point per node
+        tree._bucket = arrays.get('bucket', np.zeros(attrs['size'],
+                                                     dtype=np.int32))
+        tree.leaf_size = attrs.get('leaf_size', 1)
+        tree._size, tree._root = attrs['size'], attrs['root']
+        tree._count = attrs.get('count', attrs['size'])
+        # unused slots left by rebuilds, lost in files written before them
+        tree._free = arrays['free'].tolist() if 'free' in arrays else []
+        tree._slots = None
+        tree.visits = tree.version = 0
+        projection = attrs['projection']
+        tree.projection = tuple(projection) if projection else None
+        tree.metric = get_metric(attrs.get('metric', 'euclidean'))
+        tree.stats = None
+
+        return tree
+
+    def save(self, path: str):
+        """Writes the node arrays to a binary index file, see storage.py.
+        ------------------------------------------------------------------------
+        Args:
+            path: output file path"""
+        write_index(path, 'kdtree', *self._state())
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, verify: bool = None) -> 'Tree':
+        """Loads a tree written by save without rebuilding it. With mmap, the
+        node arrays are read-only memory mapped views of the file, so loading
+        is immediate and processes loading the same file share its pages.
+        ------------------------------------------------------------------------
+        Args:
+            path: input file path
+            mmap: map the file instead of reading it into memory
+            verify: check the data checksum, by default only when not mapping
+        Returns:
+            tree: loaded Tree"""
+        return cls._from_state(*read_index(path, 'kdtree', mmap, verify))
 
     def print(self):
         """Printing method starting at tree's root.
         ------------------------------------------------------------------------
         """
-        self.__print_subtree(self.root)
+        if self._root >= 0:
+            self.__print_subtree(self._root, UNBOUNDED)
 
-    def __print_subtree(self, node: TreeNode):
-        """Recursive tree printing method. Visits subtree defined by node arg
+    def __print_subtree(self, i: int, bounds: Tuple[float]):
+        """Iterative tree printing method. Visits subtree defined by node arg
         in order and prints nodes in order as well.
         ------------------------------------------------------------------------
         Args:
-            node: root of the subtree to print"""
-        if node.left != None:
-            self.__print_subtree(node.left) # explore left subtree
+            i: slot of the root of the subtree to print
+            bounds: region of the subtree's root"""
+        stack = [] # ancestors whose right subtree is still to be printed
+        while stack or i >= 0:
+            while i >= 0: # explore left subtree
+                stack.append((i, bounds))
+                bounds = self._child_bounds(i, bounds, left=True)
+                i = self._left[i]
 
-        print(node) # print node after exploring left subtree
+            i, bounds = stack.pop()
+            # print node after its left subtree, with its leaf block if any
+            for j in range(i, i + max(self._bucket.item(i), 1)):
+                print(self.node(j, bounds))
+            # explore right subtree
+            bounds = self._child_bounds(i, bounds, left=False)
+            i = self._right[i]
 
-        if node.right != None:
-            self.__print_subtree(node.right) # explore right subtree
-
-    def __select(self, isorted: List[int], isecond: List[int]) -> List[int]:
+    def __select(self, isorted: np.ndarray, isecond: np.ndarray) -> np.ndarray:
         """Given an array of indices, select from a second array those that
         match with any of the elements of the first array. From the selected
-        items, it preserves the ordering in the second array.
+        items, it preserves the ordering in the second array. Runs in linear
+        time by marking isorted members in a reusable boolean mask, so keeping
+        both presorted index arrays in sync costs O(n log n) for the full build.
         ------------------------------------------------------------------------
         Args:
             isorted: array of indices that would sort an array
@@ -89,229 +313,921 @@ class Tree:
         Returns:
             io: array of indices in isecond that are contained in isorted, order
                 is preserved"""
-        io = np.array([]).astype(int)
-        # iterate along second array of indices (non-splitting direction)
-        for i in isecond:
-            r = (isorted == i) # compare isorted elements to i
-            if r.any() == True: # element is present in isorted
-                io = np.append(io, i)
+        self._mask[isorted] = True # mark elements present in isorted
+        io = isecond[self._mask[isecond]] # stable partition of isecond
+        self._mask[isorted] = False # reset mask for next call
 
         return io
 
-    def __get_bounds(
-            self, 
-            node: TreeNode, 
-            parent: TreeNode) -> Tuple[float]:
-        """Computes node region's boundaries based on parent splitting dir.
+    def _child_bounds(
+            self,
+            i: int,
+            bounds: Tuple[float],
+            left: bool) -> Tuple[float]:
+        """Computes a child region's boundaries from its parent's region and
+        splitting dir. The side is known at build time, so points lying on the
+        splitting line get the region of the subtree they are stored in.
         ------------------------------------------------------------------------
         Args:
-            node: 2d-tree node
-            parent: parent node
+            i: parent node slot
+            bounds: (4,)-tuple with parent's region (xmin, xmax, ymin, ymax)
+            left: True for the left child, False for the right one
         Returns:
             (4,)-tuple containing rectangular boundaries"""
-        xmin, xmax = parent.xmin, parent.xmax
-        ymin, ymax = parent.ymin, parent.ymax
+        xmin, xmax, ymin, ymax = bounds
 
-        if parent.split_x == True: # parent splits along x
-            # check if parent is to the left or right of node
-            if parent.x <= node.x:
-                xmin = parent.x
+        if self._split_x[i]: # parent splits along x
+            if left:
+                xmax = self._x[i]
             else:
-                xmax = parent.x
+                xmin = self._x[i]
 
         else: # parent splits along y
-            if parent.y <= node.y:
-                ymin = parent.y
+            if left:
+                ymax = self._y[i]
             else:
-                ymax = parent.y
+                ymin = self._y[i]
 
         return xmin, xmax, ymin, ymax
 
     def __build_tree(
             self,
-            xs: List[float],
-            ys: List[float],
-            ix: List[int],
-            iy: List[int],
-            split_x: bool = None,
-            parent = None) -> TreeNode:
-        """Recursive building method. Builds a 2d-tree for a list of points.
-        Uses variance rule for determining splitting direction of child nodes.
-        ------------------------------------------------------------------------
-        Args:
-            xs: list of x-coordinates
-            ys: list of y-coordinates
-            ix: list of indices that define xs sorting
-            iy: list of indices that define ys sorting
-            split_x: splitting direction. True if x and False if y
-            parent: parent node"""
-        size = ix.shape[0] # number of nodes
-        mid = size // 2 # middle index
-        
-        if split_x: # split along x-axis
-            # use middle node along x-axis to partition space
-            node = TreeNode(xs[ix[mid]], ys[ix[mid]], True)
-            if parent != None:
-                # compute region's boundaries
-                bounds = self.__get_bounds(node, parent)
-                node.xmin, node.xmax = bounds[:2]
-                node.ymin, node.ymax = bounds[2:]
-                
-            if mid > 0:
-                # select iy elements corresponding to ix[:mid]
-                sub_iy = self.__select(ix[:mid], iy)
+            xs: np.ndarray,
+            ys: np.ndarray,
+            ids: np.ndarray,
+            slots: np.ndarray) -> int:
+        """Iterative building method. Builds a 2d-tree for a list of points
+        using an explicit stack of pending subtrees, so depth is not bounded by
+        the interpreter's recursion limit. Uses variance rule for determining
+        splitting direction of child nodes. Nodes are written in preorder to
+        the given slots, which lets a rebuilt subtree reuse its old slots. A
+        subtree of 2 to leaf_size points whose slots are consecutive becomes a
+        leaf block, sorted along its splitting axis. With stats, the time
+        spent sorting, partitioning and laying out nodes is recorded.
+        ------------------------------------------------------------------------
+        Args:
+            xs: array of x-coordinates
+            ys: array of y-coordinates
+            ids: array of point ids
+            slots: array of at least len(xs) free slots, in layout order
+        Returns:
+            root: slot of the tree's root node, -1 if there are no points"""
+        n = xs.shape[0]
+        if n == 0:
+            return -1
+        # phases are only timed when statistics are recorded
+        timed = self.stats is not None
+        start = time.perf_counter() if timed else 0.0
+        # membership mask shared by all __select calls during construction
+        self._mask = np.zeros(n, dtype=bool)
+        # splitting rule for the root
+        split_x = True if np.var(xs) > np.var(ys) else False
+        # pending subtrees as (ix, iy, split_x, parent slot, is left child),
+        # where ix and iy are the indices that sort the subtree along x and y
+        stack = [(np.argsort(xs), np.argsort(ys), split_x, -1, True)]
+        t_sort = time.perf_counter() - start if timed else 0.0
+        t_partition = 0.0
+        k = 0 # number of nodes laid out so far
+        while stack:
+            ix, iy, split_x, parent, left = stack.pop()
+            size = ix.shape[0] # number of nodes
+            mid = size // 2 # middle index
+            # sort order along splitting axis and along the other one
+            isplit, iother = (ix, iy) if split_x else (iy, ix)
+
+            i = slots.item(k)
+            if parent >= 0: # link node to its parent
+                if left:
+                    self._left[parent] = i
+                else:
+                    self._right[parent] = i
+            if 1 < size <= self.leaf_size and \
+                    slots.item(k + size - 1) - i == size - 1:
+                # leaf block, laid out in the consecutive slots [i, i + size)
+                block = slice(i, i + size)
+                self._x[block], self._y[block] = xs[isplit], ys[isplit]
+                self._index[block] = ids[isplit]
+                self._split_x[block] = split_x
+                self._left[block] = self._right[block] = -1
+                self._bucket[block] = 0
+                self._bucket[i] = size
+                k += size
+                continue
+
+            # use middle node along splitting axis to partition space
+            k += 1
+            p = isplit[mid]
+            self._x[i], self._y[i] = xs[p], ys[p]
+            self._index[i] = ids[p]
+            self._split_x[i] = split_x
+            self._left[i] = self._right[i] = -1
+            self._bucket[i] = 0
+
+            # push right subtree first, so left subtree is laid out right
+            # after its parent (preorder)
+            t = time.perf_counter() if timed else 0.0
+            for lo, hi, is_left in ((mid + 1, size, False), (0, mid, True)):
+                if lo == hi:
+                    continue
+                # select elements along the other axis in isplit[lo:hi]
+                sub = self.__select(isplit[lo:hi], iother)
                 # compute splitting axis based on variance rule
-                x_var, y_var = np.var(xs[ix[:mid]]), np.var(ys[ix[:mid]])
-                split_x = True if x_var > y_var else False
-                # build left-subtree
-                node.left = self.__build_tree(xs, ys, ix[:mid], sub_iy,
-                                              split_x, node)
-
-            if mid + 1 < size:
-                sub_iy = self.__select(ix[mid+1:], iy)
-                x_var, y_var = np.var(xs[ix[mid+1:]]), np.var(ys[ix[mid+1:]])
-                split_x = True if x_var > y_var else False
-                # build right-subtree
-                node.right = self.__build_tree(xs, ys, ix[mid+1:], sub_iy,
-                                              split_x, node)
-
-        else: # split along y-axis
-            node = TreeNode(xs[iy[mid]], ys[iy[mid]], False)
-            if parent != None:
-                bounds = self.__get_bounds(node, parent)
-                node.xmin, node.xmax = bounds[:2]
-                node.ymin, node.ymax = bounds[2:]
-
-            if mid > 0:
-                # select ix elements corresponding to iy[:mid]
-                sub_ix = self.__select(iy[:mid], ix)
-                x_var, y_var = np.var(xs[iy[:mid]]), np.var(ys[iy[:mid]])
-                split_x = True if x_var > y_var else False
-                # build left-subtree
-                node.left = self.__build_tree(xs, ys, sub_ix, iy[:mid],
-                                              split_x, node)
-
-            if mid + 1 < size:
-                # select ix elements corresponding to iy[:mid]
-                sub_ix = self.__select(iy[mid+1:], ix)
-                x_var, y_var = np.var(xs[iy[mid+1:]]), np.var(ys[iy[mid+1:]])
-                split_x = True if x_var > y_var else False
-                # build right-subtree
-                node.right = self.__build_tree(xs, ys, sub_ix, iy[mid+1:],
-                                              split_x, node)
-
-        # once it finishes recursive calls, return subtree's root node
-        return node
-
-    def __dist(self, point1: List[float], point2: List[float]) -> float:
-        """Compute Euclidean distance between two 2d-points.
-        ------------------------------------------------------------------------
-        Args:
-            point1: first point's coords
-            point2: second point's coords
+                x_var = np.var(xs[isplit[lo:hi]])
+                y_var = np.var(ys[isplit[lo:hi]])
+                child_split = True if x_var > y_var else False
+                sub_ix, sub_iy = (isplit[lo:hi], sub) if split_x else \
+                                 (sub, isplit[lo:hi])
+                stack.append((sub_ix, sub_iy, child_split, i, is_left))
+            if timed:
+                t_partition += time.perf_counter() - t
+        del self._mask
+
+        if timed:
+            t_layout = time.perf_counter() - start - t_sort - t_partition
+            self.stats.record_build('kdtree', n, {
+                'sort': t_sort, 'partition': t_partition,
+                'layout': t_layout})
+        return slots.item(0)
+
+    def insert(self, x: float, y: float, id: int):
+        """Inserts a point as a new leaf. A leaf deeper than log(nodes) in base
+        1 / ALPHA triggers a scapegoat rebuild: the lowest ancestor with a
+        child holding more than ALPHA of its nodes is rebuilt balanced, which
+        keeps insertions amortized O(log n). Regions are derived from the
+        splits, so they stay exact after any update.
+        ------------------------------------------------------------------------
+        Args:
+            x: x-coordinate
+            y: y-coordinate
+            id: non-negative point id returned by searches, must not belong to
+                a point already in the tree"""
+        x, y, id = float(x), float(y), int(id)
+        slots = self.__id_slots()
+        if id < 0:
+            raise ValueError(f"id must be non-negative, got {id}")
+        if id in slots:
+            raise ValueError(f"id {id} is already in the tree")
+        self.__reserve(1)
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = self._size
+            self._size += 1
+        self._x[slot], self._y[slot] = x, y
+        self._index[slot] = id
+        self._left[slot] = self._right[slot] = -1
+        self._bucket[slot] = 0
+        slots[id] = slot
+        self._count += 1
+        self.version += 1
+
+        # descend to the missing child whose region holds the point
+        path = [] # ancestors of the new leaf, from the root
+        i = self._root
+        while i >= 0:
+            if self._bucket.item(i) > 0:
+                self.__insert_into_block(path, i, slot)
+                return
+            path.append(i)
+            if self._split_x.item(i):
+                left = x <= self._x.item(i)
+            else:
+                left = y <= self._y.item(i)
+            i = self._left.item(i) if left else self._right.item(i)
+        if not path:
+            self._root = slot
+            self._split_x[slot] = True
+            return
+
+        parent = path[-1]
+        if left:
+            self._left[parent] = slot
+        else:
+            self._right[parent] = slot
+        # a leaf splits across its parent's splitting direction
+        self._split_x[slot] = not self._split_x.item(parent)
+
+        nodes = self._size - len(self._free)
+        if len(path) > math.log(nodes, 1 / ALPHA):
+            self.__rebalance(path, slot)
+
+    def __insert_into_block(self, path: List[int], i: int, slot: int):
+        """Rebuilds a leaf block together with a new point, as a block if its
+        slots stay consecutive and it fits, as a small subtree otherwise. The
+        block counts as one leaf for the scapegoat depth test.
+        ------------------------------------------------------------------------
+        Args:
+            path: slots of the block's ancestors, from the root
+            i: slot of the block
+            slot: slot holding the new point"""
+        slots = np.sort(np.append(np.arange(i, i + self._bucket.item(i)),
+                                  slot))
+        root = self.__build_tree(self._x[slots], self._y[slots],
+                                 self._index[slots], slots)
+        if not path:
+            self._root = root
+        elif self._left.item(path[-1]) == i:
+            self._left[path[-1]] = root
+        else:
+            self._right[path[-1]] = root
+        if self._slots is not None:
+            live = slots[self._index[slots] >= 0]
+            self._slots.update(zip(self._index[live].tolist(), live.tolist()))
+
+        nodes = self._size - len(self._free)
+        if len(path) + 1 > math.log(nodes, 1 / ALPHA):
+            self.__rebalance(path, root)
+
+    def delete(self, id: int):
+        """Deletes a point by id. The node stays as a tombstone that still
+        routes searches but is never returned. Once tombstones outnumber live
+        points the whole tree is rebuilt from the live ones, so deletions are
+        amortized O(log n) as well.
+        ------------------------------------------------------------------------
+        Args:
+            id: id of a point in the tree"""
+        id = int(id)
+        slots = self.__id_slots()
+        if id not in slots:
+            raise KeyError(f"no point with id {id} in the tree")
+        self.__reserve(0)
+        slot = slots.pop(id)
+        self._index[slot] = ~id
+        self._count -= 1
+        self.version += 1
+
+        if 2 * self._count < self._size - len(self._free):
+            self.__compact()
+
+    def coords(self, ids: np.ndarray) -> Tuple[np.ndarray]:
+        """Looks up the coords of points in the tree by id.
+        ------------------------------------------------------------------------
+        Args:
+            ids: array of point ids
+        Returns:
+            xs, ys: arrays of the points' coords"""
+        slots = self.__id_slots()
+        i = np.array([slots[id] for id in np.asarray(ids).tolist()],
+                     dtype=np.int64)
+        return self._x[i], self._y[i]
+
+    def __id_slots(self) -> dict:
+        """Map from live point ids to slots, built on the first update. Slots
+        below _size holding a non-negative id are exactly the live nodes.
+        ------------------------------------------------------------------------
         Returns:
-            dist: Euclidean distance between point1 and point2"""
-        # cast to numpy arrays
-        point1, point2 = np.array(point1), np.array(point2)
-        dist = np.sqrt(np.sum((point1 - point2)**2)) # compute distance
+            slots: dict of id: slot items"""
+        if self._slots is None:
+            live = np.flatnonzero(self._index[:self._size] >= 0)
+            self._slots = dict(zip(self._index[live].tolist(), live.tolist()))
+
+        return self._slots
 
-        return dist
+    def __reserve(self, extra: int):
+        """Makes the node arrays writable with room for extra new slots. They
+        grow geometrically, so appends are amortized O(1), and arrays mapped
+        from a file are copied on the first update.
+        ------------------------------------------------------------------------
+        Args:
+            extra: number of slots about to be taken"""
+        need = self._size + max(extra - len(self._free), 0)
+        capacity = self._x.shape[0]
+        if need <= capacity and self._x.flags.writeable:
+            return
+
+        if need > capacity:
+            capacity = max(need, 2 * capacity)
+        for name in ('_x', '_y', '_split_x', '_left', '_right', '_index',
+                     '_bucket'):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
 
-    def __min_dist_region(self, point: List[float], node: TreeNode):
-        """Function to compute minimum distance from a point to the rectangular
-        region defined by a 2d-tree splitting node.
+    def __subtree_slots(self, i: int) -> np.ndarray:
+        """Collects the slots of the nodes and leaf blocks of the subtree
+        rooted at slot i.
         ------------------------------------------------------------------------
         Args:
-            point: (2,)-shape list containing point of interest xy coordinates
-            node: splitting node whose rectangular region is to be considered
+            i: subtree root slot, -1 for an empty subtree
         Returns:
-            dist_min: minimum distance from point to region defined by node"""
-        if node == None:
-            return math.inf
-
-        xp, yp = point
-        xmin, xmax = node.xmin, node.xmax
-        ymin, ymax = node.ymin, node.ymax
-
-        xin_reg = (xmin <= xp and xp <= xmax) # is xp in [xmin, xmax]?
-        yin_reg = (ymin <= yp and yp <= ymax) # is yp in [ymin, ymax]?
-
-        if xin_reg:
-            dist_min = min(np.abs(yp - ymin), np.abs(yp - ymax))
-        elif yin_reg:
-            dist_min = min(np.abs(xp - xmin), np.abs(xp - xmax))
-        else: # point does not intersect neither [xmin, xmax] nor [ymin, ymax]
-            if xp < xmin:
-                if yp < ymin:
-                    dist_min = self.__dist([xp, yp], [xmin, ymin])
-                else:
-                    dist_min = self.__dist([xp, yp], [xmin, ymax])
-            else:
-                if yp < ymin:
-                    dist_min = self.__dist([xp, yp], [xmax, ymin])
-                else:
-                    dist_min = self.__dist([xp, yp], [xmax, ymax])
+            slots: array of node slots"""
+        slots = []
+        stack = [i] if i >= 0 else []
+        while stack:
+            i = stack.pop()
+            size = self._bucket.item(i)
+            if size > 0:
+                slots.extend(range(i, i + size))
+                continue
+            slots.append(i)
+            for child in (self._left.item(i), self._right.item(i)):
+                if child >= 0:
+                    stack.append(child)
 
-        return dist_min
+        return np.array(slots, dtype=np.int64)
+
+    def __rebalance(self, path: List[int], leaf: int):
+        """Finds the scapegoat of a too deep leaf, walking up its path while
+        counting subtree nodes, and rebuilds its subtree.
+        ------------------------------------------------------------------------
+        Args:
+            path: slots of the leaf's ancestors, from the root
+            leaf: slot of the new leaf or of a rebuilt leaf block"""
+        # nodes in the subtree rooted at child
+        size, child = self.__subtree_slots(leaf).shape[0], leaf
+        for depth in range(len(path) - 1, -1, -1):
+            i = path[depth]
+            sibling = self._right.item(i) if self._left.item(i) == child \
+                else self._left.item(i)
+            child_size = size
+            size = 1 + child_size + self.__subtree_slots(sibling).shape[0]
+            if child_size > ALPHA * size:
+                self.__rebuild(i, path[depth - 1] if depth > 0 else -1)
+                return
+            child = i
+
+    def __rebuild(self, i: int, parent: int):
+        """Rebuilds the subtree rooted at slot i from its live points, reusing
+        its slots. Slots of dropped tombstones are freed.
+        ------------------------------------------------------------------------
+        Args:
+            i: subtree root slot
+            parent: slot of the subtree root's parent, -1 for the tree's root"""
+        slots = np.sort(self.__subtree_slots(i))
+        live = slots[self._index[slots] >= 0]
+        n = live.shape[0]
+        root = self.__build_tree(self._x[live], self._y[live],
+                                 self._index[live], slots)
+        # freed slots are marked dead, so only live nodes hold an id
+        self._index[slots[n:]] = -1
+        self._bucket[slots[n:]] = 0
+        self._free.extend(slots[n:].tolist())
+        if parent < 0:
+            self._root = root
+        elif self._left.item(parent) == i:
+            self._left[parent] = root
+        else:
+            self._right[parent] = root
+        if self._slots is not None:
+            self._slots.update(zip(self._index[slots[:n]].tolist(),
+                                   slots[:n].tolist()))
+
+    def __compact(self):
+        """Rebuilds the whole tree from its live points in the first slots,
+        dropping tombstones and free slots.
+        ------------------------------------------------------------------------
+        """
+        live = np.flatnonzero(self._index[:self._size] >= 0)
+        xs, ys, ids = self._x[live], self._y[live], self._index[live]
+        self._size, self._free = live.shape[0], []
+        self._root = self.__build_tree(xs, ys, ids, np.arange(self._size))
+        self._slots = dict(zip(self._index[:self._size].tolist(),
+                               range(self._size)))
+
+    def __split(
+            self,
+            query: Tuple[float],
+            i: int,
+            xi: float,
+            yi: float,
+            bounds: Tuple[float]) -> Tuple:
+        """Orders a node's children by the side of the splitting line holding
+        the query, and computes their regions.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            i: node slot
+            xi, yi: node coords
+            bounds: node's region (xmin, xmax, ymin, ymax)
+        Returns:
+            near, far: slots of the children on the query's side and on the
+                other one, -1 for missing children
+            near_bounds, far_bounds: regions of near and far children"""
+        xmin, xmax, ymin, ymax = bounds
+        if self._split_x.item(i):
+            near_left = query[0] <= xi
+            left_bounds = (xmin, xi, ymin, ymax)
+            right_bounds = (xi, xmax, ymin, ymax)
+        else:
+            near_left = query[1] <= yi
+            left_bounds = (xmin, xmax, ymin, yi)
+            right_bounds = (xmin, xmax, yi, ymax)
+
+        if near_left:
+            return (self._left.item(i), self._right.item(i), left_bounds,
+                    right_bounds)
+        return (self._right.item(i), self._left.item(i), right_bounds,
+                left_bounds)
+
+    def __scan(self, query: Tuple[float], i: int, size: int) -> Tuple:
+        """Nearest live point of a leaf block, by a vectorized scan. Among
+        equally distant points the lowest index is kept.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            i: first slot of the block
+            size: number of points in the block
+        Returns:
+            d: distance to the nearest live point, inf if there is none
+            slot: slot of that point"""
+        d = self.metric.dists(query[0], query[1], self._x[i:i + size],
+                              self._y[i:i + size])
+        index = self._index[i:i + size]
+        if self._count < self._size - len(self._free): # tombstones exist
+            d[index < 0] = math.inf
+        j = int(d.argmin())
+        ties = np.flatnonzero(d == d.item(j))
+        if ties.shape[0] > 1:
+            j = int(ties[index[ties].argmin()])
+
+        return d.item(j), i + j
+
+    def __blocks(self, q: np.ndarray, i: np.ndarray) -> Tuple[np.ndarray]:
+        """Expands (query, node) pairs whose node starts a leaf block into
+        one pair per point of the block.
+        ------------------------------------------------------------------------
+        Args:
+            q: (k,)-shape array of query positions
+            i: (k,)-shape array of node slots
+        Returns:
+            q, i: arrays of query positions and point slots"""
+        size = self._bucket[i]
+        if not size.any():
+            return q, i
+        size = np.maximum(size, 1)
+        offsets = np.arange(size.sum()) - np.repeat(np.cumsum(size) - size,
+                                                    size)
+        return np.repeat(q, size), np.repeat(i, size) + offsets
 
     def nearest_neighbor(
-            self, 
-            query: List[float], 
-            node: TreeNode,
-            dmin: int = math.inf,
-            nn: TreeNode = None) -> TreeNode:
+            self,
+            query: List[float],
+            node: TreeNode = None,
+            dmin: float = math.inf,
+            nn: TreeNode = None,
+            eps: float = 0.0,
+            max_visits: int = None) -> Tuple[float, TreeNode]:
         """Given a query node, find nearest neighbor among the subtree nodes.
+        With eps > 0 the answer is approximate: it is at most (1 + eps) times
+        as far as the true nearest neighbor. With max_visits the search stops
+        once that many points were examined (leaf blocks are scanned whole)
+        and returns the best one so far.
         ------------------------------------------------------------------------
         Args:
             query: list of query coords
-            node: subtree node
+            node: subtree node view, defaults to tree's root
             dmin: current nearest distance
             nn: current nearest neighbor node
+            eps: relative error allowed on the nearest distance
+            max_visits: budget of points examined, None for no limit
         Returns:
+            dmin: distance from query to its nearest neighbor
             nearest: nearest neighbor to query node in subtree rooted at node"""
-        # compute distance from query to node and update dmin if applicable
+        if eps < 0:
+            raise ValueError(f"eps must be non-negative, got {eps}")
+        if max_visits is not None and max_visits < 1:
+            raise ValueError(f"max_visits must be positive, got {max_visits}")
+        if node is None:
+            node = self.root
+        if node is None: # empty tree
+            return dmin, nn
+
+        best = (dmin, -1 if nn is None else nn.slot,
+                None if nn is None else nn.bounds)
+        dmin, inn, nn_bounds = self.__nearest_neighbor(
+            (float(query[0]), float(query[1])), node.slot, node.bounds, best,
+            eps, math.inf if max_visits is None else max_visits)
+
+        return dmin, self.node(inn, nn_bounds) if inn >= 0 else nn
+
+    def __nearest_neighbor(
+            self,
+            query: Tuple[float],
+            i: int,
+            bounds: Tuple[float],
+            best: Tuple,
+            eps: float = 0.0,
+            max_visits: float = math.inf) -> Tuple:
+        """Iterative nearest neighbor search over the subtree rooted at slot i.
+        Pending subtrees are kept in an explicit stack along with a lower bound
+        on their distance to the query. The child containing the query is
+        pushed last so it is explored first, and the other child is pruned
+        when popped if its region is no closer than the best distance found.
+        Approximate searches prune regions closer than dmin / (1 + eps), whose
+        points could only improve dmin by that factor, and stop after
+        max_visits points. Among equally distant points the lowest index is
+        kept, so regions as far as the best distance are still searched. With
+        stats, the search is recorded as an 'nn' query.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            i: subtree root slot
+            bounds: region of the subtree's root
+            best: (dmin, slot, bounds) of the current nearest neighbor
+            eps: relative error allowed on the nearest distance
+            max_visits: budget of points examined
+        Returns:
+            best: updated (dmin, slot, bounds) of the nearest neighbor"""
+        start = time.perf_counter() if self.stats is not None else 0.0
         xq, yq = query
-        if node != None:
-            d = self.__dist([xq, yq], [node.x, node.y])
-            if d < dmin:
-                dmin = d
-                nn = node
+        x, y = self._x, self._y
+        dist, rect_dist = self.metric.dist, self.metric.rect_dist
+        dmin = best[0]
+        imin = self._index.item(best[1]) if best[1] >= 0 else -1
+        scale = 1.0 + eps
+        visits = checks = pruned = max_depth = 0
+        # (slot, region, min distance to region, depth below i)
+        stack = [(i, bounds, 0.0, 0)]
+        while stack:
+            i, bounds, dist_region, depth = stack.pop()
+            # region cannot hold a nearer point, by more than 1 + eps, nor
+            # an equally distant one
+            if dist_region * scale > dmin:
+                pruned += 1
+                continue
+            if visits >= max_visits: # budget spent, keep the best so far
+                break
+            if depth > max_depth:
+                max_depth = depth
+            size = self._bucket.item(i)
+            if size > 0: # leaf block
+                visits += size
+                d, j = self.__scan(query, i, size)
+                idx = self._index.item(j)
+                if d < dmin or (d == dmin and 0 <= idx < imin):
+                    dmin, imin = d, idx
+                    best = (d, j, bounds)
+                continue
+            visits += 1
+
+            # compute distance from query to node and update dmin if applicable
+            xi, yi = x.item(i), y.item(i)
+            d = dist(xq, yq, xi, yi)
+            idx = self._index.item(i)
+            # skip tombstones, ties go to the lowest index
+            if idx >= 0 and (d < dmin or (d == dmin and idx < imin)):
+                dmin, imin = d, idx
+                best = (d, i, bounds)
 
             # find where query is located with respect to subtree root node
-            if node.split_x == True:
-                if xq <= node.x: # explore left subtree
-                    dmin, nn = self.nearest_neighbor(query, node.left,
-                                                     dmin=dmin, nn=nn)
-                    # compute min distance to region defined by right node
-                    dist_region = self.__min_dist_region(query, node.right)
-                    if dist_region < dmin:
-                        # explore right subtree
-                        dmin, nn = self.nearest_neighbor(query, node.right,
-                                                         dmin=dmin, nn=nn)
-                else: # explore right subtree
-                    dmin, nn = self.nearest_neighbor(query, node.right, 
-                                                     dmin=dmin, nn=nn)
-                    dist_region = self.__min_dist_region(query, node.left)
-                    if dist_region < dmin:
-                        # explore left subtree
-                        dmin, nn = self.nearest_neighbor(query, node.left,
-                                                         dmin=dmin, nn=nn)
-            else:
-                if yq <= node.y:
-                    dmin, nn = self.nearest_neighbor(query, node.left,
-                                                     dmin=dmin, nn=nn)
-                    dist_region = self.__min_dist_region(query, node.right)
-                    if dist_region < dmin:
-                        # explore right subtree
-                        dmin, nn = self.nearest_neighbor(query, node.right,
-                                                         dmin=dmin, nn=nn)
+            near, far, near_bounds, far_bounds = self.__split(
+                query, i, xi, yi, bounds)
+            if far >= 0:
+                checks += 1
+                stack.append((far, far_bounds,
+                              rect_dist(xq, yq, far_bounds), depth + 1))
+            if near >= 0: # parent's lower bound holds for its children
+                stack.append((near, near_bounds, dist_region, depth + 1))
+
+        self.visits = visits
+        if self.stats is not None:
+            self.stats.record_query('kdtree', 'nn',
+                                    time.perf_counter() - start, visits,
+                                    checks, pruned, max_depth)
+        return best
+
+    def query(self, points: np.ndarray) -> Tuple[np.ndarray]:
+        """Batch nearest neighbor search. All queries are traversed together:
+        a greedy descent along each query's path gives an initial bound, then
+        (query, node) pairs are expanded level by level from the root and
+        pruned with the region bounds, so Python overhead is paid per level
+        instead of per query and node. Ties go to the lowest point index.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+        Returns:
+            dists: (m,)-shape array of distances to the nearest neighbors
+            indices: (m,)-shape array with the nearest neighbors' indices in
+                the input coords, -1 for an empty tree"""
+        start = time.perf_counter() if self.stats is not None else 0.0
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        m = points.shape[0]
+        dists = np.full(m, math.inf)
+        indices = np.full(m, -1, dtype=np.int64)
+        if self._root < 0 or m == 0:
+            return dists, indices
+        xq, yq = points[:, 0], points[:, 1]
+
+        # greedy descent towards the leaf containing each query
+        q = np.arange(m)
+        i = np.full(m, self._root, dtype=np.int32)
+        while q.shape[0] > 0:
+            self.__update_best(dists, indices, q, i, xq, yq)
+            near_left = np.where(self._split_x[i], xq[q] <= self._x[i],
+                                 yq[q] <= self._y[i])
+            i = np.where(near_left, self._left[i], self._right[i])
+            q, i = q[i >= 0], i[i >= 0]
+
+        # level by level expansion of (query, node) pairs with region pruning
+        q = np.arange(m)
+        i = np.full(m, self._root, dtype=np.int32)
+        inf = np.full(m, math.inf)
+        xmin, xmax, ymin, ymax = -inf, inf, -inf, inf
+        while q.shape[0] > 0:
+            self.__update_best(dists, indices, q, i, xq, yq)
+            split_x, xs, ys = self._split_x[i], self._x[i], self._y[i]
+            children = []
+            # left child shrinks the upper bound along the splitting axis
+            children.append((self._left[i], xmin, np.where(split_x, xs, xmax),
+                             ymin, np.where(split_x, ymax, ys)))
+            # right child raises the lower bound along the splitting axis
+            children.append((self._right[i], np.where(split_x, xs, xmin), xmax,
+                             np.where(split_x, ymin, ys), ymax))
+
+            pairs = []
+            for c, cxmin, cxmax, cymin, cymax in children:
+                dist_region = self.metric.rect_dists(xq[q], yq[q], cxmin,
+                                                     cxmax, cymin, cymax)
+                # regions as far as the current best may hold a lower index
+                keep = (c >= 0) & (dist_region <= dists[q])
+                pairs.append((q[keep], c[keep], cxmin[keep], cxmax[keep],
+                              cymin[keep], cymax[keep]))
+            q, i, xmin, xmax, ymin, ymax = (np.concatenate(a)
+                                            for a in zip(*pairs))
+
+        if self.stats is not None:
+            self.stats.record_batch('kdtree', 'query',
+                                    time.perf_counter() - start, m)
+        return dists, indices
+
+    def __update_best(
+            self,
+            dists: np.ndarray,
+            indices: np.ndarray,
+            q: np.ndarray,
+            i: np.ndarray,
+            xq: np.ndarray,
+            yq: np.ndarray):
+        """Updates in place the best distances and indices of a batch of
+        queries with a set of (query, node) pairs. A query may appear in more
+        than one pair; among equally distant nodes the lowest index is kept.
+        ------------------------------------------------------------------------
+        Args:
+            dists: (m,)-shape array of current nearest distances
+            indices: (m,)-shape array of current nearest indices
+            q: (k,)-shape array of query positions
+            i: (k,)-shape array of node slots
+            xq: (m,)-shape array of query x-coords
+            yq: (m,)-shape array of query y-coords"""
+        q, i = self.__blocks(q, i)
+        # tombstones are still traversed but never become neighbors
+        live = self._index[i] >= 0
+        q, i = q[live], i[live]
+        d = self.metric.dists(xq[q], yq[q], self._x[i], self._y[i])
+        update_best(dists, indices, q, d, self._index[i])
+
+    def parallel_query(
+            self,
+            points: np.ndarray,
+            workers: int = None) -> Tuple[np.ndarray]:
+        """Batch nearest neighbor search split across worker processes that
+        share the node arrays through shared memory, see parallel.py.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            workers: number of worker processes, defaults to the CPU count
+        Returns:
+            dists: (m,)-shape array of distances to the nearest neighbors
+            indices: (m,)-shape array of the nearest neighbors' indices"""
+        import parallel # loads multiprocessing, only when needed
+        return parallel.parallel_query(self, points, workers)
+
+    def nearest_join(self, queries) -> Tuple[np.ndarray]:
+        """Nearest neighbors of a large set of query points, by walking a
+        2d-tree over the queries together with this one, see join.py.
+        ------------------------------------------------------------------------
+        Args:
+            queries: (m, 2)-shape array of query coords, or a Tree over them
+        Returns:
+            dists: distances to the nearest neighbors, by query position (id
+                for a query Tree)
+            indices: nearest neighbors' indices, ties by lowest index"""
+        return join.nearest_join(self, queries)
+
+    def all_nearest_neighbors(self) -> Tuple[np.ndarray]:
+        """Nearest other point of every point of the tree, see join.py.
+        ------------------------------------------------------------------------
+        Returns:
+            dists: distances to the nearest other points, by point id
+            indices: nearest other points' ids, -1 for ids without a live
+                point"""
+        return join.all_nearest_neighbors(self)
+
+    def closest_pair(self) -> Tuple[float, int, int]:
+        """Closest pair of distinct points of the tree, see join.py.
+        ------------------------------------------------------------------------
+        Returns:
+            dist: distance between the pair, inf with fewer than two points
+            i, j: ids of the pair with i < j"""
+        return join.closest_pair(self)
+
+    def knn(self, query: List[float], k: int) -> Tuple[np.ndarray]:
+        """Finds the k nearest neighbors of a query point. Candidates are kept
+        in a bounded max-heap and a region is explored only if it may hold a
+        point closer than the current k-th candidate. Results are sorted by
+        distance, ties by index.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords
+            k: number of neighbors
+        Returns:
+            dists: (min(k, n),)-shape array of sorted distances
+            indices: (min(k, n),)-shape array of neighbors' indices"""
+        if k < 1:
+            raise ValueError(f"k must be positive, got {k}")
+        heap = [] # max-heap of (-dist, -index) pairs
+        if self._root >= 0:
+            self.__knn((float(query[0]), float(query[1])), k, heap)
+
+        return sorted_heap(heap)
+
+    def __knn(self, query: Tuple[float], k: int, heap: List[Tuple]):
+        """Iterative k nearest neighbors search, with the same stack discipline
+        as nearest neighbor search. Updates heap in place.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            k: number of neighbors
+            heap: max-heap of (-dist, -index) pairs, holds at most k items"""
+        start = time.perf_counter() if self.stats is not None else 0.0
+        x, y = self._x, self._y
+        xq, yq = query
+        dist, rect_dist = self.metric.dist, self.metric.rect_dist
+        visits = checks = pruned = max_depth = 0
+        stack = [(self._root, UNBOUNDED, 0.0, 0)]
+        while stack:
+            i, bounds, dist_region, depth = stack.pop()
+            # regions as far as the k-th candidate may hold a lower index
+            if len(heap) == k and dist_region > -heap[0][0]:
+                pruned += 1
+                continue
+            if depth > max_depth:
+                max_depth = depth
+            size = self._bucket.item(i)
+            if size > 0: # leaf block
+                visits += size
+                d = self.metric.dists(xq, yq, x[i:i + size], y[i:i + size])
+                for d, index in zip(d.tolist(),
+                                    self._index[i:i + size].tolist()):
+                    if index >= 0: # skip tombstones
+                        push_bounded(heap, k, d, index)
+                continue
+            visits += 1
+
+            xi, yi = x.item(i), y.item(i)
+            index = self._index.item(i)
+            if index >= 0: # skip tombstones
+                push_bounded(heap, k, dist(xq, yq, xi, yi), index)
+
+            near, far, near_bounds, far_bounds = self.__split(
+                query, i, xi, yi, bounds)
+            if far >= 0:
+                checks += 1
+                stack.append((far, far_bounds,
+                              rect_dist(xq, yq, far_bounds), depth + 1))
+            if near >= 0:
+                stack.append((near, near_bounds, dist_region, depth + 1))
+
+        self.visits = visits
+        if self.stats is not None:
+            self.stats.record_query('kdtree', 'knn',
+                                    time.perf_counter() - start, visits,
+                                    checks, pruned, max_depth)
+
+    def knn_batch(self, points: np.ndarray, k: int) -> Tuple[np.ndarray]:
+        """Batch k nearest neighbors search.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            k: number of neighbors
+        Returns:
+            dists: (m, min(k, n))-shape array of sorted distances
+            indices: (m, min(k, n))-shape array of neighbors' indices"""
+        return knn_each(self.knn, points, k, self._count)
+
+    def query_radius(self, query: List[float], r: float) -> Tuple[np.ndarray]:
+        """Finds all points within distance r of a query point. Regions farther
+        than r are pruned. Results are sorted by distance, ties by index.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords
+            r: search radius
+        Returns:
+            dists: array of sorted distances
+            indices: array of indices of the points within the radius"""
+        hits = [] # (dist, index) pairs
+        if self._root >= 0:
+            self.__query_radius((float(query[0]), float(query[1])), r, hits)
+        hits.sort()
+        dists = np.array([d for d, _ in hits], dtype=float)
+        indices = np.array([index for _, index in hits], dtype=np.int64)
+
+        return dists, indices
+
+    def __query_radius(self, query: Tuple[float], r: float, hits: List):
+        """Iterative radius search, appends (dist, index) pairs to hits.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            r: search radius
+            hits: list of (dist, index) pairs found so far"""
+        start = time.perf_counter() if self.stats is not None else 0.0
+        x, y = self._x, self._y
+        xq, yq = query
+        dist, rect_dist = self.metric.dist, self.metric.rect_dist
+        visits = checks = pruned = max_depth = 0
+        stack = [(self._root, UNBOUNDED, 0)]
+        while stack:
+            i, bounds, depth = stack.pop()
+            if depth > max_depth:
+                max_depth = depth
+            size = self._bucket.item(i)
+            if size > 0: # leaf block
+                visits += size
+                d = self.metric.dists(xq, yq, x[i:i + size], y[i:i + size])
+                ids = self._index[i:i + size]
+                hit = (d <= r) & (ids >= 0) # skip tombstones
+                hits.extend(zip(d[hit].tolist(), ids[hit].tolist()))
+                continue
+            visits += 1
+            xi, yi = x.item(i), y.item(i)
+            d = dist(xq, yq, xi, yi)
+            if d <= r and self._index.item(i) >= 0: # skip tombstones
+                hits.append((d, self._index.item(i)))
+
+            near, far, near_bounds, far_bounds = self.__split(
+                query, i, xi, yi, bounds)
+            if far >= 0:
+                checks += 1
+                if rect_dist(xq, yq, far_bounds) <= r:
+                    stack.append((far, far_bounds, depth + 1))
                 else:
-                    dmin, nn = self.nearest_neighbor(query, node.right,
-                                                     dmin=dmin, nn=nn)
-                    dist_region = self.__min_dist_region(query, node.left)
-                    if dist_region < dmin:
-                        # explore left subtree
-                        dmin, nn = self.nearest_neighbor(query, node.left,
-                                                         dmin=dmin, nn=nn)
-
-        return dmin, nn
+                    pruned += 1
+            if near >= 0:
+                checks += 1
+                if rect_dist(xq, yq, near_bounds) <= r:
+                    stack.append((near, near_bounds, depth + 1))
+                else:
+                    pruned += 1
+
+        self.visits = visits
+        if self.stats is not None:
+            self.stats.record_query('kdtree', 'radius',
+                                    time.perf_counter() - start, visits,
+                                    checks, pruned, max_depth)
+
+    def query_radius_batch(
+            self,
+            points: np.ndarray,
+            r: float) -> List[Tuple[np.ndarray]]:
+        """Batch radius search. As in query, (query, node) pairs are expanded
+        level by level and pairs whose region is farther than r are dropped.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            r: search radius
+        Returns:
+            results: list with a (dists, indices) pair of sorted arrays for
+                each query"""
+        start = time.perf_counter() if self.stats is not None else 0.0
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        m = points.shape[0]
+        xq, yq = points[:, 0], points[:, 1]
+        hits_q, hits_d = [np.arange(0)], [np.empty(0)]
+        hits_idx = [np.empty(0, dtype=np.int64)]
+
+        q = np.arange(m) if self._root >= 0 else np.arange(0)
+        i = np.full(q.shape[0], self._root, dtype=np.int32)
+        inf = np.full(q.shape[0], math.inf)
+        xmin, xmax, ymin, ymax = -inf, inf, -inf, inf
+        while q.shape[0] > 0:
+            pq, pi = self.__blocks(q, i)
+            d = self.metric.dists(xq[pq], yq[pq], self._x[pi], self._y[pi])
+            hit = (d <= r) & (self._index[pi] >= 0) # skip tombstones
+            hits_q.append(pq[hit])
+            hits_d.append(d[hit])
+            hits_idx.append(self._index[pi[hit]])
+
+            split_x, xs, ys = self._split_x[i], self._x[i], self._y[i]
+            children = [(self._left[i], xmin, np.where(split_x, xs, xmax),
+                         ymin, np.where(split_x, ymax, ys)),
+                        (self._right[i], np.where(split_x, xs, xmin), xmax,
+                         np.where(split_x, ymin, ys), ymax)]
+            pairs = []
+            for c, cxmin, cxmax, cymin, cymax in children:
+                dist_region = self.metric.rect_dists(xq[q], yq[q], cxmin,
+                                                     cxmax, cymin, cymax)
+                keep = (c >= 0) & (dist_region <= r)
+                pairs.append((q[keep], c[keep], cxmin[keep], cxmax[keep],
+                              cymin[keep], cymax[keep]))
+            q, i, xmin, xmax, ymin, ymax = (np.concatenate(a)
+                                            for a in zip(*pairs))
+
+        results = group_hits(m, np.concatenate(hits_q),
+                             np.concatenate(hits_d), np.concatenate(hits_idx))
+        if self.stats is not None:
+            self.stats.record_batch('kdtree', 'radius',
+                                    time.perf_counter() - start, m)
+        return results
+
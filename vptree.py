@@ -1,16 +1,77 @@
 import math
+import time
 import numpy as np
-from typing import List
+from typing import List, Tuple
+
+from metrics import get_metric
+from neighbors import knn_each, push_bounded, sorted_heap
+from stats import Stats
+from storage import read_index, write_index
+
+# relative slack on triangle inequality tests, so that rounding errors do not
+# prune shells holding points tied with the current candidates
+TOL = 1e-9
+# ranges up to this size are partitioned with plain Python while building
+SMALL_RANGE = 8
+# default number of points below which ranges are stored as flat leaf blocks,
+# chosen with benchmarks/leaf_size.py
+LEAF_SIZE = 32
+
+
+def vantage_draws(n: int) -> List[float]:
+    """Uniform draws picking the vantage point of each range of a build, one
+    per slot, from numpy's global random state."""
+    return np.random.random_sample(n).tolist()
+
+
+def pick_vantage_point(perm: np.ndarray, low_idx: int, size: int,
+                       draw: float) -> int:
+    """Moves a random point of a range of the permutation to its start, where
+    it becomes the range's vantage point.
+    ----------------------------------------------------------------------------
+    Args:
+        perm: permutation of point indices
+        low_idx: first slot of the range
+        size: number of points in the range
+        draw: uniform draw in [0, 1) choosing the point
+    Returns:
+        vp: index of the vantage point"""
+    root_i = low_idx + int(draw * size)
+    perm[low_idx], perm[root_i] = perm[root_i], perm[low_idx]
+
+    return perm[low_idx]
+
+
+def sort_small_range(dist, xs: np.ndarray, ys: np.ndarray, perm: np.ndarray,
+                     low_idx: int, up_idx: int) -> List[float]:
+    """Sorts the rest of a range by distance to its vantage point, stored at
+    its start. Meant for ranges of up to SMALL_RANGE points, where sorting in
+    Python beats NumPy call overhead.
+    ----------------------------------------------------------------------------
+    Args:
+        dist: scalar distance function of the metric
+        xs, ys: point coords
+        perm: permutation of point indices
+        low_idx: first slot of the range, holding the vantage point
+        up_idx: one past the last slot of the range
+    Returns:
+        dists: sorted distances from the vantage point to the rest"""
+    vp = perm.item(low_idx)
+    xv, yv = xs.item(vp), ys.item(vp)
+    pairs = sorted((dist(xv, yv, xs.item(p), ys.item(p)), p)
+                   for p in perm[low_idx + 1:up_idx].tolist())
+    perm[low_idx + 1:up_idx] = [p for _, p in pairs]
+
+    return [d for d, _ in pairs]
 
-def distance(point1: List[float], point2: List[float]) -> float:
-    return math.sqrt((point1[1] - point2[1])**2 + (point1[0] - point2[0])**2)
 
 # Adaptation from VP-Tree implementation, by Steve Hanov. (steve.hanov@gmail.com)
 
 # Node class
 class VpTreeNode:
-    def __init__(self, point):
+    def __init__(self, point, index: int = -1):
         self.vp = point
+        self.index = index # position of vp in the input datapoints
         self.left = None
         self.right = None
         self.mu = 0
@@ -19,117 +80,601 @@ class VpTreeNode:
         return f"(vp={self.vp}, mu={self.mu})"
 
 
+class VpTreeNodeView(VpTreeNode):
+    def __init__(self, tree: 'VpTree', slot: int):
+        """Read-only view over a node stored in the arrays of a vp-tree, with
+        lazily resolved children.
+        ------------------------------------------------------------------------
+        Args:
+            tree: vp-tree owning the node
+            slot: position of the node in the tree arrays"""
+        self._tree = tree
+        self.slot = slot
+        self.index = int(tree._vp[slot])
+        self.vp = tree._points[self.index]
+        self.mu = float(tree._mu[slot])
+        # points of the leaf block starting at this node, 0 for plain nodes
+        self.bucket = int(tree._bucket[slot])
+
+    @property
+    def left(self) -> VpTreeNode:
+        return self._tree.node(self._tree._left[self.slot])
+
+    @property
+    def right(self) -> VpTreeNode:
+        return self._tree.node(self._tree._right[self.slot])
+
+
 # VPTree Class
 class VpTree:
-    def __init__(self, datapoints):
-        self._datapoints = datapoints
-        self._root = self.__build(0, len(self._datapoints))
+    def __init__(
+            self,
+            datapoints,
+            metric: str = 'euclidean',
+            leaf_size: int = LEAF_SIZE,
+            stats: Stats = None):
+        """Builds a vp-tree over a sequence of 2d-points. Points are copied
+        into one (n, 2) array, which is never reordered. Node k covers a
+        range of a permutation of point indices starting at k, so nodes are
+        stored in preorder in flat arrays: vantage point index, radius mu and
+        child slots. Any metric works, searches only rely on the triangle
+        inequality. Ranges of up to leaf_size points are not split further:
+        they are leaf blocks, scanned with one vectorized distance call.
+        ------------------------------------------------------------------------
+        Args:
+            datapoints: sequence of (2,)-shape points, (lon, lat) for
+                haversine
+            metric: metric name or object, see metrics.py
+            leaf_size: largest leaf block, 1 for one point per node
+            stats: statistics recorder for searches and builds, see
+                stats.py, None to keep only the visits of the last search"""
+        if leaf_size < 1:
+            raise ValueError(f"leaf_size must be positive, got {leaf_size}")
+        self._points = np.asarray(datapoints, dtype=float).reshape(-1, 2)
+        n = self._points.shape[0]
+        self._vp = np.arange(n) # permutation, slot k holds node k's vp
+        self._mu = np.zeros(n)
+        self._left = np.full(n, -1, dtype=np.int32)
+        self._right = np.full(n, -1, dtype=np.int32)
+        # size of the leaf block starting at each slot, 0 for plain nodes
+        self._bucket = np.zeros(n, dtype=np.int32)
+        self.leaf_size = leaf_size
+        self.visits = 0 # nodes visited by the last search
+        self.version = 0 # vp-trees are static, it never changes
+        # (lon_mean, lat_mean) used to project the input coords, if any
+        self.projection = None
+        self.metric = get_metric(metric)
+        self.stats = stats
+        self._root = self.__build(0, n)
 
-    def __build(self, low_idx, up_idx):
-        # terminal case
-        if up_idx == low_idx:
+    def __len__(self) -> int:
+        return self._points.shape[0]
+
+    @property
+    def root(self) -> VpTreeNode:
+        return self.node(self._root)
+
+    def node(self, slot: int) -> VpTreeNode:
+        """Builds a VpTreeNode view of the node stored at a given slot.
+        ------------------------------------------------------------------------
+        Args:
+            slot: node position in the tree arrays, -1 stands for no node
+        Returns:
+            view: VpTreeNode view or None if slot is -1"""
+        if slot < 0:
             return None
 
-        # terminal case with one node
-        if up_idx - low_idx == 1:
-            node = VpTreeNode(self._datapoints[low_idx])
-            return node
-
-        # if previous conditions are not met, then there are at least two data
-        root_i = np.random.randint(low_idx, up_idx) # choose rand index for root
-        # swap corresponding element with starting element
-        tmp = self._datapoints[root_i], self._datapoints[low_idx]
-        self._datapoints[low_idx], self._datapoints[root_i] = tmp
-
-        # compute all distances to subtree's root node
-        dists = [distance(p, self._datapoints[low_idx])
-                for p in self._datapoints[low_idx:up_idx]]
-        mid = len(dists) // 2 # distances' middle element
-        # move all elements lower to mid element to left and higher to the right
-        idx = np.argpartition(dists, mid)
-        zero = np.argwhere(idx == 0)[0][0] # track position of zero idx
-        # swap it to the leftmost position
-        idx[zero] = idx[0]
-        idx[0] = 0
-
-        # partially sort data based on their distance to low_idx element
-        tmp = [self._datapoints[low_idx + i] for i in idx]
-        self._datapoints[low_idx:up_idx] = tmp
-        
-        # create subtree root node
-        node = VpTreeNode(self._datapoints[low_idx])
-        node.mu = distance(self._datapoints[low_idx],
-                           self._datapoints[low_idx + mid])
-
-        # recursive call for left and right child nodes
-        node.left = self.__build(low_idx + 1, low_idx + mid + 1)
-        node.right = self.__build(low_idx + mid + 1, up_idx)
-
-        return node
+        return VpTreeNodeView(self, int(slot))
+
+    @property
+    def points(self) -> np.ndarray:
+        """(n, 2)-shape array of the indexed points in input order.
+        ------------------------------------------------------------------------
+        """
+        return self._points
+
+    def _state(self) -> Tuple[dict]:
+        """Point and node arrays and scalar attributes that fully describe the
+        tree, used to save it and to share it with other processes.
+        ------------------------------------------------------------------------
+        Returns:
+            arrays: named arrays
+            attrs: JSON serializable scalar attributes"""
+        arrays = {'points': self._points, 'vp': self._vp, 'mu': self._mu,
+                  'left': self._left, 'right': self._right,
+                  'bucket': self._bucket}
+        attrs = {'root': int(self._root), 'projection': self.projection,
+                 'metric': self.metric.name, 'leaf_size': self.leaf_size}
+        return arrays, attrs
+
+    @classmethod
+    def _from_state(cls, arrays: dict, attrs: dict) -> 'VpTree':
+        """Wraps arrays returned by _state into a tree, without copying them.
+        ------------------------------------------------------------------------
+        Args:
+            arrays: named arrays
+            attrs: scalar attributes
+        Returns:
+            tree: VpTree using the given arrays"""
+        tree = cls.__new__(cls)
+        tree._points, tree._vp = arrays['points'], arrays['vp']
+        tree._mu = arrays['mu']
+        tree._left, tree._right = arrays['left'], arrays['right']
+        # files written before leaf blocks hold one point per node
+        tree._bucket = arrays.get('bucket', np.zeros(len(arrays['vp']),
+                                                     dtype=np.int32))
+        tree.leaf_size = attrs.get('leaf_size', 1)
+        tree._root = attrs['root']
+        tree.visits = tree.version = 0
+        tree.stats = None
+        projection = attrs['projection']
+        tree.projection = tuple(projection) if projection else None
+        tree.metric = get_metric(attrs.get('metric', 'euclidean'))
+
+        return tree
+
+    def coords(self, ids: np.ndarray) -> Tuple[np.ndarray]:
+        """Looks up the coords of points by index.
+        ------------------------------------------------------------------------
+        Args:
+            ids: array of point indices
+        Returns:
+            xs, ys: arrays of the points' coords"""
+        points = self._points[np.asarray(ids, dtype=np.int64)]
+        return points[:, 0], points[:, 1]
+
+    def save(self, path: str):
+        """Writes the points and node arrays to a binary index file, see
+        storage.py.
+        ------------------------------------------------------------------------
+        Args:
+            path: output file path"""
+        write_index(path, 'vptree', *self._state())
+
+    @classmethod
+    def load(
+            cls,
+            path: str,
+            mmap: bool = True,
+            verify: bool = None) -> 'VpTree':
+        """Loads a tree written by save without rebuilding it. With mmap, the
+        arrays are read-only memory mapped views of the file, so loading is
+        immediate and processes loading the same file share its pages.
+        ------------------------------------------------------------------------
+        Args:
+            path: input file path
+            mmap: map the file instead of reading it into memory
+            verify: check the data checksum, by default only when not mapping
+        Returns:
+            tree: loaded VpTree"""
+        return cls._from_state(*read_index(path, 'vptree', mmap, verify))
+
+    def __build(self, low_idx, up_idx):
+        """Iterative building method. Pending index ranges are kept in an
+        explicit stack. At each node, distances from the vantage point to the
+        rest of the range are computed in one vectorized call and the range of
+        the permutation is partitioned around their median with argpartition.
+        Vantage points are drawn from numpy's global random state. With stats,
+        the time spent sorting small ranges, partitioning larger ones and
+        laying out nodes is recorded.
+        ------------------------------------------------------------------------
+        Args:
+            low_idx: first slot of the range to index
+            up_idx: one past the last slot of the range to index
+        Returns:
+            root: slot of the root node, -1 if the range is empty"""
+        # phases are only timed when statistics are recorded
+        timed = self.stats is not None
+        start = time.perf_counter() if timed else 0.0
+        t_sort = t_partition = 0.0
+        root = low_idx if up_idx > low_idx else -1
+        n = up_idx - low_idx
+        xs, ys = self._points[:, 0], self._points[:, 1]
+        dist = self.metric.dist
+        perm = self._vp
+        draws = vantage_draws(up_idx - low_idx)
+        offset = low_idx
+        stack = [(low_idx, up_idx)] if up_idx > low_idx else []
+        while stack:
+            low_idx, up_idx = stack.pop()
+            size = up_idx - low_idx
+            # terminal case with one node, no children and mu = 0
+            if size == 1:
+                continue
+            if size <= self.leaf_size: # leaf block, no vp
+                self._bucket[low_idx] = size
+                continue
+
+            # at least two data, the random vp is moved to the range's start
+            vp = pick_vantage_point(perm, low_idx, size,
+                                    draws[low_idx - offset])
+            mid = size // 2 # size of the inner range
+
+            t = time.perf_counter() if timed else 0.0
+            if size <= SMALL_RANGE:
+                dists = sort_small_range(dist, xs, ys, perm, low_idx, up_idx)
+                self._mu[low_idx] = dists[mid - 1] # largest inner distance
+                if timed:
+                    t_sort += time.perf_counter() - t
+            else:
+                # compute distances from vp to the rest of the range
+                rest = perm[low_idx + 1:up_idx]
+                dists = self.metric.dists(xs[vp], ys[vp], xs[rest], ys[rest])
+                # move the mid closest elements to the left, the rest to the
+                # right
+                idx = dists.argpartition(mid - 1)
+                perm[low_idx + 1:up_idx] = rest[idx]
+                self._mu[low_idx] = dists[idx[mid - 1]] # largest inner dist
+                if timed:
+                    t_partition += time.perf_counter() - t
+
+            # pending ranges for left and right child nodes
+            self._left[low_idx] = low_idx + 1
+            if low_idx + mid + 1 < up_idx:
+                self._right[low_idx] = low_idx + mid + 1
+                stack.append((low_idx + mid + 1, up_idx))
+            stack.append((low_idx + 1, low_idx + mid + 1))
+
+        if timed and root >= 0:
+            t_layout = time.perf_counter() - start - t_sort - t_partition
+            self.stats.record_build('vptree', n, {
+                'sort': t_sort, 'partition': t_partition,
+                'layout': t_layout})
+        return root
+
+    def __vp_distance(self, query, slot: int) -> float:
+        """Distance from query to the vantage point of a node.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            slot: node slot
+        Returns:
+            d: distance from query to node's vp"""
+        v = self._vp.item(slot)
+        return self.metric.dist(query[0], query[1], self._points.item(v, 0),
+                                self._points.item(v, 1))
+
+    def __scan(self, query, slot: int, size: int) -> Tuple[np.ndarray]:
+        """Distances from query to the points of a leaf block.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            slot: first slot of the block
+            size: number of points in the block
+        Returns:
+            d: (size,)-shape array of distances
+            ids: (size,)-shape array of point indices"""
+        ids = self._vp[slot:slot + size]
+        points = self._points[ids]
+        return self.metric.dists(query[0], query[1], points[:, 0],
+                                 points[:, 1]), ids
+
+    def __push_children(
+            self,
+            stack: List[Tuple],
+            slot: int,
+            d: float,
+            depth: int) -> int:
+        """Pushes a node's children along with lower bounds on the distance
+        from the query to their points. Inner subtree holds points at distance
+        <= mu from vp and outer subtree points at distance >= mu, so the
+        triangle inequality gives d - mu and mu - d. The shell containing the
+        query is pushed last, so it is explored first.
+        ------------------------------------------------------------------------
+        Args:
+            stack: pending (slot, lower bound, depth) triples
+            slot: node slot
+            d: distance from query to node's vp
+            depth: depth of the node
+        Returns:
+            pushed: number of children pushed"""
+        mu = self._mu.item(slot)
+        left, right = self._left.item(slot), self._right.item(slot)
+        slack = TOL * (d + mu)
+        inner_gap = d - mu - slack # lower bound for inner points
+        outer_gap = mu - d - slack # lower bound for outer points
+        depth += 1
+        if d < mu:
+            if right >= 0:
+                stack.append((right, outer_gap, depth))
+            if left >= 0:
+                stack.append((left, inner_gap, depth))
+        else:
+            if left >= 0:
+                stack.append((left, inner_gap, depth))
+            if right >= 0:
+                stack.append((right, outer_gap, depth))
+
+        return (left >= 0) + (right >= 0)
 
     def __nearest_neighbor(
-              self, 
-              query, 
-              node, 
-              tau: float = math.inf, 
-              nn: VpTreeNode = None) -> VpTreeNode:
-        """"""
-        if node != None:
-            d = distance(query, node.vp)
-            if nn == None: # special case at initialization
-                tau = d
-                nn = node
-                # explore inner region
-                nl, tl = self.__nearest_neighbor(query, node.left, 
-                                                 tau=tau, nn=nn)
-                if tl < tau:
-                    tau = tl 
-                    nn = nl
-                # explore outter region
-                nr, tr = self.__nearest_neighbor(query, node.right, 
-                                                 tau=tau, nn=nn)
-                if tr < tau:
-                    tau = tr
-                    nn = nr
-            else: # second iteration onward
+            self,
+            query,
+            slot: int,
+            eps: float = 0.0,
+            max_visits: float = math.inf) -> Tuple[int, float]:
+        """Iterative nearest neighbor search. tau is the best distance found so
+        far: a subtree is visited only if its distance shell around its
+        parent's vantage point intersects the ball of radius tau around the
+        query, i.e. d - mu <= tau for the inner subtree and mu - d <= tau for
+        the outer one. The shell containing the query is explored first so tau
+        shrinks early. Ties are broken by lowest index. Approximate searches
+        shrink the ball to radius tau / (1 + eps) and stop after max_visits
+        points. With stats, the search is recorded as an 'nn' query.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            slot: subtree root slot
+            eps: relative error allowed on the nearest distance
+            max_visits: budget of points examined
+        Returns:
+            nn: slot of the nearest neighbor node, -1 for an empty tree
+            tau: distance from query to nn"""
+        start = time.perf_counter() if self.stats is not None else 0.0
+        nn, nn_index, tau = -1, -1, math.inf
+        scale = 1.0 + eps
+        visits = checks = pruned = max_depth = 0
+        # pending subtrees as (slot, lower bound on distance to its points,
+        # depth)
+        stack = [(slot, -math.inf, 0)] if slot >= 0 else []
+        while stack:
+            slot, gap, depth = stack.pop()
+            # shell does not intersect the ball of radius tau / (1 + eps)
+            if gap * scale > tau:
+                pruned += 1
+                continue
+            if visits >= max_visits: # budget spent, keep the best so far
+                break
+            if depth > max_depth:
+                max_depth = depth
+            size = self._bucket.item(slot)
+            if size > 0: # leaf block
+                visits += size
+                d, ids = self.__scan(query, slot, size)
+                j = int(d.argmin())
+                if d.item(j) <= tau:
+                    # lowest index among the block's nearest points
+                    tied = np.flatnonzero(d == d.item(j))
+                    j = int(tied[ids[tied].argmin()])
+                    if d.item(j) < tau or ids.item(j) < nn_index:
+                        tau = d.item(j)
+                        nn, nn_index = slot + j, ids.item(j)
+                continue
+
+            visits += 1
+            d = self.__vp_distance(query, slot)
+            index = self._vp.item(slot)
+            if d < tau or (d == tau and index < nn_index):
                 tau = d
-                nn = node
-                if tau + node.mu < d: # prune inner tree
-                    nr, tr = self.__nearest_neighbor(query, node.right,
-                                                     tau=d, nn=nn)
-                    if tr < tau:
-                        tau = tr
-                        nn = nr
-                elif tau < node.mu and d < node.mu - tau: # prune outter tree
-                    nl, tl = self.__nearest_neighbor(query, node.left,
-                                                     tau=d, nn=nn)
-                    if tl < tau:
-                        tau = tl
-                        nn = nl
-                elif node.mu - tau < d and d < node.mu + tau: # check both trees
-                    # explore inner region
-                    nl, tl = self.__nearest_neighbor(query, node.left, 
-                                                     tau=d, nn=nn)
-                    if tl < tau:
-                        tau = tl 
-                        nn = nl
-                    # explore outter region
-                    nr, tr = self.__nearest_neighbor(query, node.right, 
-                                                     tau=tau, nn=nn)
-                    if tr < tau:
-                        tau = tr
-                        nn = nr
+                nn, nn_index = slot, index
+
+            checks += self.__push_children(stack, slot, d, depth)
+
+        self.visits = visits
+        if self.stats is not None:
+            self.stats.record_query('vptree', 'nn',
+                                    time.perf_counter() - start, visits,
+                                    checks, pruned, max_depth)
         return nn, tau
 
-    def nearest_neighbor(self, query) -> VpTreeNode:
-        return self.__nearest_neighbor(query, self._root)
+    def nearest_neighbor(
+            self,
+            query,
+            eps: float = 0.0,
+            max_visits: int = None) -> Tuple[VpTreeNode, float]:
+        """Finds the nearest neighbor of a query point, ties by lowest index.
+        With eps > 0 the answer is at most (1 + eps) times as far as the true
+        nearest neighbor. With max_visits the search stops once that many
+        points were examined (leaf blocks are scanned whole) and returns the
+        best one so far.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            eps: relative error allowed on the nearest distance
+            max_visits: budget of points examined, None for no limit
+        Returns:
+            nn: nearest neighbor node, None for an empty tree
+            tau: distance from query to nn"""
+        if eps < 0:
+            raise ValueError(f"eps must be non-negative, got {eps}")
+        if max_visits is not None and max_visits < 1:
+            raise ValueError(f"max_visits must be positive, got {max_visits}")
+        nn, tau = self.__nearest_neighbor(
+            query, self._root, eps,
+            math.inf if max_visits is None else max_visits)
+        return self.node(nn), tau
+
+    def query(self, points: np.ndarray) -> Tuple[np.ndarray]:
+        """Batch nearest neighbor search, with the same outputs as Tree.query.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+        Returns:
+            dists: (m,)-shape array of distances to the nearest neighbors
+            indices: (m,)-shape array with the nearest neighbors' indices in
+                the input points, -1 for an empty tree"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        dists = np.full(points.shape[0], math.inf)
+        indices = np.full(points.shape[0], -1, dtype=np.int64)
+        for j, query in enumerate(points.tolist()):
+            nn, dists[j] = self.__nearest_neighbor(query, self._root)
+            if nn >= 0:
+                indices[j] = self._vp.item(nn)
+
+        return dists, indices
+
+    def parallel_query(
+            self,
+            points: np.ndarray,
+            workers: int = None) -> Tuple[np.ndarray]:
+        """Batch nearest neighbor search split across worker processes that
+        share the node arrays through shared memory, see parallel.py.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            workers: number of worker processes, defaults to the CPU count
+        Returns:
+            dists: (m,)-shape array of distances to the nearest neighbors
+            indices: (m,)-shape array of the nearest neighbors' indices"""
+        import parallel # loads multiprocessing, only when needed
+        return parallel.parallel_query(self, points, workers)
+
+    def knn(self, query, k: int) -> Tuple[np.ndarray]:
+        """Finds the k nearest neighbors of a query point. Candidates are kept
+        in a bounded max-heap with the k-th candidate distance as tau, so a
+        subtree is explored only if its distance shell around the vantage
+        point may hold a closer point. Results are sorted by distance, ties by
+        index.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            k: number of neighbors
+        Returns:
+            dists: (min(k, n),)-shape array of sorted distances
+            indices: (min(k, n),)-shape array of neighbors' indices"""
+        if k < 1:
+            raise ValueError(f"k must be positive, got {k}")
+        heap = [] # max-heap of (-dist, -index) pairs
+        self.__knn(query, k, self._root, heap)
+
+        return sorted_heap(heap)
+
+    def __knn(self, query, k: int, slot: int, heap: List[Tuple]):
+        """Iterative k nearest neighbors search, with the same stack discipline
+        as nearest neighbor search. Updates heap in place.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            k: number of neighbors
+            slot: subtree root slot
+            heap: max-heap of (-dist, -index) pairs, holds at most k items"""
+        start = time.perf_counter() if self.stats is not None else 0.0
+        visits = checks = pruned = max_depth = 0
+        # pending subtrees as (slot, lower bound on distance to its points,
+        # depth)
+        stack = [(slot, -math.inf, 0)] if slot >= 0 else []
+        while stack:
+            slot, gap, depth = stack.pop()
+            # tau is the k-th candidate distance, ties may hold a lower index
+            tau = -heap[0][0] if len(heap) == k else math.inf
+            if gap > tau: # shell does not intersect the ball of radius tau
+                pruned += 1
+                continue
+            if depth > max_depth:
+                max_depth = depth
+            size = self._bucket.item(slot)
+            if size > 0: # leaf block
+                visits += size
+                d, ids = self.__scan(query, slot, size)
+                for d, index in zip(d.tolist(), ids.tolist()):
+                    push_bounded(heap, k, d, index)
+                continue
+
+            visits += 1
+            d = self.__vp_distance(query, slot)
+            push_bounded(heap, k, d, self._vp.item(slot))
+            checks += self.__push_children(stack, slot, d, depth)
+
+        self.visits = visits
+        if self.stats is not None:
+            self.stats.record_query('vptree', 'knn',
+                                    time.perf_counter() - start, visits,
+                                    checks, pruned, max_depth)
+
+    def knn_batch(self, points: np.ndarray, k: int) -> Tuple[np.ndarray]:
+        """Batch k nearest neighbors search.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            k: number of neighbors
+        Returns:
+            dists: (m, min(k, n))-shape array of sorted distances
+            indices: (m, min(k, n))-shape array of neighbors' indices"""
+        return knn_each(self.knn, points, k, len(self))
+
+    def query_radius(self, query, r: float) -> Tuple[np.ndarray]:
+        """Finds all points within distance r of a query point. A subtree is
+        pruned when its distance shell does not intersect the query ball.
+        Results are sorted by distance, ties by index.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            r: search radius
+        Returns:
+            dists: array of sorted distances
+            indices: array of indices of the points within the radius"""
+        hits = [] # (dist, index) pairs
+        self.__query_radius(query, r, self._root, hits)
+        hits.sort()
+        dists = np.array([d for d, _ in hits], dtype=float)
+        indices = np.array([i for _, i in hits], dtype=np.int64)
+
+        return dists, indices
+
+    def __query_radius(self, query, r: float, slot: int, hits: List):
+        """Iterative radius search, appends (dist, index) pairs to hits.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            r: search radius
+            slot: subtree root slot
+            hits: list of (dist, index) pairs found so far"""
+        start = time.perf_counter() if self.stats is not None else 0.0
+        visits = checks = pruned = max_depth = 0
+        stack = [(slot, -math.inf, 0)] if slot >= 0 else []
+        while stack:
+            slot, gap, depth = stack.pop()
+            if gap > r: # shell does not intersect the query ball
+                pruned += 1
+                continue
+            if depth > max_depth:
+                max_depth = depth
+            size = self._bucket.item(slot)
+            if size > 0: # leaf block
+                visits += size
+                d, ids = self.__scan(query, slot, size)
+                hit = d <= r
+                hits.extend(zip(d[hit].tolist(), ids[hit].tolist()))
+                continue
+
+            visits += 1
+            d = self.__vp_distance(query, slot)
+            if d <= r:
+                hits.append((d, self._vp.item(slot)))
+            checks += self.__push_children(stack, slot, d, depth)
+
+        self.visits = visits
+        if self.stats is not None:
+            self.stats.record_query('vptree', 'radius',
+                                    time.perf_counter() - start, visits,
+                                    checks, pruned, max_depth)
+
+    def query_radius_batch(
+            self,
+            points: np.ndarray,
+            r: float) -> List[Tuple[np.ndarray]]:
+        """Batch radius search.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            r: search radius
+        Returns:
+            results: list with a (dists, indices) pair of sorted arrays for
+                each query"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return [self.query_radius(query, r) for query in points]
 
     def print(self):
         self.__print_subtree(self._root)
 
-    def __print_subtree(self, node):
-        if node.left != None:
-            self.__print_subtree(node.left)
-        print(node)
-        if node.right != None:
-            self.__print_subtree(node.right)
+    def __print_subtree(self, slot):
+        stack = [] # ancestors whose outer subtree is still to be printed
+        while stack or slot >= 0:
+            while slot >= 0:
+                stack.append(slot)
+                slot = self._left[slot]
+            slot = stack.pop()
+            # leaf blocks print all their points
+            for j in range(slot, slot + max(self._bucket[slot], 1)):
+                print(self.node(j))
+            slot = self._right[slot]